@@ -1,16 +1,27 @@
+import asyncio
 import os
 import ssl
 import socket
-import subprocess
 import threading
 import time
-from ipaddress import ip_interface, IPv6Interface
+from ipaddress import ip_address, ip_interface, IPv6Interface
 from dataclasses import dataclass
 
-import hcloud
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request
-from wireguard_tools import WireguardConfig, WireguardDevice, WireguardKey, WireguardPeer
+from fastapi import FastAPI, HTTPException, Request, Response
+from wireguard_tools import WireguardConfig, WireguardKey, WireguardPeer
+
+import backend as wireguard_backend
+import metrics
+import mtu
+import netconf
+import tracing
+import unbound
+from labels import LabelWriter
+from prober import Hysteresis, LivenessMonitor
+from ratelimit import RateLimitedClient
+from resolver import CachedResolver
+from startup import Startup, setup_wireguard
 
 @dataclass(kw_only=True)
 class Hetznat64AgentConfig:
@@ -32,15 +43,81 @@ class Hetznat64AgentConfig:
     api_endpoint: str = "https://api.hetzner.cloud/v1"
     discovery_label_prefix: str = "hetznat64"
 
+    # Seconds to reuse the control server hostname's resolved address
+    dns_ttl: float = 60
+
+    # Seconds to collect label changes before writing them to the API
+    label_debounce: float = 2.0
+
+    # Consecutive failed checks before a connected agent falls back to waiting
+    fail_threshold: int = 3
+
+    # Wireguard interface MTU (None to work it out from the path to the control server)
+    tunnel_mtu: int = None
+
+    # Seconds between path MTU probes through the tunnel (0 to disable)
+    mtu_probe_interval: float = 300
+
+    # URL of the DNS64 resolver's stats (its scraper's /stats endpoint, None to disable) and
+    # seconds between reads
+    dns64_stats_url: str = None
+    dns64_stats_interval: float = 30
+
+    # File to write trace spans to as JSON lines (None to disable tracing)
+    trace_file: str = None
+
+def _same_tunnel(current: WireguardConfig, addresses: list[IPv6Interface], desired: WireguardConfig,
+                 address: IPv6Interface) -> bool:
+    """Whether the device and its address already carry the tunnel `desired` and `address` describe."""
+    if addresses != [address] or current.private_key != desired.private_key or len(current.peers) != 1:
+        return False
+    live, = current.peers.values()
+    peer, = desired.peers.values()
+    return (
+        live.public_key == peer.public_key
+        and live.preshared_key == peer.preshared_key
+        and str(live.endpoint_host) == str(peer.endpoint_host)
+        and live.endpoint_port == peer.endpoint_port
+        # The device reports allowed IPs as networks, without the host part
+        and {ip.network for ip in live.allowed_ips} == {ip.network for ip in peer.allowed_ips}
+    )
+
 class Hetznat64Agent:
-    def __init__(self, config: Hetznat64AgentConfig):
+    def __init__(self, config: Hetznat64AgentConfig, network: netconf.NetConf | netconf.NetConfClient = None,
+                 backend: wireguard_backend.WireguardBackend = None):
         self.__lock = threading.Lock()
+        self.__network = network or netconf.connect()
+        self.__backend = backend or wireguard_backend.select_backend()
         self.__state_label = f'{config.discovery_label_prefix}.status'
         self.__state = 'initializing'
         self.__control_ip = None
         self.__config = config
         self.__wg_key = None
-        self.__client = hcloud.Client(token=self.__config.api_key, api_endpoint=self.__config.api_endpoint)
+        # The tunnel the last handshake configured and the response it returned
+        self.__tunnel: tuple = None
+        self.__handshake_response: dict = None
+        self.__handshake_lock = asyncio.Lock()
+        self.__resolver = CachedResolver(ttl=config.dns_ttl)
+        self.__liveness = LivenessMonitor()
+        # Last stats read for the control peer, reported by /metrics without touching the device
+        self.__control_peer_stats: WireguardPeer = None
+        self.__connectivity = Hysteresis(rise=1, fall=config.fail_threshold)
+        self.__mtu: mtu.MTUPlan = None
+        self.__mtu_probe = mtu.PathMTUProbe(self.__control_address, interval=config.mtu_probe_interval)
+        self.__dns64 = unbound.StatsScraper(
+            lambda: unbound.fetch_stats(config.dns64_stats_url), interval=config.dns64_stats_interval,
+        ) if config.dns64_stats_url else None
+        if config.trace_file:
+            tracing.configure(config.trace_file)
+        self.__client = RateLimitedClient(token=self.__config.api_key, api_endpoint=self.__config.api_endpoint)
+        self.__labels = LabelWriter(self.__client, debounce=config.label_debounce)
+        metrics.AGENT_STATE.labels(self.__state).set(1)
+        # This instance's collectors, served by /metrics next to the process-wide metrics
+        self.__collectors = metrics.instance_registry()
+        metrics.register(metrics.ApiBudgetCollector(self.__client), self.__collectors)
+        metrics.register(metrics.PeerStatsCollector(self.__peer_stats), self.__collectors)
+        if self.__dns64:
+            metrics.register(metrics.ResolverStatsCollector(self.__dns64), self.__collectors)
         self.__app = FastAPI()
         self.__setup_routes()
 
@@ -52,6 +129,11 @@ class Hetznat64Agent:
         with self.__lock:
             if self.__state != value:
                 print(f"Updating state from {self.__state} to {value}")
+                metrics.set_agent_state(self.__state, value)
+                if value == 'waiting':
+                    # The tunnel isn't working, so the next handshake checks it against the device and
+                    # repairs whatever differs instead of answering from memory
+                    self.__tunnel = None
                 self.__state = value
                 self.add_labels({ self.__state_label: value })
 
@@ -69,43 +151,62 @@ class Hetznat64Agent:
             recheck += 1
             control_ip = self.__get_control_ip()
             state = self.__get_state()
-            if control_ip and (state != 'connected' or recheck >= 20):
+            # Check again right away while a failure is waiting to be confirmed
+            if control_ip and (state != 'connected' or recheck >= 20 or self.__connectivity.pending):
+                recheck = 0
                 ping_ip = str(IPv6Interface(control_ip).ip)
-                try:
-                    ping_result = subprocess.run(
-                        ["ping6", "-c", "1", "-W", "2", ping_ip],
-                        capture_output=True
-                    )
-                    recheck = 0
-                    if ping_result.returncode == 0:
-                        print(f"Ping to {ping_ip} succeeded")
-                        self.__set_state('connected')
+                control_peer = self.__control_peer()
+                if control_peer and self.__liveness.passive('control', control_peer):
+                    # A recent handshake or incoming traffic proves the tunnel without sending anything
+                    connected = True
+                else:
+                    rtt = self.__liveness.prober.probe([ping_ip], timeout=2).get(ping_ip)
+                    connected = rtt is not None
+                    if connected:
+                        print(f"Ping to {ping_ip} succeeded ({rtt * 1000:.1f} ms)")
                     else:
                         print(f"Ping to {ping_ip} failed")
-                        self.__set_state('waiting')
-                except Exception as e:
-                    print(f"Ping process failed for {ping_ip}: {e}")
+                # Single lost pings don't flip a connected agent back to waiting
+                self.__set_state('connected' if self.__connectivity.update(connected) else 'waiting')
             elif not control_ip and state != 'waiting':
                 self.__set_state('waiting')
             time.sleep(1)
 
-    def add_labels(self, labels: dict):
-        server_id = os.environ.get('HOSTNAME', None)
+    def __control_address(self) -> str | None:
+        control_ip = self.__get_control_ip()
+        return str(IPv6Interface(control_ip).ip) if control_ip else None
+
+    def __control_peer(self) -> WireguardPeer | None:
         try:
-            if os.path.exists("/var/lib/cloud/data/instance-id"):
-                with open("/var/lib/cloud/data/instance-id", "r") as f:
-                    server_id = f.read().strip()
-        except Exception:
-            pass
+            device = self.__backend.device(self.__config.wg_interface)
+            try:
+                self.__control_peer_stats = next(iter(device.get_config().peers.values()), None)
+                return self.__control_peer_stats
+            finally:
+                device.close()
+        except Exception as e:
+            print(f"Failed to read Wireguard stats for {self.__config.wg_interface}: {e}")
+            return None
+
+    def __tune_mtu(self, endpoint_host: str):
+        """Size the tunnel for the path to the control server. Best effort: a handshake doesn't fail over it."""
+        try:
+            destination = ip_address(endpoint_host) if self.__config.tunnel_mtu is None else None
+            self.__mtu = mtu.tune(self.__network, self.__config.wg_interface, destination, tunnel=self.__config.tunnel_mtu)
+        except Exception as e:
+            print(f"Failed to tune the MTU of {self.__config.wg_interface} for {endpoint_host}: {e}")
 
-        server = self.__client.servers.get_by_id(server_id)
-        existing_labels = server.labels or {}
-        existing_labels.update(labels)
-        server.update(labels=existing_labels)
+    def add_labels(self, labels: dict):
+        """Queue labels to be written to this server; returns without waiting for the API."""
+        self.__labels.set(labels)
 
     def start(self):
         self.__set_control_ip(None)
         threading.Thread(target=self.__check_connection, daemon=True).start()
+        if self.__config.mtu_probe_interval:
+            self.__mtu_probe.start()
+        if self.__dns64:
+            self.__dns64.start()
         uvicorn.run(self.__app, host='::', port=self.__config.rest_port,
                     ssl_certfile=self.__config.cert_file,
                     ssl_keyfile=self.__config.key_file,
@@ -117,6 +218,7 @@ class Hetznat64Agent:
         self.__app.get('/ready')(self.__ready)
         self.__app.get('/health')(self.__health)
         self.__app.post('/handshake')(self.__handshake)
+        self.__app.get('/metrics')(self.__metrics)
 
     async def __ready(self):
         return {"status": "ok"}
@@ -124,17 +226,57 @@ class Hetznat64Agent:
     async def __health(self):
         if self.__get_state() != 'connected':
             raise HTTPException(status_code=500, detail="Not connected to control server")
-        return {"status": "ok"}
+        return {
+            "status": "ok",
+            "tunnel_mtu": self.__mtu.tunnel if self.__mtu else None,
+            "path_mtu": self.__mtu_probe.as_dict(),
+            "dns64": self.__dns64.as_dict() if self.__dns64 else None,
+        }
+
+    async def __metrics(self):
+        body, content_type = metrics.exposition(self.__collectors)
+        return Response(content=body, media_type=content_type)
+
+    def __peer_stats(self):
+        peer = self.__control_peer_stats
+        if peer:
+            yield {'public_key': str(peer.public_key), 'server': 'control'}, peer
 
     async def __handshake(self, request: Request):
+        start = time.perf_counter()
+        try:
+            with tracing.span('agent.handshake'):
+                response = await self.__apply_handshake(request)
+        except Exception:
+            metrics.HANDSHAKE_FAILURES.inc()
+            metrics.HANDSHAKE_DURATION.labels('failure').observe(time.perf_counter() - start)
+            raise
+        metrics.HANDSHAKE_DURATION.labels('success').observe(time.perf_counter() - start)
+        return response
+
+    async def __apply_handshake(self, request: Request):
         data = await request.json()
+        tunnel = tuple(data.get(name) for name in ('public_key', 'preshared_key', 'control_ip', 'control_port', 'agent_ip', 'control_host'))
+
+        # A retrying service repeats the same handshake; if it matches the tunnel we already
+        # configured (and haven't lost since), answer from memory without touching the device
+        if tunnel == self.__tunnel:
+            return self.__handshake_response
+
+        async with self.__handshake_lock:
+            if tunnel != self.__tunnel:
+                # Resolving and reconfiguring the device block, so keep them off the event loop
+                self.__handshake_response = await asyncio.to_thread(self.__configure_tunnel, data)
+                self.__tunnel = tunnel
+            return self.__handshake_response
+
+    def __configure_tunnel(self, data: dict) -> dict:
         agent_ip = data.get('agent_ip')
         control_ip = data.get('control_ip')
         control_port = data.get('control_port')
         public_key = data.get('public_key')
         preshared_key = data.get('preshared_key', None)
 
-        self.__control_ip = control_ip
         if not self.__wg_key:
             self.__wg_key = WireguardKey.generate()
 
@@ -150,13 +292,12 @@ class Hetznat64Agent:
             listen_port=self.__config.wg_port,
         )
 
-        # Resolve the control server hostname to get its IPv6 address
-        try:
-            addrinfo = socket.getaddrinfo(self.__config.control_server_hostname, None, socket.AF_INET6)
-            endpoint_host = addrinfo[0][4][0]  # Get the first IPv6 address
-        except socket.gaierror as e:
-            print(f"Failed to resolve IPv6 address for {self.__config.control_server_hostname}: {e}")
-            endpoint_host = self.__config.control_server_hostname
+        # Resolve the control server hostname to get its IPv6 address. With several gateways the
+        # handshake names the one this server was assigned to
+        control_host = data.get('control_host') or self.__config.control_server_hostname
+        endpoint_host = self.__resolver.resolve(control_host, socket.AF_INET6)
+        if endpoint_host is None:
+            endpoint_host = control_host
         config.add_peer(WireguardPeer(
             friendly_name="control",
             public_key=public_key,
@@ -166,15 +307,25 @@ class Hetznat64Agent:
             allowed_ips=[control_ip, IPv6Interface("64:ff9b::/96")],
         ))
 
-        current_config = WireguardDevice.get(self.__config.wg_interface).get_config()
-        current_peer = next(iter(current_config.peers.keys()), None)
-        new_peer = next(iter(config.peers.keys()), None)
-        if current_peer != new_peer:
-            print(f"Updating Wireguard configuration")
-            print('current_peer', current_peer)
-            print('new_peer', new_peer)
-            subprocess.run(["/usr/bin/sudo", "/update-ip.sh", str(ip_interface(new_agent_ip))], check=True)
-            WireguardDevice.get(self.__config.wg_interface).set_config(config)
+        device = self.__backend.device(self.__config.wg_interface)
+        try:
+            with tracing.span('device.get_config', interface=self.__config.wg_interface):
+                current = device.get_config()
+            addresses = self.__network.addresses(self.__config.wg_interface)
+            # A server moved to another address keeps its control key, so compare the whole tunnel
+            if not _same_tunnel(current, addresses, config, ip_interface(new_agent_ip)):
+                print(f"Updating Wireguard configuration")
+                self.__network.set_address(self.__config.wg_interface, ip_interface(new_agent_ip))
+                self.__network.masquerade(self.__config.wg_interface)
+                self.__tune_mtu(endpoint_host)
+                with tracing.span('device.set_config', interface=self.__config.wg_interface):
+                    device.set_config(config)
+        finally:
+            device.close()
+        self.__set_control_ip(control_ip)
+        if self.__config.mtu_probe_interval:
+            # Check the new tunnel right away rather than at the next interval
+            threading.Thread(target=self.__mtu_probe.probe, daemon=True).start()
 
         response = {
             'public_key': str(self.__wg_key.public_key()),
@@ -187,39 +338,48 @@ if __name__ == "__main__":
     port = os.environ.get("WG_PORT", "51820")
     ipv6 = os.environ.get("WG_IPV6", "fd00:6464::1/64")
     ipv4 = os.environ.get("WG_IPV4", "10.0.0.1/24")
-    try:
-        device = WireguardDevice.get(interface)
-        wgconf = device.get_config()
-    except Exception as e:
-        print(f"Wireguard interface {interface} not found, creating it")
-        subprocess.Popen([ "/usr/bin/sudo", "/setup-wg.sh",
-            "--name", interface, "--port", port, "--ip6", ipv6, "--ip4", ipv4,
-        ])
-        while True:
-            time.sleep(1)
-            try:
-                device = WireguardDevice.get(interface)
-                wgconf = device.get_config()
-                break
-            except Exception as e:
-                print(f"Wireguard interface {interface} not found, retrying...")
-
-    # Setup NAT64 route
     nat64_prefix = os.environ.get("NAT64_PREFIX", "64:ff9b::/96")
-    subprocess.run(["/usr/bin/sudo", "/setup-nat64.sh", "--prefix", nat64_prefix, "--dev", interface], check=True)
-
-    agent_config = Hetznat64AgentConfig(
-        wg_interface=interface,
-        wg_port=port,
-        control_server_hostname=os.environ.get('CONTROL_SERVER_HOSTNAME', 'server'),
-        rest_port=int(os.environ.get('PORT', 5001)),
-        cert_file=os.environ.get('CERT_FILE', None),
-        key_file=os.environ.get('KEY_FILE', None),
-        ca_file=os.environ.get('CA_FILE', None),
-        api_endpoint=os.environ.get('HCLOUD_API_ENDPOINT', 'https://api.hetzner.cloud/v1'),
-        api_key=os.environ.get('HCLOUD_API_TOKEN', None),
-        discovery_label_prefix=os.environ.get('DISCOVERY_LABEL_PREFIX', 'hetznat64'),
-    )
+    tunnel_mtu = int(os.environ['WG_MTU']) if os.environ.get('WG_MTU') else None
+    network = netconf.connect()
+    backend = wireguard_backend.from_environment(network=network)
+
+    def setup_device():
+        device = setup_wireguard(interface, network, backend, port=port, ip6=ipv6, ip4=ipv4)
+        device.close()
+
+    def create_agent():
+        agent_config = Hetznat64AgentConfig(
+            wg_interface=interface,
+            wg_port=port,
+            control_server_hostname=os.environ.get('CONTROL_SERVER_HOSTNAME', 'server'),
+            rest_port=int(os.environ.get('PORT', 5001)),
+            cert_file=os.environ.get('CERT_FILE', None),
+            key_file=os.environ.get('KEY_FILE', None),
+            ca_file=os.environ.get('CA_FILE', None),
+            api_endpoint=os.environ.get('HCLOUD_API_ENDPOINT', 'https://api.hetzner.cloud/v1'),
+            api_key=os.environ.get('HCLOUD_API_TOKEN', None),
+            discovery_label_prefix=os.environ.get('DISCOVERY_LABEL_PREFIX', 'hetznat64'),
+            dns_ttl=float(os.environ.get('DNS_TTL', 60)),
+            label_debounce=float(os.environ.get('LABEL_DEBOUNCE', 2)),
+            fail_threshold=int(os.environ.get('FAIL_THRESHOLD', 3)),
+            tunnel_mtu=tunnel_mtu,
+            mtu_probe_interval=float(os.environ.get('MTU_PROBE_INTERVAL', 300)),
+            dns64_stats_url=os.environ.get('DNS64_STATS_URL') or None,
+            dns64_stats_interval=float(os.environ.get('DNS64_STATS_INTERVAL', 30)),
+            trace_file=os.environ.get('TRACE_FILE') or None,
+        )
+        return Hetznat64Agent(agent_config, network=network, backend=backend)
+
+    # The agent (FastAPI app, API client) is built while the device comes up
+    print(f"Wireguard backend: {backend.describe()}")
+    startup = Startup()
+    startup.step('wireguard', setup_device)
+    startup.step('nat64-route', lambda: network.ensure_route(nat64_prefix, dev=interface), after=('wireguard',))
+    # Sized for the default route until the first handshake names the control server
+    startup.step('mtu', lambda: mtu.tune(network, interface, tunnel=tunnel_mtu), after=('wireguard',))
+    startup.step('agent', create_agent)
+    agent = startup.run()['agent']
+    print(startup.timeline.report())
+    startup.timeline.export()
 
-    agent = Hetznat64Agent(agent_config)
     agent.start()
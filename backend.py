@@ -0,0 +1,285 @@
+import os
+import random
+import time
+from ipaddress import ip_address, ip_interface
+from typing import Iterator
+
+from wireguard_tools import WireguardConfig, WireguardDevice, WireguardKey, WireguardPeer
+
+import wgpeers
+
+BACKENDS = ('auto', 'kernel', 'boringtun', 'fake')
+
+# CAP_NET_ADMIN's bit in /proc/<pid>/status CapEff
+CAP_NET_ADMIN = 12
+
+def _has_net_admin() -> bool:
+    if os.geteuid() == 0:
+        return True
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("CapEff:"):
+                    return bool(int(line.split()[1], 16) >> CAP_NET_ADMIN & 1)
+    except OSError:
+        pass
+    return False
+
+def host_cpus() -> int:
+    """CPUs this process may run on, which can be fewer than the host has (cgroups/affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class WireguardBackend:
+    """
+    Where wireguard devices come from and how they are created.
+
+    The service, agent and startup code open devices through a backend instead of calling
+    `WireguardDevice.get` directly, so the data plane can be swapped (kernel module, userspace
+    boringtun, or an in-memory fake for tests) without touching the control plane.
+    """
+
+    name: str = None
+
+    def device(self, interface: str) -> WireguardDevice:
+        raise NotImplementedError
+
+    def devices(self) -> Iterator[WireguardDevice]:
+        raise NotImplementedError
+
+    def set_peers(self, interface: str, removed: list[WireguardKey], peers: list[WireguardPeer]):
+        """
+        Remove the `removed` peers and add or replace `peers`, leaving every other peer alone
+        (`WireguardDevice.set_config` always replaces them all).
+        """
+        raise NotImplementedError
+
+    def setup_command(self, interface: str, port: int | str, ip6: str, ip4: str) -> list[str] | None:
+        """Command that creates the device, or None if the backend creates it in-process."""
+        return ["/usr/bin/sudo", "/setup-wg.sh",
+                "--name", interface, "--port", str(port), "--ip6", ip6, "--ip4", ip4,
+                *self._setup_arguments()]
+
+    def create(self, interface: str):
+        """Create the device in-process (backends whose setup_command is None)."""
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        return self.name
+
+    def _setup_arguments(self) -> list[str]:
+        return ["--backend", self.name]
+
+class HelperWireguardDevice(WireguardDevice):
+    """
+    A kernel wireguard device configured through the privileged network helper, for processes
+    without CAP_NET_ADMIN (the container runs as an unprivileged user).
+    """
+
+    def __init__(self, interface: str, network):
+        super().__init__(interface)
+        self.__network = network
+
+    def get_config(self) -> WireguardConfig:
+        return WireguardConfig.from_dict(self.__network.wg_config(self.interface))
+
+    def set_config(self, config: WireguardConfig):
+        self.__network.wg_set_config(self.interface, config.asdict())
+
+class KernelBackend(WireguardBackend):
+    """
+    The in-kernel wireguard module, configured over netlink. setup-wg.sh creates the device
+    (under sudo); a process without CAP_NET_ADMIN then configures it through the network helper
+    (`network`, a netconf.NetConfClient, connected on first use if not given).
+    """
+
+    name = 'kernel'
+
+    def __init__(self, network=None):
+        self.__network = network
+
+    @staticmethod
+    def available() -> bool:
+        return os.path.isdir("/sys/module/wireguard")
+
+    def device(self, interface: str) -> WireguardDevice:
+        if _has_net_admin():
+            from wireguard_tools.wireguard_netlink import WireguardNetlinkDevice
+            return WireguardNetlinkDevice(interface)
+        return HelperWireguardDevice(interface, self.__helper())
+
+    def devices(self) -> Iterator[WireguardDevice]:
+        if _has_net_admin():
+            from wireguard_tools.wireguard_netlink import WireguardNetlinkDevice
+            yield from WireguardNetlinkDevice.list()
+            return
+        for interface in self.__helper().wg_interfaces():
+            yield self.device(interface)
+
+    def set_peers(self, interface: str, removed: list[WireguardKey], peers: list[WireguardPeer]):
+        if _has_net_admin():
+            wgpeers.set_peers_netlink(interface, removed, peers)
+        else:
+            self.__helper().wg_set_peers(interface, [str(key) for key in removed], [peer.asdict() for peer in peers])
+
+    def __helper(self):
+        if self.__network is None:
+            import netconf
+            self.__network = netconf.NetConfClient()
+        return self.__network
+
+class BoringtunBackend(WireguardBackend):
+    """
+    Userspace boringtun, configured over its UAPI socket. Multi-queue gives every worker thread
+    its own tun queue, so packet processing scales with `threads` instead of one queue.
+    """
+
+    name = 'boringtun'
+
+    def __init__(self, threads: int = None, multi_queue: bool = True):
+        self.threads = threads or host_cpus()
+        self.multi_queue = multi_queue
+
+    def device(self, interface: str) -> WireguardDevice:
+        from wireguard_tools.wireguard_uapi import WireguardUAPIDevice
+        return WireguardUAPIDevice(interface)
+
+    def devices(self) -> Iterator[WireguardDevice]:
+        from wireguard_tools.wireguard_uapi import WireguardUAPIDevice
+        yield from WireguardUAPIDevice.list()
+
+    def set_peers(self, interface: str, removed: list[WireguardKey], peers: list[WireguardPeer]):
+        wgpeers.set_peers_uapi(interface, removed, peers)
+
+    def describe(self) -> str:
+        return f"{self.name} ({'multi-queue' if self.multi_queue else 'single queue'}, {self.threads} threads)"
+
+    def _setup_arguments(self) -> list[str]:
+        return [*super()._setup_arguments(), "--threads", str(self.threads),
+                "--multi-queue", "1" if self.multi_queue else "0"]
+
+class FakeWireguardDevice(WireguardDevice):
+    """
+    A wireguard device that only exists in memory.
+
+    It speaks enough of the UAPI `set` protocol for FakeBackend.set_peers and counts every write. Peers
+    report a handshake once they have been on the device for a read, with probability
+    `handshake_rate`, which stands in for the other side bringing the tunnel up.
+    """
+
+    def __init__(self, interface: str, handshake_rate: float = 1.0):
+        super().__init__(interface)
+        self.config = WireguardConfig()
+        self.writes = 0
+        self.peer_writes = 0
+        self.__handshake_rate = handshake_rate
+        self.__random = random.Random(interface)
+
+    def close(self):
+        pass
+
+    def get_config(self) -> WireguardConfig:
+        now = time.time()
+        config = WireguardConfig(
+            private_key=self.config.private_key,
+            listen_port=self.config.listen_port,
+            fwmark=self.config.fwmark,
+        )
+        for peer in self.config.peers.values():
+            if peer.last_handshake is None and self.__random.random() < self.__handshake_rate:
+                peer.last_handshake = now
+            config.add_peer(WireguardPeer.from_dict(peer.asdict()))
+        return config
+
+    def set_config(self, config: WireguardConfig):
+        self.writes += 1
+        self.peer_writes += len(config.peers)
+        self.config = WireguardConfig(private_key=config.private_key, listen_port=config.listen_port, fwmark=config.fwmark)
+        for peer in config.peers.values():
+            self.config.add_peer(WireguardPeer.from_dict(peer.asdict()))
+
+    def apply_uapi(self, message: str):
+        self.writes += 1
+        peer = None
+        for line in message.splitlines():
+            if not line or line == "set=1":
+                continue
+            key, value = line.split("=", 1)
+            if key == "public_key":
+                public_key = WireguardKey(bytes.fromhex(value))
+                peer = self.config.peers.get(public_key) or WireguardPeer(public_key=public_key)
+                self.config.peers[public_key] = peer
+                self.peer_writes += 1
+            elif key == "remove":
+                self.config.del_peer(peer.public_key)
+            elif key == "endpoint":
+                host, port = value.rsplit(":", 1)
+                peer.endpoint_host = ip_address(host.strip("[]"))
+                peer.endpoint_port = int(port)
+            elif key == "persistent_keepalive_interval":
+                peer.persistent_keepalive = int(value) or None
+            elif key == "replace_allowed_ips":
+                peer.allowed_ips = []
+            elif key == "allowed_ip":
+                peer.allowed_ips.append(ip_interface(value))
+            elif key == "preshared_key":
+                peer.preshared_key = WireguardKey(bytes.fromhex(value))
+
+class FakeBackend(WireguardBackend):
+    """
+    Devices that only exist in memory, for running the control plane without privileges.
+    Devices are shared by every FakeBackend in the process, like real interfaces are.
+    """
+
+    name = 'fake'
+    registry: dict[str, FakeWireguardDevice] = {}
+
+    def __init__(self, handshake_rate: float = 1.0):
+        self.handshake_rate = handshake_rate
+
+    def device(self, interface: str) -> FakeWireguardDevice:
+        if interface not in self.registry:
+            raise FileNotFoundError(f"Unable to access interface: {interface} not found.")
+        return self.registry[interface]
+
+    def devices(self) -> Iterator[FakeWireguardDevice]:
+        yield from list(self.registry.values())
+
+    def set_peers(self, interface: str, removed: list[WireguardKey], peers: list[WireguardPeer]):
+        self.device(interface).apply_uapi(wgpeers.uapi_message(removed, peers))
+
+    def setup_command(self, interface: str, port: int | str, ip6: str, ip4: str) -> None:
+        return None
+
+    def create(self, interface: str) -> FakeWireguardDevice:
+        if interface not in self.registry:
+            self.registry[interface] = FakeWireguardDevice(interface, handshake_rate=self.handshake_rate)
+        return self.registry[interface]
+
+def select_backend(name: str = 'auto', threads: int = None, multi_queue: bool = True, network=None) -> WireguardBackend:
+    """
+    The backend called `name`; 'auto' prefers the kernel module and falls back to boringtun.
+    `network` is the NetConf(Client) the kernel backend configures devices through when this
+    process can't itself.
+    """
+    if name == 'auto':
+        name = 'kernel' if KernelBackend.available() else 'boringtun'
+    if name == 'kernel':
+        return KernelBackend(network=network)
+    if name == 'boringtun':
+        return BoringtunBackend(threads=threads, multi_queue=multi_queue)
+    if name == 'fake':
+        return FakeBackend()
+    raise ValueError(f"Unknown wireguard backend {name}, expected one of {', '.join(BACKENDS)}")
+
+def from_environment(network=None) -> WireguardBackend:
+    """Backend chosen by WG_BACKEND, WG_THREADS and WG_MULTI_QUEUE."""
+    threads = os.environ.get("WG_THREADS")
+    return select_backend(
+        os.environ.get("WG_BACKEND", "auto"),
+        threads=int(threads) if threads else None,
+        multi_queue=os.environ.get("WG_MULTI_QUEUE", "1") not in ("0", "false", "no"),
+        network=network,
+    )
@@ -0,0 +1,248 @@
+"""
+Control-plane reconciliation benchmark.
+
+Runs Hetznat64Service.poll() against the mock Hetzner API in synthetic fleet mode, an
+in-memory wireguard device and a fake agent fleet answering /handshake, and reports per-cycle
+latency percentiles, API requests, device writes, CPU time and peak memory for each fleet size.
+
+    python benchmark.py --sizes 10,100,1000,5000
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.25
+
+Each fleet size runs in its own process so CPU and memory figures don't leak between sizes.
+With --baseline the run exits non-zero when a metric regresses by more than --threshold.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipaddress import ip_interface
+from urllib.parse import parse_qs, urlparse
+
+from wireguard_tools import WireguardKey
+
+from backend import FakeBackend
+
+# Metrics compared against a baseline; all of them are "lower is better"
+COMPARED_METRICS = ("p50_ms", "p99_ms", "cold_ms", "api_requests", "device_writes", "cpu_ms", "max_rss_mb")
+
+class FakeAgentHandler(BaseHTTPRequestHandler):
+    """Answers every agent's /handshake; the agent is named by the ?agent= query parameter."""
+
+    latency = 0.0
+    failure_rate = 0.0
+
+    def do_POST(self):
+        agent = parse_qs(urlparse(self.path).query).get("agent", [""])[0]
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        digest = hashlib.sha256(agent.encode()).digest()
+        if self.latency:
+            time.sleep(self.latency * (0.5 + digest[1] / 255))
+        if digest[0] / 255 < self.failure_rate:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"public_key": base64.b64encode(digest).decode(), "port": 51820}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port} after {timeout}s")
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q) - 1]
+
+def run_fleet(size: int, args) -> dict:
+    """Benchmark one fleet size in this process, returning its metrics."""
+    api_port, agent_port = free_port(), free_port()
+    env = {
+        **os.environ,
+        "MOCK_FLEET_SIZE": str(size),
+        "MOCK_CHURN_INTERVAL": str(args.churn_interval),
+        "MOCK_CHURN_RATE": str(args.churn_rate),
+        "MOCK_LATENCY_MS": str(args.api_latency_ms),
+    }
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "hetzner:app", "--host", "127.0.0.1", "--port", str(api_port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    agents = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--fake-agents", str(agent_port),
+         "--agent-latency-ms", str(args.agent_latency_ms), "--agent-failure-rate", str(args.agent_failure_rate)],
+    )
+    try:
+        wait_for_port(api_port)
+        wait_for_port(agent_port)
+        return measure(size, args, api_port, agent_port)
+    finally:
+        api.terminate()
+        agents.terminate()
+        api.wait()
+        agents.wait()
+
+def measure(size: int, args, api_port: int, agent_port: int) -> dict:
+    from service import Hetznat64Config, Hetznat64Service, WireguardServerConfig
+
+    backend = FakeBackend(handshake_rate=args.handshake_rate)
+    device = backend.create("bench0")
+    service = Hetznat64Service(Hetznat64Config(
+        wireguard=WireguardServerConfig(name=device.interface, ip=ip_interface("fd00:6464::1/64"), port=51820, key=WireguardKey.generate()),
+        api_endpoint=f"http://127.0.0.1:{api_port}/v1",
+        api_key="benchmark",
+        agent_url=f"http://127.0.0.1:{agent_port}/handshake?agent={{host}}",
+        handshake_concurrency=args.handshake_concurrency,
+        handshake_timeout=args.handshake_timeout,
+    ), backend=backend)
+
+    cycles = []
+    for _ in range(args.cycles + 1):
+        requests_before = service.api_budget["requests"]
+        writes_before = device.writes
+        cpu_before = time.process_time()
+        started = time.perf_counter()
+        service.poll()
+        cycles.append({
+            "seconds": time.perf_counter() - started,
+            "cpu": time.process_time() - cpu_before,
+            "api_requests": service.api_budget["requests"] - requests_before,
+            "device_writes": device.writes - writes_before,
+        })
+        time.sleep(args.interval)
+    service.stop()
+
+    # The first cycle handshakes the whole fleet; report it separately from the steady state
+    cold, steady = cycles[0], cycles[1:] or cycles[:1]
+    latencies = [cycle["seconds"] * 1000 for cycle in steady]
+    return {
+        "servers": size,
+        "peers": len(device.config.peers),
+        "cold_ms": cold["seconds"] * 1000,
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+        "api_requests": statistics.mean(cycle["api_requests"] for cycle in steady),
+        "device_writes": statistics.mean(cycle["device_writes"] for cycle in steady),
+        "cpu_ms": statistics.mean(cycle["cpu"] for cycle in steady) * 1000,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    regressions = []
+    previous = {row["servers"]: row for row in baseline}
+    for row in results:
+        before = previous.get(row["servers"])
+        if not before:
+            continue
+        for metric in COMPARED_METRICS:
+            # Ignore noise on tiny absolute values
+            if before[metric] > 0.5 and row[metric] > before[metric] * (1 + threshold):
+                regressions.append(f"{row['servers']} servers: {metric} {before[metric]:.1f} -> {row[metric]:.1f}")
+    return regressions
+
+def print_table(results: list[dict]):
+    columns = ("servers", "peers", "cold_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms", "api_requests", "device_writes", "cpu_ms", "max_rss_mb")
+    print(" ".join(f"{column:>13}" for column in columns))
+    for row in results:
+        print(" ".join(f"{row[column]:>13.1f}" if isinstance(row[column], float) else f"{row[column]:>13}" for column in columns))
+
+def serve_fake_agents(port: int, latency_ms: float, failure_rate: float):
+    FakeAgentHandler.latency = latency_ms / 1000
+    FakeAgentHandler.failure_rate = failure_rate
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeAgentHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,5000", help="Comma separated fleet sizes")
+    parser.add_argument("--cycles", type=int, default=20, help="Steady-state cycles measured per size")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between cycles (not measured)")
+    parser.add_argument("--churn-interval", type=float, default=1.0, help="Seconds between fleet churn ticks (0 disables churn)")
+    parser.add_argument("--churn-rate", type=float, default=0.01, help="Share of the fleet touched per churn tick")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="Mean latency added by the mock API")
+    parser.add_argument("--agent-latency-ms", type=float, default=5, help="Mean latency of a fake agent handshake")
+    parser.add_argument("--agent-failure-rate", type=float, default=0, help="Share of agents answering handshakes with a 500")
+    parser.add_argument("--handshake-rate", type=float, default=1.0, help="Share of peers that complete a wireguard handshake")
+    parser.add_argument("--handshake-concurrency", type=int, default=32)
+    parser.add_argument("--handshake-timeout", type=float, default=10)
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the results to PATH")
+    parser.add_argument("--baseline", metavar="PATH", help="Compare the results with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative regression against the baseline")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--fake-agents", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fake_agents:
+        serve_fake_agents(args.fake_agents, args.agent_latency_ms, args.agent_failure_rate)
+        return
+    if args.run_one:
+        print(json.dumps(run_fleet(args.run_one, args)))
+        return
+
+    results = []
+    passthrough = [
+        "--cycles", str(args.cycles), "--interval", str(args.interval),
+        "--churn-interval", str(args.churn_interval), "--churn-rate", str(args.churn_rate),
+        "--api-latency-ms", str(args.api_latency_ms), "--agent-latency-ms", str(args.agent_latency_ms),
+        "--agent-failure-rate", str(args.agent_failure_rate), "--handshake-rate", str(args.handshake_rate),
+        "--handshake-concurrency", str(args.handshake_concurrency), "--handshake-timeout", str(args.handshake_timeout),
+    ]
+    for size in (int(size) for size in args.sizes.split(",")):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-one", str(size), *passthrough],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+        if not args.json:
+            print(f"{size} servers done", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+from ipaddress import IPv4Address, IPv6Address, ip_address
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+from pyroute2 import IPRoute
+
+from netconf import NetConf, NetConfError
+
+KEY_TYPES = ('ecdsa', 'ed25519', 'rsa')
+
+# Reissue certificates this close to expiry instead of reusing them
+RENEW_BEFORE = datetime.timedelta(days=30)
+
+def generate_key(key_type: str = 'ecdsa'):
+    """A new private key. P-256 and Ed25519 keys take milliseconds where RSA-4096 takes seconds."""
+    if key_type == 'ecdsa':
+        return ec.generate_private_key(ec.SECP256R1())
+    if key_type == 'ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    if key_type == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    raise ValueError(f"Unknown key type {key_type}, expected one of {', '.join(KEY_TYPES)}")
+
+def interface_addresses(devices: list[str], timeout: float = 10) -> list[IPv4Address | IPv6Address]:
+    """All addresses on the given interfaces, waiting up to `timeout` for each to appear."""
+    addresses = []
+    netconf = NetConf()
+    try:
+        with IPRoute() as ipr:
+            for device in devices:
+                try:
+                    index = netconf.wait_for_interface(device, timeout=timeout)
+                except NetConfError:
+                    print(f"Warning: Interface {device} not found after {timeout:.0f} seconds")
+                    continue
+                for message in ipr.get_addr(index=index):
+                    address = ip_address(message.get_attr('IFA_ADDRESS'))
+                    if address not in addresses:
+                        addresses.append(address)
+    finally:
+        netconf.close()
+    return addresses
+
+def subject_alt_names(hostnames: list[str], ips: list[IPv4Address | IPv6Address]) -> set[x509.GeneralName]:
+    return {x509.DNSName('localhost'), *(x509.DNSName(host) for host in hostnames), *(x509.IPAddress(ip) for ip in ips)}
+
+def _certificate_san(certificate: x509.Certificate) -> set[x509.GeneralName]:
+    try:
+        return set(certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName).value)
+    except x509.ExtensionNotFound:
+        return set()
+
+def _reusable(cert_file: str, key_file: str, ca: x509.Certificate, names: set[x509.GeneralName], key_type: str) -> bool:
+    """Whether an existing certificate was signed by `ca`, covers exactly `names`, has the wanted key type and isn't about to expire."""
+    try:
+        with open(cert_file, 'rb') as f:
+            certificate = x509.load_pem_x509_certificates(f.read())[0]
+        with open(key_file, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+    except (OSError, ValueError):
+        return False
+    if certificate.issuer != ca.subject:
+        return False
+    try:
+        certificate.verify_directly_issued_by(ca)
+    except Exception:
+        return False
+    if key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo) != \
+            certificate.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo):
+        return False
+    if not isinstance(key, {'ecdsa': ec.EllipticCurvePrivateKey, 'ed25519': ed25519.Ed25519PrivateKey,
+                            'rsa': rsa.RSAPrivateKey}[key_type]):
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if certificate.not_valid_after_utc - RENEW_BEFORE < now:
+        return False
+    return _certificate_san(certificate) == names
+
+def _write(path: str, data: bytes, mode: int):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.cert-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temporary, mode)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def issue_certificate(ca_file: str, out_dir: str, hostnames: list[str] = (), ips: list = (),
+                      key_type: str = 'ecdsa', days: int = 900, ca_key_file: str = None) -> bool:
+    """
+    Make sure `out_dir` holds a certificate and key signed by the CA for the given names.
+
+    A certificate left by a previous start is reused when it still matches, so restarts skip
+    key generation entirely; it's only reissued when the addresses (or the CA) changed.
+    Returns whether a new certificate was issued.
+    """
+    ca_key_file = ca_key_file or os.path.splitext(ca_file)[0] + '.key'
+    with open(ca_file, 'rb') as f:
+        ca_pem = f.read()
+    ca = x509.load_pem_x509_certificate(ca_pem)
+
+    names = subject_alt_names(list(hostnames), [ip_address(ip) for ip in ips])
+    cert_file = os.path.join(out_dir, 'cert.pem')
+    key_file = os.path.join(out_dir, 'cert.key')
+    if _reusable(cert_file, key_file, ca, names, key_type):
+        print(f"Reusing certificate {cert_file}")
+        return False
+
+    with open(ca_key_file, 'rb') as f:
+        ca_key = serialization.load_pem_private_key(f.read(), password=None)
+    key = generate_key(key_type)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')]))
+        .issuer_name(ca.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=days))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(x509.KeyUsage(
+            digital_signature=True, key_encipherment=key_type == 'rsa', content_commitment=False,
+            data_encipherment=False, key_agreement=False, key_cert_sign=False, crl_sign=False,
+            encipher_only=False, decipher_only=False,
+        ), critical=True)
+        .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH, ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+        .add_extension(x509.SubjectAlternativeName(sorted(names, key=str)), critical=False)
+        # Ed25519 CAs sign without a separate digest
+        .sign(ca_key, None if isinstance(ca_key, ed25519.Ed25519PrivateKey) else hashes.SHA256())
+    )
+
+    os.makedirs(out_dir, exist_ok=True)
+    _write(key_file, key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                       serialization.NoEncryption()), 0o600)
+    # Bundle the CA certificate with the certificate so clients get the full chain
+    _write(cert_file, certificate.public_bytes(serialization.Encoding.PEM) + ca_pem, 0o644)
+    print(f"Issued {key_type} certificate {cert_file} for {', '.join(sorted(str(name.value) for name in names))}")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Issue (or reuse) a certificate signed by the hetznat64 CA")
+    parser.add_argument('--ca', required=True, help="CA certificate; its key is expected next to it with a .key suffix")
+    parser.add_argument('--dev', action='append', default=[], help="Interfaces whose addresses to include, colon separated")
+    parser.add_argument('--host', action='append', default=[], help="Additional DNS names")
+    parser.add_argument('--ip', action='append', default=[], help="Additional IP addresses")
+    parser.add_argument('--out', required=True, help="Directory to write cert.pem and cert.key to")
+    parser.add_argument('--key-type', choices=KEY_TYPES, default=os.environ.get('CERT_KEY_TYPE', 'ecdsa'))
+    parser.add_argument('--days', type=int, default=900)
+    args = parser.parse_args()
+
+    devices = [device for value in args.dev for device in value.split(':') if device]
+    ips = [*(ip_address(ip) for value in args.ip for ip in value.split(',') if ip), *interface_addresses(devices)]
+    hostnames = [host for value in args.host for host in value.split(',') if host]
+    if not os.path.isfile(args.ca):
+        print(f"Error: CA file {args.ca} does not exist")
+        sys.exit(1)
+    issue_certificate(args.ca, args.out, hostnames=hostnames, ips=ips, key_type=args.key_type, days=args.days)
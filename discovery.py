@@ -0,0 +1,129 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import hcloud
+from hcloud.servers import BoundServer
+
+import tracing
+
+@dataclass(frozen=True)
+class InventoryDelta:
+    added: list[BoundServer] = field(default_factory=list)
+    changed: list[BoundServer] = field(default_factory=list)
+    removed: list[BoundServer] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self):
+        return f"{len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} removed"
+
+def _fingerprint(server: BoundServer) -> tuple:
+    """The parts of a server the service reacts to."""
+    ipv6 = server.public_net.ipv6.ip if server.public_net and server.public_net.ipv6 else None
+    return (ipv6, tuple(sorted((server.labels or {}).items())))
+
+class ServerInventory:
+    """Servers carrying the discovery label as of the last listing, keyed by id."""
+
+    def __init__(self):
+        self.__servers: dict[int, BoundServer] = {}
+        self.__fingerprints: dict[int, tuple] = {}
+
+    def __len__(self):
+        return len(self.__servers)
+
+    def __iter__(self):
+        return iter(self.__servers.values())
+
+    def __contains__(self, server_id: int):
+        return server_id in self.__servers
+
+    def get(self, server_id: int) -> BoundServer | None:
+        return self.__servers.get(server_id)
+
+    def update(self, servers: list[BoundServer]) -> InventoryDelta:
+        """Replace the inventory with `servers`, returning how it differs from before."""
+        delta = InventoryDelta()
+        servers_by_id = {server.id: server for server in servers}
+        for server_id, server in servers_by_id.items():
+            fingerprint = _fingerprint(server)
+            previous = self.__fingerprints.get(server_id)
+            if previous is None:
+                delta.added.append(server)
+            elif previous != fingerprint:
+                delta.changed.append(server)
+            self.__fingerprints[server_id] = fingerprint
+        for server_id in [server_id for server_id in self.__servers if server_id not in servers_by_id]:
+            delta.removed.append(self.__servers[server_id])
+            del self.__fingerprints[server_id]
+        self.__servers = servers_by_id
+        return delta
+
+class Discovery:
+    """
+    Lists the servers matching a label selector and keeps them in a ServerInventory.
+
+    The first page tells us how many pages there are; the rest are fetched in parallel.
+    """
+
+    def __init__(self, client: hcloud.Client, label_selector: str, page_size: int = 50, concurrency: int = 4):
+        self.__client = client
+        self.__label_selector = label_selector
+        self.__page_size = page_size
+        self.__executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='discovery')
+        self.inventory = ServerInventory()
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def poll(self) -> InventoryDelta:
+        return self.inventory.update(self.list_servers())
+
+    def list_servers(self) -> list[BoundServer]:
+        first = self.__get_page(1)
+        servers = list(first.servers)
+        pagination = first.meta.pagination if first.meta else None
+        last_page = (pagination.last_page or 1) if pagination else 1
+        if pagination and pagination.next_page and last_page <= 1:
+            # Without a last_page we can only walk the pages one after another
+            page = first
+            while page.meta.pagination.next_page:
+                page = self.__get_page(page.meta.pagination.next_page)
+                servers.extend(page.servers)
+            return servers
+        for page in self.__executor.map(tracing.bind(self.__get_page), range(2, last_page + 1)):
+            servers.extend(page.servers)
+        return servers
+
+    def __get_page(self, page: int):
+        with tracing.span('hetzner.list_page', page=page) as span:
+            result = self.__client.servers.get_list(label_selector=self.__label_selector, page=page, per_page=self.__page_size)
+            if span is not None:
+                span['servers'] = len(result.servers)
+            return result
+
+class AdaptiveInterval:
+    """
+    Poll interval that doubles (up to `maximum`) while nothing changes and snaps back to `base`
+    as soon as something does. A random jitter keeps a fleet of pollers from synchronising.
+    """
+
+    def __init__(self, base: float, maximum: float, factor: float = 2.0, jitter: float = 0.1):
+        self.__base = base
+        self.__maximum = max(base, maximum)
+        self.__factor = factor
+        self.__jitter = jitter
+        self.__current = base
+
+    @property
+    def current(self) -> float:
+        return self.__current
+
+    def next(self, changed: bool) -> float:
+        if changed:
+            self.__current = self.__base
+        else:
+            self.__current = min(self.__current * self.__factor, self.__maximum)
+        return self.__current * random.uniform(1 - self.__jitter, 1 + self.__jitter)
@@ -0,0 +1,253 @@
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from ipaddress import IPv6Address
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+@dataclass(frozen=True)
+class HandshakeRequest:
+    # Hetzner id of the server the agent runs on
+    server_id: int
+
+    # Address the agent's REST API is listening on
+    endpoint_host: IPv6Address
+
+    # Body posted to the agent's /handshake endpoint
+    payload: dict
+
+@dataclass(frozen=True)
+class HandshakeResult:
+    request: HandshakeRequest
+
+    # Wireguard public key and port reported by the agent
+    public_key: str = None
+    port: int = None
+
+    # Reason the handshake failed, None on success
+    error: str = None
+
+    # Wall-clock seconds spent on this agent
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+class _ResumingSocket(ssl.SSLSocket):
+    def do_handshake(self, block=False):
+        super().do_handshake(block)
+        self.context.remember(self)
+
+    def close(self):
+        # TLS 1.3 tickets arrive after the handshake, so look again before the connection goes
+        self.context.remember(self)
+        super().close()
+
+class _ResumingContext(ssl.SSLContext):
+    """
+    Client SSLContext that resumes TLS sessions per agent address.
+
+    Pooled connections already avoid new handshakes while they stay open; this covers the
+    connections that don't (an agent's pool was evicted, or it closed the connection), which
+    then resume with the session ticket from last time instead of redoing the full mutual-TLS
+    exchange with certificate verification.
+    """
+    sslsocket_class = _ResumingSocket
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.__lock = threading.Lock()
+        self.__sessions: dict[tuple, ssl.SSLSession] = {}
+
+    def wrap_socket(self, sock, *args, session=None, **kwargs):
+        if session is None:
+            try:
+                with self.__lock:
+                    session = self.__sessions.get(sock.getpeername()[:2])
+            except OSError:
+                pass
+        return super().wrap_socket(sock, *args, session=session, **kwargs)
+
+    def remember(self, sock: ssl.SSLSocket):
+        try:
+            session, peer = sock.session, sock.getpeername()[:2]
+        except (OSError, ValueError):
+            return
+        # A TLS 1.3 session is only resumable once its ticket has arrived
+        if session is not None and (session.has_ticket or sock.version() != 'TLSv1.3'):
+            with self.__lock:
+                self.__sessions[peer] = session
+
+class _ClientCertAdapter(HTTPAdapter):
+    """HTTPAdapter which hands one shared client-cert SSLContext to every pooled connection."""
+
+    def __init__(self, ssl_context: ssl.SSLContext, **kwargs):
+        self.__ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.__ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+def _cut_off(response: requests.Response):
+    """Shut down the connection a response is being read from, waking up the reading thread."""
+    try:
+        # A duplicate of the descriptor reaches the same connection without touching urllib3's socket
+        with socket.socket(fileno=os.dup(response.raw.fileno())) as sock:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, ValueError):
+        pass
+
+class HandshakeClient:
+    """
+    Posts handshakes to many agents at once.
+
+    The client certificate, key and CA bundle are loaded into a single SSLContext up front and
+    connections are kept in a pool, so agents that are handshaked again (e.g. on retry) reuse
+    their TLS connection instead of paying for a new mutual-TLS negotiation. At most
+    `concurrency` handshakes are in flight and each agent gets `timeout` seconds in total from
+    the moment its handshake starts (not per socket read), so a cycle takes roughly as long as
+    the slowest agent rather than the sum of all of them, and an agent trickling its answer
+    can't hold the cycle past its deadline.
+
+    A handshake given up on at its deadline hands its slot to the next one straight away.
+    Its worker winds down on one of `concurrency` spare threads: the body read is cut off at
+    the deadline, and a silent agent's read times out within `connect_timeout` of it. So a
+    burst of dead agents costs each slot one `timeout` and doesn't starve the pool. Header
+    reads are only bounded per read, so agents trickling their headers hold a spare thread
+    longer; with more than `concurrency` of those at once, new handshakes wait for a thread.
+    """
+
+    def __init__(self, *, cert_file: str = None, key_file: str = None, ca_file: str = None,
+                 concurrency: int = 32, timeout: float = 10, connect_timeout: float = 5,
+                 url: str = "https://[{host}]:5001/handshake"):
+        self.__timeout = timeout
+        self.__connect_timeout = min(connect_timeout, timeout)
+        self.__url = url
+
+        context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.load_verify_locations(cafile=ca_file) if ca_file else context.load_default_certs()
+        if cert_file:
+            context.load_cert_chain(cert_file, key_file)
+
+        # One pool per agent host; keep enough of them around to cover a full cycle
+        adapter = _ClientCertAdapter(context, pool_connections=max(concurrency, 256), pool_maxsize=concurrency)
+        self.__session = requests.Session()
+        self.__session.mount('https://', adapter)
+        self.__session.mount('http://', adapter)
+        # Handshakes in flight, plus as many workers again for given-up ones still winding down
+        self.__slots = threading.BoundedSemaphore(concurrency)
+        self.__executor = ThreadPoolExecutor(max_workers=2 * concurrency, thread_name_prefix='handshake')
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.__session.close()
+
+    def handshake_all(self, batch: list[HandshakeRequest]) -> list[HandshakeResult]:
+        """
+        Handshake with every agent concurrently, returning results in request order. A handshake
+        still running `timeout` seconds after it started is reported as timed out and its slot
+        released. Its worker carries on until the watchdog shuts the connection down (through a
+        duplicate of its descriptor) or the read times out.
+        """
+        handshake = tracing.bind(self.handshake)
+        started: dict[int, float] = {}
+        lock = threading.Lock()
+        released: set[int] = set()
+
+        def release(index: int):
+            # Whichever comes first, the worker finishing or the deadline, frees the slot
+            with lock:
+                if index in released:
+                    return
+                released.add(index)
+            self.__slots.release()
+
+        def run(index: int) -> HandshakeResult:
+            self.__slots.acquire()
+            started[index] = time.monotonic()
+            try:
+                return handshake(batch[index])
+            finally:
+                release(index)
+
+        futures = {self.__executor.submit(run, index): index for index in range(len(batch))}
+        results: list[HandshakeResult] = [None] * len(batch)
+        pending = set(futures)
+        while pending:
+            # Queued handshakes haven't started their clock; wake up for the first running one to expire
+            deadlines = [started[futures[future]] + self.__timeout for future in pending if futures[future] in started]
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else self.__timeout
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[futures[future]] = future.result()
+            now = time.monotonic()
+            for future in list(pending):
+                index = futures[future]
+                if index in started and started[index] + self.__timeout <= now:
+                    pending.discard(future)
+                    release(index)
+                    results[index] = HandshakeResult(batch[index], error=f"Handshake timed out after {self.__timeout:g}s",
+                                                     duration=now - started[index])
+        return results
+
+    def handshake(self, request: HandshakeRequest) -> HandshakeResult:
+        with tracing.span('handshake', server=request.server_id, host=str(request.endpoint_host)) as span:
+            result = self.__handshake(request)
+            if span is not None and result.error:
+                span['error'] = result.error
+            return result
+
+    def __handshake(self, request: HandshakeRequest) -> HandshakeResult:
+        start = time.monotonic()
+        deadline = start + self.__timeout
+        try:
+            # Connecting and the headers are bounded by the socket timeouts; the body is read
+            # with the connection shut down at the deadline, so an agent trickling it is cut off
+            response = self.__session.post(
+                self.__url.format(host=request.endpoint_host),
+                json=request.payload,
+                timeout=(self.__connect_timeout, self.__timeout),
+                stream=True,
+            )
+            with response:
+                if response.status_code != 200:
+                    return HandshakeResult(request, error=f"Handshake failed with status {response.status_code}",
+                                           duration=time.monotonic() - start)
+                cut_off = threading.Event()
+
+                def cut():
+                    cut_off.set()
+                    _cut_off(response)
+
+                watchdog = threading.Timer(max(deadline - time.monotonic(), 0), cut)
+                watchdog.start()
+                try:
+                    body = response.content
+                finally:
+                    # The watchdog may already be running; wait so the connection isn't reused half shut down
+                    watchdog.cancel()
+                    watchdog.join()
+                    if cut_off.is_set():
+                        response.raw.close()
+                if cut_off.is_set():
+                    return HandshakeResult(request, error=f"Handshake timed out after {self.__timeout:g}s",
+                                           duration=time.monotonic() - start)
+            data = json.loads(body)
+            return HandshakeResult(request, public_key=data['public_key'], port=data['port'],
+                                   duration=time.monotonic() - start)
+        except Exception as e:
+            if time.monotonic() >= deadline:
+                return HandshakeResult(request, error=f"Handshake timed out after {self.__timeout:g}s",
+                                       duration=time.monotonic() - start)
+            return HandshakeResult(request, error=f"Failed to connect to agent: {e}",
+                                   duration=time.monotonic() - start)
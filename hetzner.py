@@ -1,19 +1,39 @@
 import os
+import re
+import json
+import time
+import random
+import asyncio
 import hashlib
+import threading
+from ipaddress import IPv6Network, IPv4Address
+from contextlib import asynccontextmanager
 
-from typing import List, Dict, Any, Set
-from fastapi import FastAPI, Query, HTTPException
+from typing import List, Dict, Any, Set, Callable
+from fastapi import FastAPI, Query, HTTPException, Request, Response
 from pydantic import BaseModel
 import docker
 import uvicorn
 
-app = FastAPI()
-client = docker.from_env()
-label_store = {}
-
 # Get the discovery label prefix from environment variable, default to "hetznat64"
 DISCOVERY_LABEL_PREFIX = os.getenv("DISCOVERY_LABEL_PREFIX", "hetznat64")
 
+# Synthetic fleet mode: serve this many generated servers instead of docker containers
+MOCK_FLEET_SIZE = int(os.getenv("MOCK_FLEET_SIZE", "0"))
+# Network the synthetic servers' /64s are carved from
+MOCK_FLEET_NETWORK = os.getenv("MOCK_FLEET_NETWORK", "2a01:4f8:1c1c::/48")
+# Seconds between churn ticks, and the fraction of the fleet touched by each tick
+MOCK_CHURN_INTERVAL = float(os.getenv("MOCK_CHURN_INTERVAL", "0"))
+MOCK_CHURN_RATE = float(os.getenv("MOCK_CHURN_RATE", "0.01"))
+# Seed for the synthetic fleet and its churn
+MOCK_SEED = int(os.getenv("MOCK_SEED", "64"))
+
+# Fault injection (applies in both modes): mean added latency, share of requests failing
+# with a 503, and requests allowed per hour before answering 429 (0 disables the limit)
+MOCK_LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "0"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_RATE_LIMIT = int(os.getenv("MOCK_RATE_LIMIT", "0"))
+
 def container_name_to_int(name: str) -> int:
     return int(hashlib.sha256(name.encode()).hexdigest(), 16) % (2**31)
 
@@ -25,7 +45,7 @@ def get_container_networks(container) -> Set[str]:
     except Exception:
         return set()
 
-def get_current_container() -> docker.models.containers.Container:
+def get_current_container(client: docker.DockerClient) -> docker.models.containers.Container:
     """Get the current container object."""
     # Get the container ID from the hostname (Docker sets hostname to container ID)
     container_id = os.environ.get('HOSTNAME')
@@ -65,175 +85,458 @@ def get_container_ipv6(container) -> str:
     except Exception:
         return "::1"
 
-def get_mock_servers(label_selector: str = None) -> List[Dict[str, Any]]:
-    """Get a list of mock servers based on running Docker containers."""
-    servers = []
-
-    # Get the current container and its networks
-    current_container = get_current_container()
-    current_networks = get_container_networks(current_container)
-
-    # Get all containers
-    containers = client.containers.list()
-
-    for container in containers:
-        # Skip the current container
-        if container.id == current_container.id:
-            continue
-
-        # Get container's networks
-        container_networks = get_container_networks(container)
-
-        # Check if container shares any network with current container
-        if not current_networks.intersection(container_networks):
-            continue
-
-        # Check if container has the required label
-        labels = label_store.get(container.id, {})
-        if label_selector:
-            # Parse the label selector (simple implementation for now)
-            # Format expected: "key=value" or "key"
-            parts = label_selector.split("=")
-            key = parts[0]
-            if len(parts) > 1:
-                value = parts[1]
-                if key not in labels or labels[key] != value:
-                    continue
-            else:
-                if key not in labels:
-                    continue
-
-        # Get container's IPv6 address
-        ipv6 = get_container_ipv6(container)
-        ipv4 = get_container_ipv4(container)
-
-        # Create mock server object
-        server = {
-            "id": container_name_to_int(container.name),
-            "name": container.id,
-            "status": "running",
-            "public_net": {
-                "ipv4": {
-                    "id": 1,
-                    "ip": ipv4,
-                    "blocked": False,
-                    "dns_ptr": []
-                },
-                "ipv6": {
-                    "id": 2,
-                    "ip": f"{ipv6}/64",
-                    "blocked": False,
-                    "dns_ptr": []
-                },
-                "floating_ips": []
-            },
-            # Add other required fields with mock values
-            "server_type": {
+def mock_server(server_id: int, name: str, ipv4: str, ipv6: str, labels: Dict[str, str]) -> Dict[str, Any]:
+    """Build a mock server object in the shape returned by the Hetzner Cloud API."""
+    return {
+        "id": server_id,
+        "name": name,
+        "status": "running",
+        "public_net": {
+            "ipv4": {
                 "id": 1,
-                "name": "cx11",
-                "description": "CX11",
-                "cores": 1,
-                "memory": 2.0,
-                "disk": 20,
-                "prices": []
+                "ip": ipv4,
+                "blocked": False,
+                "dns_ptr": []
             },
-            "datacenter": {
-                "id": 1,
-                "name": "nbg1-dc3",
-                "description": "Nuremberg 1 DC 3",
-                "location": {
-                    "id": 1,
-                    "name": "nbg1",
-                    "description": "Nuremberg DC Park 1",
-                    "country": "DE",
-                    "city": "Nuremberg",
-                    "latitude": 49.452102,
-                    "longitude": 11.076665
-                }
+            "ipv6": {
+                "id": 2,
+                "ip": f"{ipv6}/64",
+                "blocked": False,
+                "dns_ptr": []
             },
-            "image": {
+            "floating_ips": []
+        },
+        # Add other required fields with mock values
+        "server_type": {
+            "id": 1,
+            "name": "cx11",
+            "description": "CX11",
+            "cores": 1,
+            "memory": 2.0,
+            "disk": 20,
+            "prices": []
+        },
+        "datacenter": {
+            "id": 1,
+            "name": "nbg1-dc3",
+            "description": "Nuremberg 1 DC 3",
+            "location": {
                 "id": 1,
-                "type": "system",
-                "status": "available",
-                "name": "ubuntu-20.04",
-                "description": "Ubuntu 20.04 LTS",
-                "image_size": 2.3,
-                "disk_size": 10,
-                "created": "2020-05-01T12:00:00+00:00",
-                "created_from": None,
-                "bound_to": None,
-                "os_flavor": "ubuntu",
-                "os_version": "20.04",
-                "rapid_deploy": False
-            },
-            "iso": None,
-            "rescue_enabled": False,
-            "locked": False,
+                "name": "nbg1",
+                "description": "Nuremberg DC Park 1",
+                "country": "DE",
+                "city": "Nuremberg",
+                "latitude": 49.452102,
+                "longitude": 11.076665
+            }
+        },
+        "image": {
+            "id": 1,
+            "type": "system",
+            "status": "available",
+            "name": "ubuntu-20.04",
+            "description": "Ubuntu 20.04 LTS",
+            "image_size": 2.3,
+            "disk_size": 10,
             "created": "2020-05-01T12:00:00+00:00",
-            "included_traffic": 2199023255552,
-            "outgoing_traffic": 123456,
-            "ingoing_traffic": 123456,
-            "backup_window": "22-02",
-            "protection": {
-                "delete": False,
-                "rebuild": False
-            },
-            "labels": labels,
-            "volumes": [],
-            "load_balancers": [],
-            "primary_disk_size": 20,
-            "placement_group": None
-        }
-        servers.append(server)
+            "created_from": None,
+            "bound_to": None,
+            "os_flavor": "ubuntu",
+            "os_version": "20.04",
+            "rapid_deploy": False
+        },
+        "iso": None,
+        "rescue_enabled": False,
+        "locked": False,
+        "created": "2020-05-01T12:00:00+00:00",
+        "included_traffic": 2199023255552,
+        "outgoing_traffic": 123456,
+        "ingoing_traffic": 123456,
+        "backup_window": "22-02",
+        "protection": {
+            "delete": False,
+            "rebuild": False
+        },
+        "labels": labels,
+        "volumes": [],
+        "load_balancers": [],
+        "primary_disk_size": 20,
+        "placement_group": None
+    }
 
-    return servers
+# Label selector terms: "k", "!k", "k=v", "k==v", "k!=v", "k in (a,b)", "k notin (a,b)"
+_SELECTOR_TERM = re.compile(
+    r"^\s*(?:(?P<absent>!)\s*(?P<absent_key>[^\s=!,()]+)"
+    r"|(?P<key>[^\s=!,()]+)\s*(?:(?P<op>==|=|!=)\s*(?P<value>[^\s,()]*)"
+    r"|\s+(?P<set_op>in|notin)\s*\((?P<values>[^()]*)\))?)\s*$"
+)
 
-class ServersResponse(BaseModel):
-    servers: List[Dict[str, Any]]
-    meta: Dict[str, Any]
+def parse_label_selector(label_selector: str) -> Callable[[Dict[str, str]], bool]:
+    """
+    Compile a Hetzner label selector into a predicate over a label dict.
 
-@app.get("/v1/servers", response_model=ServersResponse)
-async def get_servers(label_selector: str = Query(None)):
-    """Mock endpoint for GET /v1/servers."""
-    servers = get_mock_servers(label_selector)
-
-    response = {
-        "servers": servers,
-        "meta": {
-            "pagination": {
-                "page": 1,
-                "per_page": len(servers),
-                "previous_page": None,
-                "next_page": None,
-                "last_page": 1,
-                "total_entries": len(servers)
+    Terms are separated by commas (commas inside "in (...)" lists don't count) and must all match.
+    """
+    terms = []
+    depth, start = 0, 0
+    for index, char in enumerate(label_selector + ","):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            term = label_selector[start:index]
+            start = index + 1
+            if not term.strip():
+                continue
+            match = _SELECTOR_TERM.match(term)
+            if not match:
+                raise HTTPException(status_code=400, detail=f"Invalid label selector: {label_selector}")
+            terms.append(_selector_term(match))
+    return lambda labels: all(term(labels) for term in terms)
+
+def _selector_term(match: re.Match) -> Callable[[Dict[str, str]], bool]:
+    if match["absent"]:
+        key = match["absent_key"]
+        return lambda labels: key not in labels
+    key = match["key"]
+    if match["op"] in ("=", "=="):
+        value = match["value"]
+        return lambda labels: labels.get(key) == value
+    if match["op"] == "!=":
+        value = match["value"]
+        return lambda labels: labels.get(key) != value
+    if match["set_op"]:
+        values = {value.strip() for value in match["values"].split(",")}
+        if match["set_op"] == "in":
+            return lambda labels: labels.get(key) in values
+        return lambda labels: labels.get(key) not in values
+    return lambda labels: key in labels
+
+class MockServer:
+    """A mock server with its JSON rendered once, and again only when its labels change."""
+
+    def __init__(self, server: Dict[str, Any]):
+        self.id = server["id"]
+        self.name = server["name"]
+        self.server = server
+        self.rendered = json.dumps(server, separators=(",", ":"))
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        return self.server["labels"]
+
+    def set_labels(self, labels: Dict[str, str]):
+        self.server["labels"] = dict(labels)
+        self.rendered = json.dumps(self.server, separators=(",", ":"))
+
+class ServerInventory:
+    """Mock servers indexed by id and by name (plus the 12 character short form docker uses as hostname)."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.__servers: Dict[int, MockServer] = {}
+        self.__by_name: Dict[str, int] = {}
+
+    def list(self) -> List[MockServer]:
+        with self.lock:
+            return list(self.__servers.values())
+
+    def get(self, server_id: int | str) -> MockServer | None:
+        key = str(server_id)
+        with self.lock:
+            if key.isdigit() and int(key) in self.__servers:
+                return self.__servers[int(key)]
+            if key in self.__by_name:
+                return self.__servers.get(self.__by_name[key])
+            # Fall back to a scan for prefixes of unusual length
+            return next((server for server in self.__servers.values() if server.name.startswith(key)), None)
+
+    def put(self, server: MockServer):
+        with self.lock:
+            self.remove(server.id)
+            self.__servers[server.id] = server
+            self.__by_name[server.name] = server.id
+            self.__by_name[server.name[:12]] = server.id
+
+    def remove(self, server_id: int) -> MockServer | None:
+        with self.lock:
+            server = self.__servers.pop(server_id, None)
+            if server:
+                for name in (server.name, server.name[:12]):
+                    if self.__by_name.get(name) == server_id:
+                        del self.__by_name[name]
+            return server
+
+    def set_labels(self, server: MockServer, labels: Dict[str, str]):
+        with self.lock:
+            server.set_labels(labels)
+
+    def clear(self):
+        with self.lock:
+            self.__servers.clear()
+            self.__by_name.clear()
+
+class DockerInventory(ServerInventory):
+    """
+    Mock servers for the docker containers that share a network with this one.
+
+    The inventory is loaded once and then kept current from the docker events stream, so
+    requests never have to list containers. Labels set through the API survive container
+    restarts; a container starts out with its own docker labels under DISCOVERY_LABEL_PREFIX.
+    """
+
+    def __init__(self, client: docker.DockerClient):
+        super().__init__()
+        self.__client = client
+        self.__label_store: Dict[str, Dict[str, str]] = {}
+        self.__networks: Set[str] = set()
+        self.__current_id = None
+
+    def start(self):
+        self.reload()
+        threading.Thread(target=self.__watch, daemon=True).start()
+
+    def reload(self):
+        current_container = get_current_container(self.__client)
+        with self.lock:
+            self.__current_id = current_container.id
+            self.__networks = get_container_networks(current_container)
+            self.clear()
+            for container in self.__client.containers.list():
+                self.__update(container)
+
+    def set_labels(self, server: MockServer, labels: Dict[str, str]):
+        with self.lock:
+            self.__label_store[server.name] = dict(labels)
+            server.set_labels(labels)
+
+    def __update(self, container):
+        server_id = container_name_to_int(container.name)
+        # Skip the current container and containers that don't share a network with it
+        if container.id == self.__current_id or not self.__networks.intersection(get_container_networks(container)):
+            self.remove(server_id)
+            return
+
+        labels = self.__label_store.get(container.id)
+        if labels is None:
+            labels = {
+                key: value for key, value in (container.labels or {}).items()
+                if key.startswith(f"{DISCOVERY_LABEL_PREFIX}.")
             }
+            self.__label_store[container.id] = labels
+        self.put(MockServer(mock_server(
+            server_id=server_id,
+            name=container.id,
+            ipv4=get_container_ipv4(container),
+            ipv6=get_container_ipv6(container),
+            labels=dict(labels),
+        )))
+
+    def __watch(self):
+        while True:
+            try:
+                events = self.__client.events(decode=True, filters={"type": ["container", "network"]})
+                # Catch up on anything that happened while the stream was down
+                self.reload()
+                for event in events:
+                    self.__handle(event)
+            except Exception as e:
+                print(f"Docker event stream failed, reconnecting: {e}")
+                threading.Event().wait(1)
+
+    def __handle(self, event: Dict[str, Any]):
+        action = event.get("Action", "")
+        if event.get("Type") == "network":
+            container_id = event.get("Actor", {}).get("Attributes", {}).get("container")
+        else:
+            container_id = event.get("Actor", {}).get("ID") or event.get("id")
+        if not container_id or action not in ("start", "die", "destroy", "connect", "disconnect"):
+            return
+
+        if container_id == self.__current_id:
+            # Our own networks changed, so the set of visible containers may have too
+            self.reload()
+            return
+        try:
+            container = self.__client.containers.get(container_id)
+        except docker.errors.NotFound:
+            container = None
+        with self.lock:
+            if container is None or container.status != "running":
+                server = self.get(container_id)
+                if server:
+                    self.remove(server.id)
+            else:
+                self.__update(container)
+
+class SyntheticInventory(ServerInventory):
+    """
+    A generated fleet of servers for load testing without starting containers.
+
+    Server n gets the n-th /64 of MOCK_FLEET_NETWORK, so addresses are stable across runs. Every
+    churn tick a share of the fleet is touched: servers vanish, new ones appear, and others flip
+    between waiting and connected. Servers that aren't in the fleet (e.g. an agent looking itself
+    up by hostname) are added on first lookup, so real agents can run against the mock too.
+    """
+
+    def __init__(self, size: int, network: str, churn_interval: float = 0, churn_rate: float = 0.01, seed: int = 64):
+        super().__init__()
+        self.__network = IPv6Network(network)
+        self.__churn_interval = churn_interval
+        self.__churn_rate = churn_rate
+        self.__random = random.Random(seed)
+        self.__status_label = f"{DISCOVERY_LABEL_PREFIX}.status"
+        self.__next_id = 1
+        for _ in range(size):
+            self.__create()
+
+    def start(self):
+        if self.__churn_interval > 0:
+            threading.Thread(target=self.__churn, daemon=True).start()
+
+    def get(self, server_id: int | str) -> MockServer | None:
+        with self.lock:
+            server = super().get(server_id)
+            if server is None and not str(server_id).isdigit():
+                server = self.__create(name=str(server_id))
+            return server
+
+    def __create(self, name: str = None) -> MockServer:
+        server_id = self.__next_id
+        self.__next_id += 1
+        subnet = int(self.__network.network_address) + ((server_id % 2 ** (64 - self.__network.prefixlen)) << 64)
+        server = MockServer(mock_server(
+            server_id=server_id,
+            name=name or f"synthetic-{server_id:06d}",
+            ipv4=str(IPv4Address(0x0A000000 + server_id % 2 ** 24)),
+            ipv6=IPv6Network((subnet, 64)).network_address.compressed,
+            labels={self.__status_label: "waiting"},
+        ))
+        self.put(server)
+        return server
+
+    def __churn(self):
+        while True:
+            time.sleep(self.__churn_interval)
+            with self.lock:
+                servers = self.list()
+                count = max(1, int(len(servers) * self.__churn_rate))
+                for server in self.__random.sample(servers, min(count, len(servers))):
+                    action = self.__random.random()
+                    if action < 0.25:
+                        self.remove(server.id)
+                    elif action < 0.5:
+                        self.__create()
+                    else:
+                        status = "connected" if server.labels.get(self.__status_label) == "waiting" else "waiting"
+                        self.set_labels(server, {**server.labels, self.__status_label: status})
+
+class MockRateLimit:
+    """Hetzner-style request budget: `limit` requests per hour, refilled continuously."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.__tokens = float(limit)
+        self.__updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.__tokens = min(self.limit, self.__tokens + (now - self.__updated) * self.limit / 3600)
+        self.__updated = now
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+    def headers(self) -> Dict[str, str]:
+        remaining = int(self.__tokens)
+        reset = time.time() + (self.limit - self.__tokens) * 3600 / self.limit
+        return {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(remaining),
+            "RateLimit-Reset": str(int(reset)),
         }
-    }
 
+inventory: ServerInventory = None
+rate_limit = MockRateLimit(MOCK_RATE_LIMIT) if MOCK_RATE_LIMIT > 0 else None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global inventory
+    if MOCK_FLEET_SIZE > 0:
+        inventory = SyntheticInventory(MOCK_FLEET_SIZE, MOCK_FLEET_NETWORK, MOCK_CHURN_INTERVAL, MOCK_CHURN_RATE, MOCK_SEED)
+    else:
+        inventory = DockerInventory(docker.from_env())
+    inventory.start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+def error_response(status_code: int, code: str, message: str, headers: Dict[str, str] = None) -> Response:
+    content = json.dumps({"error": {"code": code, "message": message}})
+    return Response(content=content, status_code=status_code, media_type="application/json", headers=headers)
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    """Apply the configured latency, error rate and rate limit to every request."""
+    if MOCK_LATENCY_MS > 0:
+        await asyncio.sleep(random.expovariate(1000 / MOCK_LATENCY_MS))
+    headers = {}
+    if rate_limit:
+        allowed = rate_limit.take()
+        headers = rate_limit.headers()
+        if not allowed:
+            return error_response(429, "rate_limit_exceeded", "Rate limit exceeded", headers)
+    if MOCK_ERROR_RATE > 0 and random.random() < MOCK_ERROR_RATE:
+        return error_response(503, "unavailable", "Injected failure", headers)
+    response = await call_next(request)
+    response.headers.update(headers)
     return response
 
+def json_response(content: str) -> Response:
+    return Response(content=content, media_type="application/json")
+
+@app.get("/v1/servers")
+async def get_servers(label_selector: str = Query(None), page: int = Query(1, ge=1), per_page: int = Query(25, ge=1, le=50)):
+    """Mock endpoint for GET /v1/servers."""
+    servers = sorted(inventory.list(), key=lambda server: server.id)
+    if label_selector:
+        matches = parse_label_selector(label_selector)
+        servers = [server for server in servers if matches(server.labels)]
+
+    total = len(servers)
+    last_page = max((total + per_page - 1) // per_page, 1)
+    items = servers[(page - 1) * per_page:page * per_page]
+    meta = {
+        "pagination": {
+            "page": page,
+            "per_page": per_page,
+            "previous_page": page - 1 if page > 1 else None,
+            "next_page": page + 1 if page < last_page else None,
+            "last_page": last_page,
+            "total_entries": total
+        }
+    }
+    return json_response(f'{{"servers":[{",".join(server.rendered for server in items)}],"meta":{json.dumps(meta)}}}')
+
 @app.get('/v1/servers/{server_id}')
 async def get_server(server_id: int | str):
-    servers = get_mock_servers()
-    for server in servers:
-        if str(server['id']) == str(server_id) or server['name'].startswith(str(server_id)):
-            return { "server": server }
-    raise HTTPException(status_code=404, detail="Server not found")
+    server = inventory.get(server_id)
+    if not server:
+        raise HTTPException(status_code=404, detail="Server not found")
+    return json_response(f'{{"server":{server.rendered}}}')
 
 class ServerUpdate(BaseModel):
     labels: Dict[str, str]
 
 @app.put('/v1/servers/{server_id}')
 async def update_server(server_id: int | str, update: ServerUpdate):
-    servers = get_mock_servers()
-    for server in servers:
-        if str(server['id']) == str(server_id) or server['name'].startswith(str(server_id)):
-            container = client.containers.get(server['name'])
-            label_store[container.id] = update.labels
-            server['labels'] = update.labels
-            return { "server": server }
-    raise HTTPException(status_code=404, detail="Server not found")
+    server = inventory.get(server_id)
+    if not server:
+        raise HTTPException(status_code=404, detail="Server not found")
+    inventory.set_labels(server, update.labels)
+    return json_response(f'{{"server":{server.rendered}}}')
 
 if __name__ == '__main__':
     uvicorn.run(app, host=["::", "0.0.0.0"], port=5000, timeout_keep_alive=10)
@@ -0,0 +1,80 @@
+import socket
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Mapping
+from urllib.parse import parse_qs, urlparse
+
+@dataclass(frozen=True)
+class HTTPRequest:
+    path: str
+    query: Mapping[str, list[str]]
+    headers: Mapping[str, str]
+
+@dataclass(frozen=True)
+class HTTPResponse:
+    status: int = 200
+    body: bytes = b''
+    content_type: str = 'application/json'
+    headers: Mapping[str, str] = field(default_factory=dict)
+
+Handler = Callable[[HTTPRequest], HTTPResponse]
+
+class _DualStackServer(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+    daemon_threads = True
+
+    def server_bind(self):
+        # Accept IPv4 clients too when bound to ::
+        self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        super().server_bind()
+
+class ControlAPI:
+    """
+    Small threaded HTTP server for the service's read-only endpoints (/metrics and friends).
+
+    Requests are handled on their own threads and handlers only read state the reconcile loop
+    has already published, so serving them never slows the loop down.
+    """
+
+    def __init__(self, host: str = '::', port: int = 9464):
+        self.__routes: dict[str, Handler] = {}
+        self.__address = (host, port)
+        self.__server = None
+
+    def route(self, path: str, handler: Handler):
+        self.__routes[path] = handler
+
+    def start(self):
+        routes = self.__routes
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                handler = routes.get(url.path)
+                if handler is None:
+                    response = HTTPResponse(status=404, body=b'{"detail":"Not Found"}')
+                else:
+                    try:
+                        response = handler(HTTPRequest(path=url.path, query=parse_qs(url.query), headers=self.headers))
+                    except Exception as e:
+                        print(f"Request to {url.path} failed: {e}")
+                        response = HTTPResponse(status=500, body=b'{"detail":"Internal Server Error"}')
+                self.send_response(response.status)
+                self.send_header('Content-Type', response.content_type)
+                self.send_header('Content-Length', str(len(response.body)))
+                for name, value in response.headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(response.body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = _DualStackServer(self.__address, RequestHandler)
+        threading.Thread(target=self.__server.serve_forever, name='control-api', daemon=True).start()
+
+    def stop(self):
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from typing import Callable
+
+import hcloud
+from hcloud.servers import Server
+
+INSTANCE_ID_FILE = "/var/lib/cloud/data/instance-id"
+
+def local_server_id() -> str | None:
+    """This server's Hetzner id from cloud-init, falling back to $HOSTNAME (as the mock API uses)."""
+    try:
+        if os.path.exists(INSTANCE_ID_FILE):
+            with open(INSTANCE_ID_FILE, "r") as f:
+                return f.read().strip()
+    except Exception:
+        pass
+    return os.environ.get('HOSTNAME', None)
+
+def update_labels(client: hcloud.Client, server_id, labels: dict[str, str]) -> dict[str, str]:
+    """
+    Set `labels` on the server, keeping every other label as it is now. The API only replaces
+    the whole set, so the current labels are read right before the write; another writer's keys
+    (e.g. the service's gateway label on an agent's server) survive unless they change in
+    between. Skips the write if they already match; returns the server's labels either way.
+    """
+    current = dict(client.servers.get_by_id(server_id).labels or {})
+    merged = {**current, **labels}
+    if merged != current:
+        client.servers.update(Server(id=server_id), labels=merged)
+    return merged
+
+class LabelWriter:
+    """
+    Writes this server's labels from a background thread.
+
+    `set` only records the labels wanted and returns immediately. The writer waits `debounce`
+    seconds for more changes, so a burst of updates becomes one API call. Only the keys set
+    here are written: the server's labels are re-read before every write (see update_labels),
+    so labels other writers own are kept. The server id is resolved once; failed writes are
+    retried with exponential backoff.
+    """
+
+    def __init__(self, client: hcloud.Client, server_id: Callable[[], str | None] = local_server_id,
+                 debounce: float = 2.0, max_backoff: float = 60):
+        self.__client = client
+        self.__resolve_server_id = server_id
+        self.__debounce = debounce
+        self.__max_backoff = max_backoff
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__server_id = None
+        # Labels as last read from or written to the API (None until the first write)
+        self.__known: dict[str, str] = None
+        # Labels that still have to be written
+        self.__pending: dict[str, str] = {}
+        self.__writing = False
+        self.__thread = threading.Thread(target=self.__run, name='label-writer', daemon=True)
+        self.__thread.start()
+
+    @property
+    def labels(self) -> dict[str, str] | None:
+        with self.__lock:
+            return dict(self.__known) if self.__known is not None else None
+
+    def set(self, labels: dict[str, str]):
+        with self.__lock:
+            self.__pending.update(labels)
+            self.__changed.notify()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until every label set so far has been written, returning False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__lock:
+            while self.__pending or self.__writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__changed.wait(remaining)
+        return True
+
+    def __run(self):
+        backoff = 1.0
+        while True:
+            with self.__lock:
+                while not self.__pending:
+                    self.__changed.wait()
+            # Let rapid changes pile up so they go out in one write
+            time.sleep(self.__debounce)
+            with self.__lock:
+                labels = self.__pending
+                self.__pending = {}
+                self.__writing = True
+            try:
+                self.__write(labels)
+                backoff = 1.0
+            except Exception as e:
+                print(f"Failed to update labels {labels}: {e}, retrying in {backoff:.0f}s")
+                with self.__lock:
+                    # Newer values set in the meantime win over the ones that failed
+                    self.__pending = {**labels, **self.__pending}
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.__max_backoff)
+            finally:
+                with self.__lock:
+                    self.__writing = False
+                    self.__changed.notify_all()
+
+    def __write(self, labels: dict[str, str]):
+        if self.__server_id is None:
+            self.__server_id = self.__resolve_server_id()
+        with self.__lock:
+            known = self.__known
+        if known is not None and all(known.get(key) == value for key, value in labels.items()):
+            # Nothing new since our last write; skip the read as well
+            return
+        written = update_labels(self.__client, self.__server_id, labels)
+        with self.__lock:
+            self.__known = written
@@ -0,0 +1,93 @@
+import time
+from dataclasses import dataclass
+from typing import Callable, Container, Mapping
+
+from wireguard_tools import WireguardKey, WireguardPeer
+
+EVICTION_REASONS = ('orphaned', 'unconfirmed', 'stale')
+
+@dataclass(frozen=True)
+class Eviction:
+    key: WireguardKey
+    owner: int | None
+
+    # 'orphaned' (server left the inventory), 'unconfirmed' (never handshaked) or 'stale'
+    # (no handshake for too long)
+    reason: str
+
+    # Seconds past the grace period, so the most overdue peers go first
+    overdue: float
+
+@dataclass
+class _Tracked:
+    # When the peer was first seen (monotonic)
+    since: float
+
+    # When its server was first found missing from the inventory (monotonic), if it is
+    missing_since: float = None
+
+class PeerLifecycle:
+    """
+    Decides when peers are gone for good, so the device only holds peers of the live fleet.
+
+    Each peer is tracked by its server, its handshake age and whether the server is still in the
+    inventory. A peer is evicted when its server has been missing for `orphan_grace`, when it
+    never handshaked within `unconfirmed_grace` of being added, or when its last handshake is
+    older than `stale_grace`. At most `batch_size` peers are evicted per cycle, most overdue
+    first, so a mass deletion is cleaned up over a few cycles instead of in one large write.
+    """
+
+    def __init__(self, orphan_grace: float = 600, unconfirmed_grace: float = 900, stale_grace: float = 3600,
+                 batch_size: int = 100):
+        self.__orphan_grace = orphan_grace
+        self.__unconfirmed_grace = unconfirmed_grace
+        self.__stale_grace = stale_grace
+        self.__batch_size = batch_size
+        self.__tracked: dict[WireguardKey, _Tracked] = {}
+
+    def __len__(self):
+        return len(self.__tracked)
+
+    def collect(self, peers: Mapping[WireguardKey, WireguardPeer], owner: Callable[[WireguardKey], int | None],
+                inventory: Container[int], stats: Mapping[WireguardKey, WireguardPeer] = None,
+                now: float = None, wall_time: float = None) -> list[Eviction]:
+        """
+        Peers to evict this cycle, out of the desired `peers`.
+
+        `stats` are the same peers as last read from the device, for their handshake times.
+        Peers without a known server (e.g. found on the device at startup) can't be orphaned
+        and are only judged by their handshakes.
+        """
+        now = time.monotonic() if now is None else now
+        wall_time = time.time() if wall_time is None else wall_time
+        stats = stats if stats is not None else peers
+        candidates: list[Eviction] = []
+
+        for key in [key for key in self.__tracked if key not in peers]:
+            del self.__tracked[key]
+
+        for key in peers:
+            tracked = self.__tracked.get(key)
+            if tracked is None:
+                tracked = self.__tracked[key] = _Tracked(since=now)
+            server = owner(key)
+
+            if server is not None and server not in inventory:
+                if tracked.missing_since is None:
+                    tracked.missing_since = now
+                elif now - tracked.missing_since >= self.__orphan_grace:
+                    candidates.append(Eviction(key, server, 'orphaned', now - tracked.missing_since - self.__orphan_grace))
+                    continue
+            else:
+                tracked.missing_since = None
+
+            peer = stats.get(key)
+            last_handshake = peer.last_handshake if peer is not None else None
+            if not last_handshake:
+                if now - tracked.since >= self.__unconfirmed_grace:
+                    candidates.append(Eviction(key, server, 'unconfirmed', now - tracked.since - self.__unconfirmed_grace))
+            elif wall_time - last_handshake >= self.__stale_grace:
+                candidates.append(Eviction(key, server, 'stale', wall_time - last_handshake - self.__stale_grace))
+
+        candidates.sort(key=lambda eviction: eviction.overdue, reverse=True)
+        return candidates[:self.__batch_size]
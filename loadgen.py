@@ -0,0 +1,368 @@
+"""
+NAT64 data-plane load generator.
+
+Drives TCP and UDP flows through the NAT64 prefix to a sink standing in for the IPv4 internet,
+and reports connection setup time, RTT percentiles (idle and under load), TCP throughput and
+UDP packet rate and loss, along with the data-plane setup (wireguard backend, tunnel MTU, NAT64
+instances) they were measured on.
+
+    python loadgen.py --sink                                  # on the IPv4 side (compose.loadgen.yaml)
+    python loadgen.py --target 10.64.0.99                     # on an agent, through the tunnel
+    python loadgen.py --target 10.64.0.99 --json --label run=single-queue >> results.jsonl
+
+The target can be an IPv4 address (mapped into --prefix) or any IPv6 address.
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv6Address, IPv6Network, ip_address
+
+# First byte of a TCP connection: what the sink does with it
+MODE_DISCARD = b"D"
+MODE_ECHO = b"E"
+
+# UDP probe header: flow, sequence number, send time (perf_counter)
+UDP_HEADER = struct.Struct("!IQd")
+PING_SIZE = 32
+CHUNK = 64 * 1024
+
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+def summarize(values: list[float], scale: float = 1000) -> dict:
+    """Percentiles of `values` (seconds) in milliseconds."""
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * scale if values else None,
+        "p90_ms": percentile(values, 90) * scale if values else None,
+        "p99_ms": percentile(values, 99) * scale if values else None,
+        "max_ms": max(values) * scale if values else None,
+    }
+
+def nat64_address(target: str, prefix: IPv6Network) -> IPv6Address:
+    address = ip_address(target)
+    if isinstance(address, IPv4Address):
+        if prefix.prefixlen != 96:
+            raise ValueError(f"Only /96 NAT64 prefixes are supported, not {prefix}")
+        return IPv6Address(int(prefix.network_address) | int(address))
+    return address
+
+# Sink
+
+def serve_sink(port: int, workers: int):
+    """TCP discard/echo and UDP echo on `port`, for IPv4 and IPv6 clients alike."""
+    def dual_stack(kind: int) -> socket.socket:
+        sock = socket.socket(socket.AF_INET6, kind)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("::", port))
+        return sock
+
+    def handle_tcp(conn: socket.socket):
+        with conn:
+            mode = conn.recv(1)
+            if mode == MODE_DISCARD:
+                received = 0
+                while data := conn.recv(CHUNK):
+                    received += len(data)
+                # Bytes the sink actually got, so the client doesn't count what sat in its buffers
+                conn.sendall(struct.pack("!Q", received))
+            elif mode == MODE_ECHO:
+                while data := conn.recv(CHUNK):
+                    conn.sendall(data)
+
+    def accept(listener: socket.socket):
+        while True:
+            conn, _ = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=handle_tcp, args=(conn,), daemon=True).start()
+
+    def echo(sock: socket.socket):
+        while True:
+            data, address = sock.recvfrom(65535)
+            sock.sendto(data, address)
+
+    listener = dual_stack(socket.SOCK_STREAM)
+    listener.listen(1024)
+    udp = dual_stack(socket.SOCK_DGRAM)
+    threads = [threading.Thread(target=accept, args=(listener,), daemon=True)]
+    threads += [threading.Thread(target=echo, args=(udp,), daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    print(f"Sink listening on TCP and UDP port {port}")
+    threads[0].join()
+
+# Client
+
+def connect(target: IPv6Address, port: int, timeout: float) -> tuple[socket.socket, float]:
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    start = time.perf_counter()
+    try:
+        sock.connect((str(target), port))
+    except OSError:
+        sock.close()
+        raise
+    return sock, time.perf_counter() - start
+
+def measure_connects(target: IPv6Address, port: int, count: int, concurrency: int, timeout: float) -> dict:
+    """Time `count` TCP handshakes through the NAT64, `concurrency` at a time."""
+    def one(_):
+        try:
+            sock, seconds = connect(target, port, timeout)
+        except OSError:
+            return None
+        sock.close()
+        return seconds
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(count)))
+    times = [seconds for seconds in results if seconds is not None]
+    return {**summarize(times), "failures": len(results) - len(times)}
+
+def ping_tcp(target: IPv6Address, port: int, timeout: float, count: int = None, stop: threading.Event = None,
+             interval: float = 0.01) -> list[float]:
+    """Round trips of small messages on one echo connection, `count` of them or until `stop` is set."""
+    rtts = []
+    sock, _ = connect(target, port, timeout)
+    with sock:
+        sock.sendall(MODE_ECHO)
+        message = b"\0" * PING_SIZE
+        while (count is None or len(rtts) < count) and not (stop and stop.is_set()):
+            start = time.perf_counter()
+            sock.sendall(message)
+            received = 0
+            while received < PING_SIZE:
+                data = sock.recv(PING_SIZE - received)
+                if not data:
+                    return rtts
+                received += len(data)
+            rtts.append(time.perf_counter() - start)
+            if stop is not None:
+                stop.wait(interval)
+    return rtts
+
+def tcp_flow(target: IPv6Address, port: int, duration: float, timeout: float) -> tuple[int, float]:
+    """Stream to the discard sink for `duration`, returning the bytes it received and the seconds taken."""
+    sock, _ = connect(target, port, timeout)
+    with sock:
+        sock.sendall(MODE_DISCARD)
+        chunk = b"\0" * CHUNK
+        start = time.perf_counter()
+        deadline = start + duration
+        while time.perf_counter() < deadline:
+            sock.sendall(chunk)
+        sock.shutdown(socket.SHUT_WR)
+        received = b""
+        while len(received) < 8:
+            data = sock.recv(8 - len(received))
+            if not data:
+                break
+            received += data
+        return (struct.unpack("!Q", received)[0] if len(received) == 8 else 0), time.perf_counter() - start
+
+def udp_flow(target: IPv6Address, port: int, flow: int, duration: float, rate: float, size: int) -> dict:
+    """Send paced echo probes for `duration`, returning what was sent, what came back and the RTTs."""
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sock.connect((str(target), port))
+    sock.settimeout(0.2)
+    padding = b"\0" * max(size - UDP_HEADER.size, 0)
+    sent = 0
+    rtts = []
+    done = threading.Event()
+
+    def receive():
+        while True:
+            try:
+                data = sock.recv(65535)
+            except socket.timeout:
+                if done.is_set():
+                    return
+                continue
+            except OSError:
+                # e.g. ICMP unreachable reported on the connected socket
+                continue
+            if len(data) >= UDP_HEADER.size:
+                probe_flow, _, sent_at = UDP_HEADER.unpack_from(data)
+                if probe_flow == flow:
+                    rtts.append(time.perf_counter() - sent_at)
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    start = time.perf_counter()
+    while (now := time.perf_counter()) - start < duration:
+        # Catch up to the rate in bursts rather than sleeping per packet
+        due = int((now - start) * rate) + 1 if rate else sent + 64
+        while sent < due:
+            try:
+                sock.send(UDP_HEADER.pack(flow, sent, time.perf_counter()) + padding)
+            except OSError:
+                pass
+            sent += 1
+        if rate:
+            time.sleep(min(1 / rate * 16, 0.01))
+    # Give the last replies time to come back
+    time.sleep(1)
+    done.set()
+    receiver.join()
+    sock.close()
+    return {"sent": sent, "received": len(rtts), "rtts": rtts}
+
+def _flow(function, *args, **kwargs):
+    """`function`'s result, or None if its connection failed, so one flow can't abort the run."""
+    try:
+        return function(*args, **kwargs)
+    except OSError as e:
+        print(f"{function.__name__} failed: {e}")
+        return None
+
+def run(args) -> dict:
+    target = nat64_address(args.target, IPv6Network(args.prefix))
+    results = {"target": str(target)}
+
+    results["connect"] = measure_connects(target, args.port, args.connections, args.concurrency, args.timeout)
+    idle_rtts = _flow(ping_tcp, target, args.port, args.timeout, count=args.pings)
+    results["rtt_idle"] = {**summarize(idle_rtts or []), "failures": int(idle_rtts is None)}
+
+    # Load phase: TCP and UDP flows side by side, with the pinger measuring latency under load
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=args.tcp_flows + args.udp_flows + 1) as executor:
+        pinger = executor.submit(_flow, ping_tcp, target, args.port, args.timeout, stop=stop)
+        tcp = [executor.submit(_flow, tcp_flow, target, args.port, args.duration, args.timeout)
+               for _ in range(args.tcp_flows)]
+        udp = [executor.submit(_flow, udp_flow, target, args.port, flow, args.duration, args.udp_rate, args.udp_size)
+               for flow in range(args.udp_flows)]
+        tcp_results = [future.result() for future in tcp]
+        udp_results = [future.result() for future in udp]
+        stop.set()
+        loaded_rtts = pinger.result()
+
+    tcp_flows = [flow for flow in tcp_results if flow is not None]
+    received = sum(received for received, _ in tcp_flows)
+    seconds = max((seconds for _, seconds in tcp_flows), default=0)
+    results["tcp"] = {
+        "flows": args.tcp_flows,
+        "bytes": received,
+        "mbps": received * 8 / seconds / 1e6 if seconds else None,
+        "failures": len(tcp_results) - len(tcp_flows),
+    }
+    udp_failures = udp_results.count(None)
+    udp_results = [flow for flow in udp_results if flow is not None]
+    udp_sent = sum(flow["sent"] for flow in udp_results)
+    udp_received = sum(flow["received"] for flow in udp_results)
+    results["udp"] = {
+        "flows": args.udp_flows,
+        "size": args.udp_size,
+        "sent_pps": udp_sent / args.duration,
+        "received_pps": udp_received / args.duration,
+        "loss": 1 - udp_received / udp_sent if udp_sent else None,
+        "rtt": summarize([rtt for flow in udp_results for rtt in flow["rtts"]]),
+        "failures": udp_failures,
+    }
+    results["rtt_loaded"] = {**summarize(loaded_rtts or []), "failures": int(loaded_rtts is None)}
+    return results
+
+def describe_setup(args) -> dict:
+    """What the numbers were measured on, so runs with different backends or MTUs can be compared."""
+    interface = os.environ.get("WG_INTERFACE", "hetznat64")
+    setup = {
+        "time": time.time(),
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "interface": interface,
+        "labels": dict(label.split("=", 1) for label in args.label),
+    }
+    try:
+        from backend import from_environment
+        setup["backend"] = from_environment().describe()
+    except Exception as e:
+        setup["backend"] = f"unknown ({e})"
+    try:
+        with open(f"/sys/class/net/{interface}/mtu") as f:
+            setup["tunnel_mtu"] = int(f.read())
+    except OSError:
+        setup["tunnel_mtu"] = None
+    setup["nat64_instances"] = os.environ.get("NAT64_INSTANCES")
+    if args.service_url:
+        # The service knows the NAT64 instances and their pools, and its own path MTU to them
+        try:
+            with urllib.request.urlopen(args.service_url, timeout=5) as response:
+                health = json.loads(response.read())
+            setup["nat64"] = health.get("nat64")
+            setup["service_path_mtu"] = health.get("path_mtu")
+        except Exception as e:
+            setup["nat64"] = f"unknown ({e})"
+    return setup
+
+def print_report(report: dict):
+    setup, results = report["setup"], report["results"]
+    print(f"Target {results['target']} via {setup['interface']} ({setup['backend']}, MTU {setup['tunnel_mtu']})")
+    for name, value in setup["labels"].items():
+        print(f"  {name}: {value}")
+    rows = [
+        ("connect", results["connect"]),
+        ("rtt idle", results["rtt_idle"]),
+        ("rtt loaded", results["rtt_loaded"]),
+        ("udp rtt", results["udp"]["rtt"]),
+    ]
+    print(f"{'':>12} {'count':>8} {'p50_ms':>8} {'p90_ms':>8} {'p99_ms':>8} {'max_ms':>8}")
+    for name, row in rows:
+        print(f"{name:>12} {row['count']:>8} " + " ".join(
+            f"{row[column]:>8.2f}" if row[column] is not None else f"{'-':>8}" for column in ("p50_ms", "p90_ms", "p99_ms", "max_ms")
+        ))
+    if results["connect"]["failures"]:
+        print(f"{results['connect']['failures']} connections failed")
+    tcp, udp = results["tcp"], results["udp"]
+    for name, failures in (("idle pinger", results["rtt_idle"]["failures"]), ("loaded pinger", results["rtt_loaded"]["failures"]),
+                           ("TCP flows", tcp["failures"]), ("UDP flows", udp["failures"])):
+        if failures:
+            print(f"{failures} {name} failed")
+    print(f"TCP: {tcp['mbps'] or 0:.1f} Mbps over {tcp['flows']} flows")
+    print(f"UDP: {udp['received_pps']:.0f} of {udp['sent_pps']:.0f} pps ({udp['size']} bytes) over {udp['flows']} flows, "
+          f"loss {(udp['loss'] or 0):.2%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sink", action="store_true", help="Run the sink instead of generating load")
+    parser.add_argument("--sink-workers", type=int, default=os.cpu_count() or 1, help="Threads answering UDP probes")
+    parser.add_argument("--target", help="IPv4 address of the sink (mapped into --prefix) or an IPv6 address")
+    parser.add_argument("--prefix", default=os.environ.get("NAT64_PREFIX", "64:ff9b::/96"))
+    parser.add_argument("--port", type=int, default=5201)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of the load phase")
+    parser.add_argument("--tcp-flows", type=int, default=4, help="Concurrent TCP streams")
+    parser.add_argument("--udp-flows", type=int, default=2, help="Concurrent UDP probe flows")
+    parser.add_argument("--udp-rate", type=float, default=2000, help="Packets per second per UDP flow (0 for as fast as possible)")
+    parser.add_argument("--udp-size", type=int, default=512, help="UDP payload size")
+    parser.add_argument("--connections", type=int, default=200, help="TCP handshakes timed before the load phase")
+    parser.add_argument("--concurrency", type=int, default=16, help="TCP handshakes in flight at once")
+    parser.add_argument("--pings", type=int, default=100, help="Idle round trips measured before the load phase")
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--service-url", help="Service /health URL to record the NAT64 setup from")
+    parser.add_argument("--label", action="append", default=[], metavar="KEY=VALUE", help="Recorded with the results")
+    parser.add_argument("--json", action="store_true", help="Print the report as one JSON line")
+    args = parser.parse_args()
+
+    if args.sink:
+        serve_sink(args.port, args.sink_workers)
+        return
+    if not args.target:
+        parser.error("--target is required unless running the sink")
+
+    report = {"setup": describe_setup(args), "results": run(args)}
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from wireguard_tools import WireguardPeer
+
+import tracing
+
+# Reconcile loop (service)
+POLL_DURATION = Histogram(
+    'hetznat64_poll_duration_seconds', 'Duration of a full reconcile cycle',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+POLL_PHASE_DURATION = Histogram(
+    'hetznat64_poll_phase_duration_seconds', 'Duration of each phase of a reconcile cycle', ['phase'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+POLL_FAILURES = Counter('hetznat64_poll_failures_total', 'Reconcile cycles that raised an error')
+PEERS = Gauge('hetznat64_peers', 'Wireguard peers configured on the device')
+PEER_CHANGES = Counter('hetznat64_peer_changes_total', 'Peers added, updated or removed on the device', ['change'])
+PEER_EVICTIONS = Counter('hetznat64_peer_evictions_total', 'Peers garbage collected from the device', ['reason'])
+
+# Handshakes, timed by the service (client side) and the agent (server side)
+HANDSHAKE_DURATION = Histogram(
+    'hetznat64_handshake_duration_seconds', 'Agent handshake latency', ['result'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+HANDSHAKE_FAILURES = Counter('hetznat64_handshake_failures_total', 'Agent handshakes that failed')
+
+# Agent state machine
+AGENT_STATE = Gauge('hetznat64_agent_state', 'Current agent state (1 for the active state)', ['state'])
+AGENT_STATE_TRANSITIONS = Counter('hetznat64_agent_state_transitions_total', 'Agent state changes', ['from_state', 'to_state'])
+
+# Tunnel MTU (service and agent)
+TUNNEL_MTU = Gauge('hetznat64_tunnel_mtu_bytes', 'MTU set on the wireguard interface')
+TCP_MSS = Gauge('hetznat64_tcp_mss_bytes', 'MSS that TCP connections through the tunnel are clamped to')
+PATH_MTU = Gauge('hetznat64_path_mtu_bytes', 'Largest packet that got through on the last path MTU probe (0 if none did)')
+
+# NAT64 translation pools (service), from each tayga instance's dynamic mappings
+NAT64_POOL_MAPPINGS = Gauge('hetznat64_nat64_pool_mappings', 'Dynamic mappings held by a NAT64 instance', ['instance'])
+NAT64_POOL_CAPACITY = Gauge('hetznat64_nat64_pool_capacity', 'Addresses in the dynamic pool of a NAT64 instance', ['instance'])
+NAT64_MAPPING_CHANGES = Counter('hetznat64_nat64_mapping_changes_total', 'Dynamic mappings created or expired', ['instance', 'change'])
+
+# Startup (service and agent)
+STARTUP_PHASE_DURATION = Gauge('hetznat64_startup_phase_duration_seconds', 'Duration of each startup phase', ['phase'])
+
+@contextmanager
+def phase(name: str):
+    """Time a phase of the reconcile cycle, in a trace span of the same name."""
+    start = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        POLL_PHASE_DURATION.labels(name).observe(time.perf_counter() - start)
+
+def set_agent_state(previous: str, state: str):
+    AGENT_STATE_TRANSITIONS.labels(previous, state).inc()
+    AGENT_STATE.labels(previous).set(0)
+    AGENT_STATE.labels(state).set(1)
+
+class PeerStatsCollector:
+    """
+    Per-peer transfer counters and handshake age, read from an existing snapshot of the device's
+    peers at scrape time. `source` yields (labels, peer) pairs and must not touch the device
+    itself, so a scrape never competes with the reconcile loop.
+    """
+
+    def __init__(self, source: Callable[[], Iterable[tuple[dict[str, str], WireguardPeer]]]):
+        self.__source = source
+
+    def collect(self):
+        label_names = None
+        rx = tx = age = None
+        now = time.time()
+        for labels, peer in self.__source():
+            if label_names is None:
+                label_names = list(labels)
+                rx = CounterMetricFamily('hetznat64_peer_rx_bytes', 'Bytes received from the peer', labels=label_names)
+                tx = CounterMetricFamily('hetznat64_peer_tx_bytes', 'Bytes sent to the peer', labels=label_names)
+                age = GaugeMetricFamily('hetznat64_peer_last_handshake_age_seconds',
+                                        'Seconds since the last handshake with the peer', labels=label_names)
+            values = [labels[name] for name in label_names]
+            rx.add_metric(values, peer.rx_bytes or 0)
+            tx.add_metric(values, peer.tx_bytes or 0)
+            if peer.last_handshake:
+                age.add_metric(values, now - peer.last_handshake)
+        if label_names is not None:
+            yield from (rx, tx, age)
+
+class ApiBudgetCollector:
+    """Hetzner API calls made by a RateLimitedClient and the rate-limit headroom it has left."""
+
+    def __init__(self, client):
+        self.__client = client
+
+    def collect(self):
+        requests = CounterMetricFamily('hetznat64_api_requests', 'Requests sent to the Hetzner Cloud API')
+        requests.add_metric([], self.__client.requests)
+        yield requests
+        yield GaugeMetricFamily('hetznat64_api_rate_limit_remaining', 'Requests left in the Hetzner rate-limit budget',
+                                value=self.__client.bucket.remaining)
+        yield GaugeMetricFamily('hetznat64_api_rate_limit', 'Size of the Hetzner rate-limit budget',
+                                value=self.__client.bucket.capacity)
+
+class ResolverStatsCollector:
+    """DNS64 resolver cache and synthesis stats, as last read by a `unbound.StatsScraper`."""
+
+    def __init__(self, scraper):
+        self.__scraper = scraper
+
+    def collect(self):
+        stats = self.__scraper.stats
+        if stats is None:
+            return
+        for name, documentation, value in (
+            ('queries', 'Queries answered by the DNS64 resolver', stats.queries),
+            ('cache_hits', 'DNS64 resolver queries answered from the cache', stats.cache_hits),
+            ('cache_misses', 'DNS64 resolver queries that needed recursion', stats.cache_misses),
+            ('prefetches', 'Cache entries the DNS64 resolver refreshed before they expired', stats.prefetches),
+            ('expired_answers', 'DNS64 resolver answers served from expired cache entries', stats.expired_answers),
+            ('aaaa_queries', 'AAAA queries to the DNS64 resolver (the ones it may synthesize)', stats.aaaa_queries),
+        ):
+            counter = CounterMetricFamily(f'hetznat64_dns64_{name}', documentation)
+            counter.add_metric([], value)
+            yield counter
+        if stats.hit_ratio is not None:
+            yield GaugeMetricFamily('hetznat64_dns64_cache_hit_ratio', 'Share of DNS64 resolver queries answered from the cache',
+                                    value=stats.hit_ratio)
+        yield GaugeMetricFamily('hetznat64_dns64_recursion_seconds_avg', 'Average recursion time of cache misses',
+                                value=stats.recursion_avg)
+        yield GaugeMetricFamily('hetznat64_dns64_recursion_seconds_median', 'Median recursion time of cache misses',
+                                value=stats.recursion_median)
+        yield GaugeMetricFamily('hetznat64_dns64_request_list_avg', 'Queries waiting on recursion, averaged over threads',
+                                value=stats.request_list_avg)
+        yield GaugeMetricFamily('hetznat64_dns64_cache_memory_bytes', 'Memory in the message and rrset caches',
+                                value=stats.cache_memory)
+        if stats.synthesis is not None:
+            yield GaugeMetricFamily('hetznat64_dns64_synthesis_ok', 'Whether the last probe got a synthesized AAAA answer',
+                                    value=int(stats.synthesis.ok))
+            if stats.synthesis.seconds is not None:
+                yield GaugeMetricFamily('hetznat64_dns64_synthesis_seconds', 'Duration of the last synthesis probe',
+                                        value=stats.synthesis.seconds)
+
+def instance_registry() -> CollectorRegistry:
+    """
+    A registry for one service or agent's own collectors. They read that instance's state, so
+    they don't go in the process-wide REGISTRY, where a second instance in the same process
+    (tests, benchmark harnesses) would clash with the first one's.
+    """
+    return CollectorRegistry(auto_describe=True)
+
+def register(collector, registry: CollectorRegistry):
+    registry.register(collector)
+
+def exposition(registry: CollectorRegistry = None) -> tuple[bytes, str]:
+    """The process-wide metrics plus those in `registry`, in the Prometheus text format, with their content type."""
+    body = generate_latest(REGISTRY)
+    if registry is not None:
+        body += generate_latest(registry)
+    return body, CONTENT_TYPE_LATEST
@@ -0,0 +1,202 @@
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from ipaddress import IPv4Address, IPv6Address, ip_address
+
+import metrics
+
+# Header sizes of the encapsulation: agent traffic is IPv6 inside wireguard (UDP) over an IPv6
+# (or IPv4) underlay, and tayga then swaps its IPv6 header for an IPv4 one
+IPV6_HEADER = 40
+IPV4_HEADER = 20
+UDP_HEADER = 8
+TCP_HEADER = 20
+ICMPV6_HEADER = 8
+# Wireguard data message header (type, receiver index, counter) plus the Poly1305 tag
+WIREGUARD_OVERHEAD = 16 + 16
+
+# IPv6 links can't be smaller than this, and neither can the tunnel carrying them
+IPV6_MIN_MTU = 1280
+
+# Destinations used to find the default route's MTU when there's no known peer yet
+DEFAULT_DESTINATIONS = ('2000::1', '1.0.0.1')
+
+# Linux socket options not exported by the socket module
+IPV6_MTU_DISCOVER = 23
+IPV6_PMTUDISC_PROBE = 3
+
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+@dataclass(frozen=True)
+class MTUPlan:
+    # MTU of the underlay path the tunnel's UDP packets take
+    underlay: int
+
+    # Whether that path is IPv4 (20 bytes less header than IPv6)
+    ipv4_underlay: bool
+
+    # MTU for the wireguard interface
+    tunnel: int
+
+    # Largest IPv4 packet that still fits through the tunnel once tayga translated it to IPv6
+    ipv4: int
+
+    # MSS clamped on TCP SYNs through the tunnel. The payload survives 6->4 translation
+    # unchanged, so the same MSS is right on both sides of tayga
+    mss: int
+
+    def __str__(self):
+        underlay = 'IPv4' if self.ipv4_underlay else 'IPv6'
+        return f"tunnel MTU {self.tunnel} over {underlay} underlay MTU {self.underlay}, IPv4 MTU {self.ipv4}, TCP MSS {self.mss}"
+
+def plan(underlay: int, ipv4_underlay: bool = False, tunnel: int = None) -> MTUPlan:
+    """
+    Work out the tunnel MTU and MSS from the underlay MTU, or from a fixed `tunnel` MTU.
+
+    The tunnel never goes below the IPv6 minimum, even on an underlay too small to carry it
+    without fragmenting the outer packets; that's still better than IPv6 not working at all.
+    """
+    if tunnel is None:
+        overhead = (IPV4_HEADER if ipv4_underlay else IPV6_HEADER) + UDP_HEADER + WIREGUARD_OVERHEAD
+        tunnel = underlay - overhead
+        if tunnel < IPV6_MIN_MTU:
+            print(f"Warning: Underlay MTU {underlay} leaves {tunnel} for the tunnel, using the IPv6 minimum {IPV6_MIN_MTU}")
+            tunnel = IPV6_MIN_MTU
+    return MTUPlan(
+        underlay=underlay,
+        ipv4_underlay=ipv4_underlay,
+        tunnel=tunnel,
+        ipv4=tunnel - IPV6_HEADER + IPV4_HEADER,
+        mss=tunnel - IPV6_HEADER - TCP_HEADER,
+    )
+
+def underlay_mtu(network, destination: IPv4Address | IPv6Address | str = None) -> tuple[int, bool]:
+    """MTU of the route the tunnel takes to `destination` (default route if unknown) and whether it's IPv4."""
+    destinations = [destination] if destination is not None else DEFAULT_DESTINATIONS
+    for candidate in destinations:
+        candidate = ip_address(candidate)
+        if isinstance(candidate, IPv6Address) and candidate.ipv4_mapped:
+            candidate = candidate.ipv4_mapped
+        mtu = network.route_mtu(candidate)
+        if mtu:
+            return mtu, candidate.version == 4
+    raise RuntimeError(f"No route to {destination or 'the internet'} to take the underlay MTU from")
+
+def tune(network, interface: str, destination: IPv4Address | IPv6Address | str = None, tunnel: int = None) -> MTUPlan:
+    """Set the wireguard interface's MTU for the path to `destination` and clamp TCP MSS through it."""
+    if tunnel is None:
+        mtu, ipv4_underlay = underlay_mtu(network, destination)
+        result = plan(mtu, ipv4_underlay)
+    else:
+        result = plan(tunnel + IPV6_HEADER + UDP_HEADER + WIREGUARD_OVERHEAD, tunnel=tunnel)
+    changed = network.set_mtu(interface, result.tunnel)
+    changed = network.clamp_mss(interface, result.mss) or changed
+    if changed:
+        print(f"Tuned {interface}: {result}")
+    metrics.TUNNEL_MTU.set(result.tunnel)
+    metrics.TCP_MSS.set(result.mss)
+    return result
+
+def probe_path_mtu(target: str, low: int = IPV6_MIN_MTU, high: int = 1500, timeout: float = 1.0) -> int | None:
+    """
+    The largest IPv6 packet that reaches `target` and gets an answer, found by binary search
+    with unfragmented echo requests. None if even `low` doesn't get through.
+
+    Path MTU discovery is put in probe mode, so a smaller cached MTU doesn't cap the search and
+    packets over the local interface's MTU fail right away instead of waiting for the timeout.
+    """
+    # Unprivileged ICMP datagram socket where ping_group_range allows it, like Prober
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_ICMPV6)
+    except OSError:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+    ident = os.getpid() & 0xFFFF
+    try:
+        sock.setsockopt(socket.IPPROTO_IPV6, IPV6_MTU_DISCOVER, IPV6_PMTUDISC_PROBE)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_DONTFRAG, 1)
+        sock.setblocking(False)
+        sequence = 0
+
+        def echo(size: int) -> bool:
+            nonlocal sequence
+            sequence = (sequence + 1) & 0xFFFF
+            payload = b'\0' * (size - IPV6_HEADER - ICMPV6_HEADER)
+            try:
+                sock.sendto(struct.pack('!BBHHH', ICMPV6_ECHO_REQUEST, 0, 0, ident, sequence) + payload, (target, 0))
+            except OSError:
+                return False
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if not readable:
+                    return False
+                try:
+                    data = sock.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    # A packet too big (or other ICMP error) for an earlier probe
+                    return False
+                if len(data) >= 8 and struct.unpack('!BBHHH', data[:8])[0::4] == (ICMPV6_ECHO_REPLY, sequence):
+                    return True
+            return False
+
+        if not echo(low):
+            return None
+        while low < high:
+            size = (low + high + 1) // 2
+            if echo(size):
+                low = size
+            else:
+                high = size - 1
+        return low
+    finally:
+        sock.close()
+
+class PathMTUProbe:
+    """Probes the path MTU to a target on a background thread, keeping the last result and exporting it as a metric."""
+
+    def __init__(self, target, interval: float = 300, high: int = 1500):
+        self.__target = target
+        self.__interval = interval
+        self.__high = high
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.mtu: int | None = None
+        self.checked: float | None = None
+
+    @property
+    def target(self) -> str | None:
+        return self.__target() if callable(self.__target) else self.__target
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='mtu-probe', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def probe(self) -> int | None:
+        target = self.target
+        if not target:
+            return None
+        self.mtu = probe_path_mtu(str(target), high=self.__high)
+        self.checked = time.time()
+        metrics.PATH_MTU.set(self.mtu or 0)
+        return self.mtu
+
+    def as_dict(self) -> dict:
+        return {'target': str(self.target) if self.target else None, 'mtu': self.mtu, 'checked': self.checked}
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.probe()
+            except Exception as e:
+                print(f"Failed to probe path MTU to {self.target}: {e}")
+            self.__stop.wait(self.__interval)
@@ -0,0 +1,233 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+
+import metrics
+
+# File tayga keeps its dynamic IPv6 to IPv4 mappings in, inside its data-dir
+DYNAMIC_MAP = 'dynamic.map'
+
+# Routing tables and rule priorities used to send each source slice to its NAT64 instance, and
+# how many of each are set aside (the ones past what the current layout uses are cleared)
+TABLE_BASE = 6400
+RULE_PRIORITY_BASE = 6400
+MAX_INSTANCES = 64
+MAX_SLICES = 1024
+
+@dataclass(frozen=True)
+class Nat64Instance:
+    # Address of the tayga instance the NAT64 prefix is routed through
+    address: IPv6Address
+
+    # Its dynamic pool, for the pool usage (None if unknown)
+    pool: IPv4Network = None
+
+    # Tayga's data-dir as mounted here, to read its mappings from (None to not monitor it)
+    data_dir: str = None
+
+    @classmethod
+    def parse(cls, text: str) -> 'Nat64Instance':
+        """An instance from `address [pool [data-dir]]`."""
+        fields = text.split()
+        if not 1 <= len(fields) <= 3:
+            raise ValueError(f"Expected 'address [pool [data-dir]]' for a NAT64 instance, not '{text}'")
+        return cls(
+            address=IPv6Address(fields[0]),
+            pool=IPv4Network(fields[1]) if len(fields) > 1 else None,
+            data_dir=fields[2] if len(fields) > 2 else None,
+        )
+
+    @property
+    def name(self) -> str:
+        return str(self.address)
+
+    @property
+    def capacity(self) -> int | None:
+        """Addresses tayga can hand out from the pool (not its network and broadcast addresses)."""
+        if self.pool is None:
+            return None
+        return self.pool.num_addresses - 2 if self.pool.prefixlen < 31 else self.pool.num_addresses
+
+def parse_instances(text: str) -> list[Nat64Instance]:
+    """Comma separated instances, e.g. `fd00::64 10.64.64.0/22 /var/lib/tayga/0, fd00::65 10.64.68.0/22`."""
+    return [Nat64Instance.parse(instance) for instance in text.split(',') if instance.strip()]
+
+def slice_count(instances: int) -> int:
+    """
+    Source slices for `instances` NAT64 instances: four per instance rounded up to a power of
+    two, so the slices (assigned round-robin) split the peers about evenly even when the number
+    of instances isn't a power of two.
+    """
+    return 1 if instances <= 1 else 1 << (instances * 4 - 1).bit_length()
+
+def source_routes(sources: IPv6Network, instances: list[Nat64Instance], slices: int) -> list[tuple[IPv6Network, Nat64Instance]]:
+    """Each of the `slices` prefixes of `sources` with the instance its traffic goes to."""
+    subnets = list(sources.subnets(prefixlen_diff=slices.bit_length() - 1))
+    return [(subnet, instances[index % len(instances)]) for index, subnet in enumerate(subnets)]
+
+def route(network, prefix: IPv6Network | str, sources: IPv6Network, instances: list[Nat64Instance], slices: int) -> bool:
+    """
+    Route the NAT64 prefix to the instances: through the first one in the main table, and with
+    several instances, from each slice of `sources` (the peer addresses) through its own
+    instance using a routing table per instance and a source rule per slice. Rules and tables
+    left over from a layout with more slices or instances are removed, so no slice keeps
+    going to an instance that is gone.
+    """
+    if len(instances) > MAX_INSTANCES or slices > MAX_SLICES:
+        raise ValueError(f"At most {MAX_INSTANCES} NAT64 instances and {MAX_SLICES} slices, not {len(instances)} and {slices}")
+    changed = network.ensure_route(prefix, via=instances[0].address)
+    rules = tables = 0
+    if len(instances) > 1:
+        for index, instance in enumerate(instances):
+            changed = network.ensure_route(prefix, via=instance.address, table=TABLE_BASE + index) or changed
+        for priority, (subnet, instance) in enumerate(source_routes(sources, instances, slices), start=RULE_PRIORITY_BASE):
+            changed = network.ensure_rule(subnet, TABLE_BASE + instances.index(instance), priority) or changed
+        rules, tables = slices, len(instances)
+    # Stale rules go before their tables, so traffic never looks up an emptied table
+    removed = network.remove_rules(RULE_PRIORITY_BASE + rules, RULE_PRIORITY_BASE + MAX_SLICES - 1)
+    removed = network.flush_tables(TABLE_BASE + tables, TABLE_BASE + MAX_INSTANCES - 1) or removed
+    if removed:
+        print(f"Removed NAT64 source routes beyond {rules} slices and {tables} instance tables")
+    if changed and len(instances) > 1:
+        print(f"Routed {prefix} from {slices} slices of {sources} across {len(instances)} NAT64 instances")
+    return changed or removed
+
+@dataclass(frozen=True)
+class DynamicMapping:
+    ipv4: IPv4Address
+    ipv6: IPv6Address
+
+    # When tayga last translated a packet for the mapping (unix time)
+    last_use: int
+
+def read_dynamic_map(data_dir: str) -> list[DynamicMapping]:
+    """Tayga's dynamic mappings as it last wrote them. Empty if it hasn't made any yet."""
+    mappings = []
+    try:
+        with open(os.path.join(data_dir, DYNAMIC_MAP)) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                try:
+                    mappings.append(DynamicMapping(IPv4Address(fields[0]), IPv6Address(fields[1]), int(fields[2])))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        # No mappings yet, unless the data-dir itself is missing (e.g. not mounted)
+        if not os.path.isdir(data_dir):
+            raise
+    return mappings
+
+@dataclass(frozen=True)
+class PoolUsage:
+    instance: str
+    mappings: int
+    capacity: int | None
+
+    # Mappings created and expired since the previous read
+    added: int
+    expired: int
+
+    # Seconds since the least recently used mapping was last used
+    oldest_idle: float | None
+
+    @property
+    def utilization(self) -> float | None:
+        return self.mappings / self.capacity if self.capacity else None
+
+    def as_dict(self) -> dict:
+        return {
+            'instance': self.instance,
+            'mappings': self.mappings,
+            'capacity': self.capacity,
+            'utilization': self.utilization,
+            'added': self.added,
+            'expired': self.expired,
+            'oldest_idle': self.oldest_idle,
+        }
+
+class PoolMonitor:
+    """
+    Reads the dynamic mappings of NAT64 instances on a background thread and reports how full
+    each pool is and how many mappings come and go. A mapping whose IPv6 source moved to another
+    IPv4 address counts as one expired and one added.
+    """
+
+    def __init__(self, instances: list[Nat64Instance], interval: float = 30):
+        self.__instances = [instance for instance in instances if instance.data_dir]
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__lock = threading.Lock()
+        self.__previous: dict[str, set[tuple[IPv6Address, IPv4Address]]] = {}
+        self.__usage: dict[str, PoolUsage] = {}
+        self.__errors: dict[str, str] = {}
+        self.checked: float | None = None
+
+    def __len__(self):
+        return len(self.__instances)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='nat64-pool', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def check(self, now: float = None) -> list[PoolUsage]:
+        now = time.time() if now is None else now
+        results = []
+        for instance in self.__instances:
+            try:
+                mappings = read_dynamic_map(instance.data_dir)
+            except OSError as e:
+                with self.__lock:
+                    if self.__errors.get(instance.name) != str(e):
+                        print(f"Failed to read the mappings of NAT64 instance {instance.name}: {e}")
+                    self.__errors[instance.name] = str(e)
+                continue
+            current = {(mapping.ipv6, mapping.ipv4) for mapping in mappings}
+            previous = self.__previous.get(instance.name)
+            self.__previous[instance.name] = current
+            usage = PoolUsage(
+                instance=instance.name,
+                mappings=len(mappings),
+                capacity=instance.capacity,
+                added=len(current - previous) if previous is not None else 0,
+                expired=len(previous - current) if previous is not None else 0,
+                oldest_idle=max(now - min(mapping.last_use for mapping in mappings), 0) if mappings else None,
+            )
+            metrics.NAT64_POOL_MAPPINGS.labels(instance.name).set(usage.mappings)
+            if usage.capacity:
+                metrics.NAT64_POOL_CAPACITY.labels(instance.name).set(usage.capacity)
+            metrics.NAT64_MAPPING_CHANGES.labels(instance.name, 'added').inc(usage.added)
+            metrics.NAT64_MAPPING_CHANGES.labels(instance.name, 'expired').inc(usage.expired)
+            if usage.utilization is not None and usage.utilization >= 0.9 and \
+                    (instance.name not in self.__usage or self.__usage[instance.name].utilization < 0.9):
+                print(f"Warning: NAT64 pool of {instance.name} is {usage.utilization:.0%} full "
+                      f"({usage.mappings} of {usage.capacity} addresses)")
+            with self.__lock:
+                self.__usage[instance.name] = usage
+                self.__errors.pop(instance.name, None)
+            results.append(usage)
+        self.checked = now
+        return results
+
+    def as_dict(self) -> dict:
+        with self.__lock:
+            return {
+                'instances': [usage.as_dict() for usage in self.__usage.values()],
+                'errors': dict(self.__errors),
+                'checked': self.checked,
+            }
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Failed to check NAT64 pools: {e}")
+            self.__stop.wait(self.__interval)
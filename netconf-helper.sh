@@ -0,0 +1,8 @@
+#!/bin/sh
+
+# Long-lived privileged helper: applies address/route changes sent as JSON lines on stdin.
+# It only touches this interface and NAT64 prefix; sudo resets the caller's environment, so
+# they are fixed here (like update-ip.sh's interface was) rather than chosen by the caller
+export WG_INTERFACE="hetznat64"
+export NAT64_PREFIX="64:ff9b::/96"
+exec /usr/local/bin/python3 /app/netconf.py --serve
@@ -0,0 +1,629 @@
+import errno
+import itertools
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from ipaddress import IPv4Address, IPv6Address, IPv6Interface, IPv6Network, ip_address, ip_network
+
+from pyroute2 import IPRoute, NetlinkError
+from pyroute2.netlink.rtnl import RTMGRP_LINK
+
+import tracing
+from mtu import IPV6_HEADER, IPV6_MIN_MTU, TCP_HEADER
+from nat64pool import MAX_INSTANCES, MAX_SLICES, RULE_PRIORITY_BASE, TABLE_BASE
+
+HELPER = "/netconf-helper.sh"
+
+# Address scopes and routing tables as reported by netlink
+RT_SCOPE_UNIVERSE = 0
+RT_TABLE_MAIN = 254
+
+class NetConfError(RuntimeError):
+    pass
+
+class NetConf:
+    """
+    Address and route configuration over netlink, without forking `ip`.
+
+    Every operation first reads the current state and only changes what differs, so calling
+    them again with the same arguments is cheap and doesn't disturb existing traffic.
+    Needs CAP_NET_ADMIN; unprivileged processes go through NetConfClient instead.
+    """
+
+    def __init__(self):
+        self.__ipr = IPRoute()
+        self.__masqueraded: set[str] = set()
+        self.__clamped: dict[str, int] = {}
+
+    def close(self):
+        self.__ipr.close()
+
+    def __index(self, ifname: str) -> int:
+        indexes = self.__ipr.link_lookup(ifname=ifname)
+        if not indexes:
+            raise NetConfError(f"Interface {ifname} not found")
+        return indexes[0]
+
+    def wait_for_interface(self, ifname: str, timeout: float = 30) -> int:
+        """Block until `ifname` exists, returning its index. Waits on link events rather than polling."""
+        deadline = time.monotonic() + timeout
+        with IPRoute() as events:
+            # Subscribe before looking so an interface created in between isn't missed
+            events.bind(groups=RTMGRP_LINK)
+            while True:
+                indexes = self.__ipr.link_lookup(ifname=ifname)
+                if indexes:
+                    return indexes[0]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NetConfError(f"Timed out waiting for interface {ifname}")
+                readable, _, _ = select.select([events], [], [], remaining)
+                if readable:
+                    events.get()
+
+    def addresses(self, ifname: str) -> list[IPv6Interface]:
+        """Global IPv6 addresses on the interface."""
+        return [
+            IPv6Interface(f"{message.get_attr('IFA_ADDRESS')}/{message['prefixlen']}")
+            for message in self.__ipr.get_addr(family=socket.AF_INET6, index=self.__index(ifname))
+            if message['scope'] == RT_SCOPE_UNIVERSE
+        ]
+
+    @tracing.traced('netconf.set_address')
+    def set_address(self, ifname: str, address: IPv6Interface | str) -> bool:
+        """Make `address` the only global IPv6 address of the interface, returning whether anything changed."""
+        address = IPv6Interface(address)
+        index = self.__index(ifname)
+        current = self.addresses(ifname)
+        if current == [address]:
+            return False
+        for existing in current:
+            if existing != address:
+                self.__ipr.addr('del', index=index, family=socket.AF_INET6,
+                                address=str(existing.ip), prefixlen=existing.network.prefixlen)
+        if address not in current:
+            self.__ipr.addr('add', index=index, family=socket.AF_INET6,
+                            address=str(address.ip), prefixlen=address.network.prefixlen)
+        return True
+
+    def route_device(self, destination: IPv6Address | str) -> str | None:
+        """The interface the kernel would route `destination` through."""
+        try:
+            routes = self.__ipr.route('get', dst=str(destination), family=socket.AF_INET6)
+        except NetlinkError:
+            return None
+        for route in routes:
+            index = route.get_attr('RTA_OIF')
+            if index is not None:
+                links = self.__ipr.get_links(index)
+                return links[0].get_attr('IFLA_IFNAME') if links else None
+        return None
+
+    def route_mtu(self, destination: IPv4Address | IPv6Address | str) -> int | None:
+        """MTU of the route to `destination`: the route's own mtu metric, else its interface's MTU."""
+        destination = ip_address(destination)
+        family = socket.AF_INET6 if destination.version == 6 else socket.AF_INET
+        try:
+            routes = self.__ipr.route('get', dst=str(destination), family=family)
+        except NetlinkError:
+            return None
+        for route in routes:
+            metrics = route.get_attr('RTA_METRICS')
+            mtu = metrics.get_attr('RTAX_MTU') if metrics else None
+            if mtu:
+                return mtu
+            index = route.get_attr('RTA_OIF')
+            if index is not None:
+                links = self.__ipr.get_links(index)
+                return links[0].get_attr('IFLA_MTU') if links else None
+        return None
+
+    @tracing.traced('netconf.set_mtu')
+    def set_mtu(self, ifname: str, mtu: int) -> bool:
+        """Set the interface's MTU, returning whether it changed."""
+        index = self.__index(ifname)
+        if self.__ipr.get_links(index)[0].get_attr('IFLA_MTU') == mtu:
+            return False
+        self.__ipr.link('set', index=index, mtu=mtu)
+        return True
+
+    @tracing.traced('netconf.ensure_route')
+    def ensure_route(self, prefix: IPv6Network | str, dev: str = None, via: IPv6Address | str = None,
+                     timeout: float = 60, table: int = None) -> bool:
+        """
+        Route `prefix` through `dev` (and gateway `via`), returning whether the route was changed.
+        The route goes in the main table unless another `table` is given.
+
+        A gateway that isn't reachable yet (e.g. the NAT64 container is still starting) is
+        retried with backoff until `timeout`.
+        """
+        prefix = ip_network(prefix)
+        if dev is None:
+            dev = self.route_device(via) if via else None
+            if dev is None:
+                raise NetConfError(f"No interface to route {prefix} through")
+        index = self.__index(dev)
+        gateway = str(ip_address(via)) if via else None
+
+        for route in self.__ipr.route('dump', family=socket.AF_INET6, dst=str(prefix.network_address),
+                                      dst_len=prefix.prefixlen):
+            if route.get_attr('RTA_OIF') == index and route.get_attr('RTA_GATEWAY') == gateway and \
+                    route.get_attr('RTA_TABLE') == (table or RT_TABLE_MAIN):
+                return False
+
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            try:
+                kwargs = {'gateway': gateway} if gateway else {}
+                if table is not None:
+                    kwargs['table'] = table
+                self.__ipr.route('replace', family=socket.AF_INET6, dst=str(prefix), oif=index, **kwargs)
+                return True
+            except NetlinkError as e:
+                if e.code not in (errno.EHOSTUNREACH, errno.ENETUNREACH) or time.monotonic() >= deadline:
+                    raise
+                print(f"Gateway {via} for {prefix} not reachable yet, retrying...")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    @tracing.traced('netconf.ensure_rule')
+    def ensure_rule(self, source: IPv6Network | str, table: int, priority: int) -> bool:
+        """
+        Look up routes for traffic from `source` in `table`, with the rule at `priority`, returning
+        whether it changed. Another rule at the same priority is replaced, so the priorities
+        given to a set of rules can be reassigned.
+        """
+        source = IPv6Network(source)
+        for rule in self.__ipr.get_rules(family=socket.AF_INET6):
+            if rule.get_attr('FRA_PRIORITY') != priority:
+                continue
+            if rule.get_attr('FRA_SRC') == str(source.network_address) and rule['src_len'] == source.prefixlen \
+                    and (rule.get_attr('FRA_TABLE') or rule['table']) == table:
+                return False
+            self.__ipr.rule('del', family=socket.AF_INET6, priority=priority)
+        self.__ipr.rule('add', family=socket.AF_INET6, src=str(source.network_address), src_len=source.prefixlen,
+                        table=table, priority=priority)
+        return True
+
+    @tracing.traced('netconf.remove_rules')
+    def remove_rules(self, first_priority: int, last_priority: int) -> bool:
+        """Delete every IPv6 rule with a priority from `first_priority` to `last_priority`, returning whether any were."""
+        removed = False
+        for rule in self.__ipr.get_rules(family=socket.AF_INET6):
+            priority = rule.get_attr('FRA_PRIORITY')
+            if priority is not None and first_priority <= priority <= last_priority:
+                self.__ipr.rule('del', family=socket.AF_INET6, priority=priority)
+                removed = True
+        return removed
+
+    @tracing.traced('netconf.flush_tables')
+    def flush_tables(self, first_table: int, last_table: int) -> bool:
+        """Delete every IPv6 route in the tables `first_table` to `last_table`, returning whether any were."""
+        removed = False
+        for route in self.__ipr.route('dump', family=socket.AF_INET6):
+            table = route.get_attr('RTA_TABLE') or route['table']
+            if first_table <= table <= last_table:
+                self.__ipr.route('del', family=socket.AF_INET6, table=table, dst=route.get_attr('RTA_DST') or '::',
+                                 dst_len=route['dst_len'])
+                removed = True
+        return removed
+
+    @tracing.traced('netconf.masquerade')
+    def masquerade(self, ifname: str) -> bool:
+        """
+        Masquerade IPv6 traffic leaving `ifname`. NAT rules live in netfilter rather than
+        rtnetlink, so this still runs ip6tables, but checks first and only once per interface.
+        """
+        if ifname in self.__masqueraded:
+            return False
+        rule = ["-t", "nat", "POSTROUTING", "-o", ifname, "-j", "MASQUERADE"]
+        check = ["ip6tables", rule[0], rule[1], "-C", *rule[2:]]
+        added = False
+        if subprocess.run(check, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+            subprocess.run(["ip6tables", rule[0], rule[1], "-A", *rule[2:]], check=True)
+            added = True
+        self.__masqueraded.add(ifname)
+        return added
+
+    @tracing.traced('netconf.clamp_mss')
+    def clamp_mss(self, ifname: str, mss: int) -> bool:
+        """
+        Clamp the MSS of TCP connections forwarded in or out of `ifname` to `mss`, replacing
+        rules with a different value. Like masquerade, checked first and only once per value.
+        """
+        if self.__clamped.get(ifname) == mss:
+            return False
+        changed = False
+        rules = subprocess.run(["ip6tables", "-t", "mangle", "-S", "FORWARD"], capture_output=True, text=True, check=True)
+        for line in rules.stdout.splitlines():
+            words = line.split()
+            if "TCPMSS" in words and (f"-i {ifname} " in line or f"-o {ifname} " in line) and \
+                    not line.endswith(f"--set-mss {mss}"):
+                subprocess.run(["ip6tables", "-t", "mangle", "-D", *words[1:]], check=True)
+                changed = True
+        for direction in ("-i", "-o"):
+            rule = ["FORWARD", direction, ifname, "-p", "tcp", "--tcp-flags", "SYN,RST", "SYN",
+                    "-j", "TCPMSS", "--set-mss", str(mss)]
+            if subprocess.run(["ip6tables", "-t", "mangle", "-C", *rule],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                subprocess.run(["ip6tables", "-t", "mangle", "-A", *rule], check=True)
+                changed = True
+        self.__clamped[ifname] = mss
+        return changed
+
+    # Kernel wireguard devices, for processes without CAP_NET_ADMIN (backend.HelperWireguardDevice).
+    # Configs and peers travel as WireguardConfig/WireguardPeer.asdict() so they fit in JSON
+
+    def wg_interfaces(self) -> list[str]:
+        from wireguard_tools.wireguard_netlink import WireguardNetlinkDevice
+        return [device.interface for device in WireguardNetlinkDevice.list()]
+
+    def wg_config(self, ifname: str) -> dict:
+        """The device's config, including each peer's handshake and transfer stats."""
+        from wireguard_tools.wireguard_netlink import WireguardNetlinkDevice
+        device = WireguardNetlinkDevice(ifname)
+        try:
+            return device.get_config().asdict()
+        finally:
+            device.close()
+
+    @tracing.traced('netconf.wg_set_config')
+    def wg_set_config(self, ifname: str, config: dict) -> bool:
+        """Replace the device's config (key, port and every peer)."""
+        from wireguard_tools import WireguardConfig
+        from wireguard_tools.wireguard_netlink import WireguardNetlinkDevice
+        device = WireguardNetlinkDevice(ifname)
+        try:
+            device.set_config(WireguardConfig.from_dict(config))
+        finally:
+            device.close()
+        return True
+
+    @tracing.traced('netconf.wg_set_peers')
+    def wg_set_peers(self, ifname: str, removed: list[str], peers: list[dict]) -> bool:
+        """Remove the peers with the `removed` public keys and add or replace `peers`, leaving the rest alone."""
+        from wireguard_tools import WireguardKey, WireguardPeer
+        import wgpeers
+        wgpeers.set_peers_netlink(ifname, [WireguardKey(key) for key in removed], [WireguardPeer.from_dict(peer) for peer in peers])
+        return bool(removed or peers)
+
+# Operations the privileged helper will run on behalf of its client
+OPERATIONS = ('wait_for_interface', 'addresses', 'set_address', 'route_device', 'route_mtu', 'set_mtu',
+              'ensure_route', 'ensure_rule', 'remove_rules', 'flush_tables', 'masquerade', 'clamp_mss',
+              'wg_interfaces', 'wg_config', 'wg_set_config', 'wg_set_peers')
+
+# Settings and peer fields a wireguard config sent to the helper may carry (no addresses or hooks)
+WG_CONFIG_FIELDS = {'private_key', 'listen_port', 'fwmark', 'peers'}
+WG_PEER_FIELDS = {'public_key', 'preshared_key', 'endpoint', 'endpoint_host', 'endpoint_port', 'persistent_keepalive',
+                  'allowed_ips', 'friendly_name', 'friendly_json', 'last_handshake', 'rx_bytes', 'tx_bytes'}
+
+def _integer(low: int, high: int):
+    def parse(value) -> int:
+        if type(value) is not int or not low <= value <= high:
+            raise ValueError(f"expected an integer from {low} to {high}, not {value!r}")
+        return value
+    return parse
+
+def _seconds(value) -> float:
+    if type(value) not in (int, float) or not 0 <= value <= 600:
+        raise ValueError(f"expected 0 to 600 seconds, not {value!r}")
+    return value
+
+def _text(parse):
+    def check(value) -> str:
+        if not isinstance(value, str):
+            raise ValueError(f"expected a string, not {value!r}")
+        return str(parse(value))
+    return check
+
+def _optional(parse):
+    return lambda value: None if value is None else parse(value)
+
+def _wg_peer(peer) -> dict:
+    from wireguard_tools import WireguardPeer
+    if not isinstance(peer, dict):
+        raise ValueError("expected a wireguard peer")
+    if not set(peer) <= WG_PEER_FIELDS:
+        raise ValueError(f"unexpected wireguard peer fields {sorted(set(peer) - WG_PEER_FIELDS)}")
+    WireguardPeer.from_dict(dict(peer))
+    return peer
+
+def _wg_config(config) -> dict:
+    from wireguard_tools import WireguardConfig
+    if not isinstance(config, dict):
+        raise ValueError("expected a wireguard config")
+    if not set(config) <= WG_CONFIG_FIELDS:
+        raise ValueError(f"unexpected wireguard config fields {sorted(set(config) - WG_CONFIG_FIELDS)}")
+    for peer in config.get('peers', []):
+        _wg_peer(peer)
+    WireguardConfig.from_dict({**config, 'peers': [dict(peer) for peer in config.get('peers', [])]})
+    return config
+
+def _wg_keys(keys) -> list[str]:
+    from wireguard_tools import WireguardKey
+    if not isinstance(keys, list):
+        raise ValueError(f"expected a list of keys, not {keys!r}")
+    return [_text(WireguardKey)(key) for key in keys]
+
+def _wg_peers(peers) -> list[dict]:
+    if not isinstance(peers, list):
+        raise ValueError(f"expected a list of peers, not {peers!r}")
+    return [_wg_peer(peer) for peer in peers]
+
+@dataclass(frozen=True)
+class HelperPolicy:
+    """
+    What the privileged helper lets its client touch: the wireguard interface, routes for the
+    NAT64 prefix, and the routing tables and rule priorities nat64pool sets aside. Every
+    argument is parsed and range checked before an operation runs; anything else is refused.
+    """
+
+    # The wireguard interface (the only one addresses, MTU, MSS and wireguard configs are set on)
+    interface: str
+
+    # The NAT64 prefix (the only prefix routes are added for)
+    nat64_prefix: IPv6Network
+
+    def check(self, network: 'NetConf', op: str, args: dict) -> dict:
+        """`args` for `op` once every one of them has been checked, or NetConfError."""
+        interface = self.__interface
+        tables = _integer(TABLE_BASE, TABLE_BASE + MAX_INSTANCES - 1)
+        priorities = _integer(RULE_PRIORITY_BASE, RULE_PRIORITY_BASE + MAX_SLICES - 1)
+        parsers = {
+            'wait_for_interface': {'ifname': interface, 'timeout': _seconds},
+            'addresses': {'ifname': interface},
+            'set_address': {'ifname': interface, 'address': _text(IPv6Interface)},
+            'route_device': {'destination': _text(IPv6Address)},
+            'route_mtu': {'destination': _text(ip_address)},
+            'set_mtu': {'ifname': interface, 'mtu': _integer(IPV6_MIN_MTU, 65535)},
+            'ensure_route': {'prefix': self.__prefix, 'dev': _optional(interface), 'via': _optional(_text(IPv6Address)),
+                             'timeout': _seconds, 'table': _optional(tables)},
+            'ensure_rule': {'source': _text(IPv6Network), 'table': tables, 'priority': priorities},
+            'remove_rules': {'first_priority': priorities, 'last_priority': priorities},
+            'flush_tables': {'first_table': tables, 'last_table': tables},
+            'masquerade': {'ifname': lambda value: self.__masquerade_device(network, value)},
+            'clamp_mss': {'ifname': interface, 'mss': _integer(IPV6_MIN_MTU - IPV6_HEADER - TCP_HEADER, 65535)},
+            'wg_interfaces': {},
+            'wg_config': {'ifname': interface},
+            'wg_set_config': {'ifname': interface, 'config': _wg_config},
+            'wg_set_peers': {'ifname': interface, 'removed': _wg_keys, 'peers': _wg_peers},
+        }
+        if op not in parsers:
+            raise NetConfError(f"Unknown operation {op}")
+        if not isinstance(args, dict):
+            raise NetConfError(f"Arguments of {op} must be an object")
+        unexpected = set(args) - set(parsers[op])
+        if unexpected:
+            raise NetConfError(f"Unexpected arguments to {op}: {', '.join(sorted(unexpected))}")
+        checked = {}
+        for name, value in args.items():
+            try:
+                checked[name] = parsers[op][name](value)
+            except (ValueError, TypeError, KeyError) as e:
+                # Not echoing the value, which may be a private key
+                raise NetConfError(f"Refusing {op}: {name}: {e}") from None
+        return checked
+
+    def __interface(self, value) -> str:
+        if value != self.interface:
+            raise ValueError(f"only {self.interface} is managed by the helper")
+        return value
+
+    def __prefix(self, value) -> str:
+        if not isinstance(value, str) or ip_network(value) != self.nat64_prefix:
+            raise ValueError(f"only routes for {self.nat64_prefix} are managed by the helper")
+        return str(self.nat64_prefix)
+
+    def __masquerade_device(self, network: 'NetConf', value) -> str:
+        # Besides the tunnel, gateways masquerade towards the NAT64 instances (service.py)
+        if value != self.interface and value != network.route_device(self.nat64_prefix.network_address):
+            raise ValueError(f"only {self.interface} and the interface {self.nat64_prefix} is routed through can be masqueraded")
+        return value
+
+def serve(policy: HelperPolicy, stdin=sys.stdin, stdout=sys.stdout, workers: int = 4):
+    """
+    Run NetConf operations read as JSON lines from stdin until it closes (the helper process).
+    Only what `policy` allows is run; other requests get an error back without touching anything.
+
+    Requests run concurrently, each worker thread with its own netlink socket, so a slow one
+    (e.g. waiting for an interface) doesn't hold up the rest. Responses carry the request id
+    and may come back out of order.
+    """
+    local = threading.local()
+    instances: list[NetConf] = []
+    write_lock = threading.Lock()
+
+    def handle(request: dict):
+        try:
+            if request.get('op') not in OPERATIONS:
+                raise NetConfError(f"Unknown operation {request.get('op')}")
+            if not hasattr(local, 'netconf'):
+                local.netconf = NetConf()
+                instances.append(local.netconf)
+            args = policy.check(local.netconf, request['op'], request.get('args', {}))
+            result = getattr(local.netconf, request['op'])(**args)
+            if isinstance(result, list):
+                result = [str(item) for item in result]
+            response = {'id': request.get('id'), 'result': result}
+        except Exception as e:
+            response = {'id': request.get('id'), 'error': f"{type(e).__name__}: {e}"}
+        with write_lock:
+            stdout.write(json.dumps(response) + "\n")
+            stdout.flush()
+
+    # Anything the operations print must not end up in the response stream
+    sys.stdout = sys.stderr
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='netconf') as executor:
+            for line in stdin:
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    with write_lock:
+                        stdout.write(json.dumps({'id': None, 'error': f"Invalid request: {e}"}) + "\n")
+                        stdout.flush()
+                    continue
+                executor.submit(handle, request)
+    finally:
+        sys.stdout = stdout
+        for netconf in instances:
+            netconf.close()
+
+class NetConfClient:
+    """
+    NetConf for unprivileged processes. Starts one privileged helper (`sudo /netconf-helper.sh`)
+    on first use and sends it every operation over a pipe, instead of a sudo fork per change.
+    Calls from several threads are in flight at the same time and matched to their responses by id.
+    """
+
+    def __init__(self, command: list[str] = None):
+        self.__command = command or ["/usr/bin/sudo", HELPER]
+        self.__lock = threading.Lock()
+        self.__process: subprocess.Popen = None
+        self.__ids = itertools.count(1)
+        self.__waiting: dict[int, Future] = {}
+
+    def close(self):
+        with self.__lock:
+            if self.__process:
+                self.__process.stdin.close()
+                self.__process.wait()
+                self.__process = None
+
+    def __start(self):
+        self.__process = subprocess.Popen(self.__command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          text=True, bufsize=1)
+        threading.Thread(target=self.__read, args=(self.__process,), name='netconf-client', daemon=True).start()
+
+    def __read(self, process: subprocess.Popen):
+        for line in process.stdout:
+            response = json.loads(line)
+            with self.__lock:
+                future = self.__waiting.pop(response.get('id'), None)
+            if future is None:
+                continue
+            if 'error' in response:
+                future.set_exception(NetConfError(response['error']))
+            else:
+                future.set_result(response['result'])
+        # The helper exited; fail whatever was still waiting on it
+        with self.__lock:
+            waiting, self.__waiting = self.__waiting, {}
+        for future in waiting.values():
+            future.set_exception(NetConfError("Network helper exited"))
+
+    def __call(self, op: str, **args):
+        with tracing.span(f'netconf.{op}'):
+            return self.__send(op, args).result()
+
+    def __send(self, op: str, args: dict) -> Future:
+        future = Future()
+        with self.__lock:
+            if self.__process is None or self.__process.poll() is not None:
+                self.__start()
+            request_id = next(self.__ids)
+            self.__waiting[request_id] = future
+            self.__process.stdin.write(json.dumps({'id': request_id, 'op': op, 'args': args}) + "\n")
+            self.__process.stdin.flush()
+        return future
+
+    def wait_for_interface(self, ifname: str, timeout: float = 30) -> int:
+        return self.__call('wait_for_interface', ifname=ifname, timeout=timeout)
+
+    def addresses(self, ifname: str) -> list[IPv6Interface]:
+        return [IPv6Interface(address) for address in self.__call('addresses', ifname=ifname)]
+
+    def set_address(self, ifname: str, address: IPv6Interface | str) -> bool:
+        return self.__call('set_address', ifname=ifname, address=str(address))
+
+    def route_device(self, destination: IPv6Address | str) -> str | None:
+        return self.__call('route_device', destination=str(destination))
+
+    def route_mtu(self, destination: IPv4Address | IPv6Address | str) -> int | None:
+        return self.__call('route_mtu', destination=str(destination))
+
+    def set_mtu(self, ifname: str, mtu: int) -> bool:
+        return self.__call('set_mtu', ifname=ifname, mtu=mtu)
+
+    def ensure_route(self, prefix: IPv6Network | str, dev: str = None, via: IPv6Address | str = None,
+                     timeout: float = 60, table: int = None) -> bool:
+        return self.__call('ensure_route', prefix=str(prefix), dev=dev, via=str(via) if via else None, timeout=timeout,
+                           table=table)
+
+    def ensure_rule(self, source: IPv6Network | str, table: int, priority: int) -> bool:
+        return self.__call('ensure_rule', source=str(source), table=table, priority=priority)
+
+    def remove_rules(self, first_priority: int, last_priority: int) -> bool:
+        return self.__call('remove_rules', first_priority=first_priority, last_priority=last_priority)
+
+    def flush_tables(self, first_table: int, last_table: int) -> bool:
+        return self.__call('flush_tables', first_table=first_table, last_table=last_table)
+
+    def masquerade(self, ifname: str) -> bool:
+        return self.__call('masquerade', ifname=ifname)
+
+    def clamp_mss(self, ifname: str, mss: int) -> bool:
+        return self.__call('clamp_mss', ifname=ifname, mss=mss)
+
+    def wg_interfaces(self) -> list[str]:
+        return self.__call('wg_interfaces')
+
+    def wg_config(self, ifname: str) -> dict:
+        return self.__call('wg_config', ifname=ifname)
+
+    def wg_set_config(self, ifname: str, config: dict) -> bool:
+        # Addresses and hooks aren't device settings (netlink ignores them) and the helper refuses them
+        return self.__call('wg_set_config', ifname=ifname,
+                           config={name: value for name, value in config.items() if name in WG_CONFIG_FIELDS})
+
+    def wg_set_peers(self, ifname: str, removed: list[str], peers: list[dict]) -> bool:
+        return self.__call('wg_set_peers', ifname=ifname, removed=removed, peers=peers)
+
+def connect() -> NetConf | NetConfClient:
+    """NetConf in-process when running as root, otherwise through the privileged helper."""
+    return NetConf() if os.geteuid() == 0 else NetConfClient()
+
+def wait_for_device(ifname: str, socket_path: str = None, timeout: float = 60):
+    """
+    Block until the interface exists (on link events) and, if given, its UAPI socket does (on
+    inotify). /setup-wg.sh waits on the device it creates through this rather than polling.
+    """
+    deadline = time.monotonic() + timeout
+    network = NetConf()
+    try:
+        network.wait_for_interface(ifname, timeout=timeout)
+    finally:
+        network.close()
+    if socket_path:
+        from startup import wait_for_path
+        wait_for_path(socket_path, timeout=max(deadline - time.monotonic(), 0))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--serve", action="store_true", help="Run operations sent on stdin (the privileged helper)")
+    mode.add_argument("--wait-for-interface", metavar="IFNAME", help="Wait until the interface exists")
+    parser.add_argument("--socket", metavar="PATH", help="With --wait-for-interface, also wait for this UAPI socket")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    if args.serve:
+        # sudo resets the caller's environment, so these come from the helper script, not the caller
+        serve(HelperPolicy(
+            interface=os.environ.get("WG_INTERFACE", "hetznat64"),
+            nat64_prefix=IPv6Network(os.environ.get("NAT64_PREFIX", "64:ff9b::/96")),
+        ))
+    else:
+        try:
+            wait_for_device(args.wait_for_interface, socket_path=args.socket, timeout=args.timeout)
+        except (NetConfError, TimeoutError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,255 @@
+import os
+import select
+import socket
+import struct
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from ipaddress import IPv6Address
+from typing import Hashable, Iterable, Mapping
+
+from wireguard_tools import WireguardPeer
+
+import tracing
+
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+# Wireguard re-keys every 2 minutes while a tunnel is in use and gives up on a session after 3
+REJECT_AFTER_TIME = 180
+
+@dataclass(frozen=True)
+class Liveness:
+    alive: bool
+
+    # Round trip time in seconds, if the peer was probed and answered
+    rtt: float = None
+
+    # 'handshake' when judged from wireguard stats alone, 'probe' when an echo was sent
+    source: str = 'probe'
+
+class Prober:
+    """
+    Sends ICMPv6 echo requests to many targets at once over a single socket.
+
+    An unprivileged ICMP datagram socket is used when `net.ipv4.ping_group_range` allows it
+    (docker's default), then a raw socket. If neither can be opened the prober falls back to
+    running `ping6` for every target in parallel.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__ident = os.getpid() & 0xFFFF
+        self.__sequence = 0
+        self.__socket = None
+        for kind in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                self.__socket = socket.socket(socket.AF_INET6, kind, socket.IPPROTO_ICMPV6)
+                self.__socket.setblocking(False)
+                break
+            except OSError:
+                continue
+
+    def close(self):
+        if self.__socket:
+            self.__socket.close()
+
+    def probe(self, targets: Iterable[str], timeout: float = 2.0) -> dict[str, float | None]:
+        """Echo every target once, returning the round trip time in seconds (None if it didn't answer)."""
+        targets = list(dict.fromkeys(str(target) for target in targets))
+        if not targets:
+            return {}
+        with tracing.span('icmp.probe', targets=len(targets)) as span:
+            results = self.__probe(targets, timeout)
+            if span is not None:
+                span['answered'] = sum(rtt is not None for rtt in results.values())
+            return results
+
+    def __probe(self, targets: list[str], timeout: float) -> dict[str, float | None]:
+        if not self.__socket:
+            return self.__probe_subprocess(targets, timeout)
+
+        # Only one batch in flight per socket so replies can't be claimed by the wrong caller
+        with self.__lock:
+            results: dict[str, float | None] = dict.fromkeys(targets)
+            outstanding: dict[tuple[IPv6Address, int], tuple[str, float]] = {}
+            for target in targets:
+                self.__sequence = (self.__sequence + 1) & 0xFFFF
+                packet = struct.pack('!BBHHH', ICMPV6_ECHO_REQUEST, 0, 0, self.__ident, self.__sequence)
+                try:
+                    self.__socket.sendto(packet + b'hetznat64', (target, 0))
+                    outstanding[(IPv6Address(target), self.__sequence)] = (target, time.monotonic())
+                except OSError:
+                    pass
+
+            deadline = time.monotonic() + timeout
+            while outstanding:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([self.__socket], [], [], remaining)
+                if not readable:
+                    break
+                while True:
+                    try:
+                        data, address = self.__socket.recvfrom(1024)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    if len(data) < 8:
+                        continue
+                    kind, _, _, _, sequence = struct.unpack('!BBHHH', data[:8])
+                    if kind != ICMPV6_ECHO_REPLY:
+                        continue
+                    sent = outstanding.pop((IPv6Address(address[0].split('%')[0]), sequence), None)
+                    if sent is not None:
+                        target, started = sent
+                        results[target] = time.monotonic() - started
+            return results
+
+    @staticmethod
+    def __probe_subprocess(targets: list[str], timeout: float) -> dict[str, float | None]:
+        started = time.monotonic()
+        processes = {
+            target: subprocess.Popen(["ping6", "-c", "1", "-W", str(max(int(timeout), 1)), target],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for target in targets
+        }
+        return {
+            target: (time.monotonic() - started) if process.wait() == 0 else None
+            for target, process in processes.items()
+        }
+
+class LivenessMonitor:
+    """
+    Decides whether wireguard peers are alive, probing only the ones whose stats can't tell.
+
+    A peer that handshaked within REJECT_AFTER_TIME, or whose rx counter grew since the last
+    check, is alive without sending anything. The rest are echoed in a single batch.
+    """
+
+    def __init__(self, prober: Prober = None, max_handshake_age: float = REJECT_AFTER_TIME):
+        self.__prober = prober or Prober()
+        self.__max_handshake_age = max_handshake_age
+        self.__rx_bytes: dict[Hashable, int] = {}
+
+    @property
+    def prober(self) -> Prober:
+        return self.__prober
+
+    def close(self):
+        self.__prober.close()
+
+    def passive(self, key: Hashable, peer: WireguardPeer, now: float = None) -> bool:
+        """Whether the peer's handshake/transfer stats alone show it is alive."""
+        now = time.time() if now is None else now
+        previous_rx = self.__rx_bytes.get(key)
+        if peer.rx_bytes is not None:
+            self.__rx_bytes[key] = peer.rx_bytes
+        if peer.last_handshake and now - peer.last_handshake < self.__max_handshake_age:
+            return True
+        return previous_rx is not None and peer.rx_bytes is not None and peer.rx_bytes > previous_rx
+
+    def check(self, peers: Mapping[Hashable, WireguardPeer], timeout: float = 2.0) -> dict[Hashable, Liveness]:
+        now = time.time()
+        results: dict[Hashable, Liveness] = {}
+        targets: dict[Hashable, str] = {}
+        for key, peer in peers.items():
+            if self.passive(key, peer, now):
+                results[key] = Liveness(alive=True, source='handshake')
+            elif peer.allowed_ips:
+                targets[key] = str(peer.allowed_ips[0].ip)
+        for key in [key for key in self.__rx_bytes if key not in peers]:
+            del self.__rx_bytes[key]
+
+        rtts = self.__prober.probe(targets.values(), timeout=timeout)
+        for key, target in targets.items():
+            rtt = rtts.get(target)
+            results[key] = Liveness(alive=rtt is not None, rtt=rtt)
+        return results
+
+class BackgroundLiveness:
+    """
+    Runs a LivenessMonitor on its own thread, so a reconcile cycle never waits for echoes.
+
+    `update` hands over the peers to check and returns the results that came in since the
+    last call. New peers are checked right away, the rest again every `interval` seconds.
+    The thread starts with the first update.
+    """
+
+    def __init__(self, monitor: LivenessMonitor = None, timeout: float = 5.0, interval: float = 5.0):
+        self.__monitor = monitor or LivenessMonitor()
+        self.__timeout = timeout
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__peers: dict[Hashable, WireguardPeer] = {}
+        self.__results: dict[Hashable, Liveness] = {}
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def update(self, peers: Mapping[Hashable, WireguardPeer]) -> dict[Hashable, Liveness]:
+        with self.__lock:
+            new = peers.keys() - self.__peers.keys()
+            self.__peers = dict(peers)
+            results = {key: liveness for key, liveness in self.__results.items() if key in peers}
+            self.__results = {}
+            if new:
+                self.__wake.set()
+            if self.__thread is None and peers:
+                self.__thread = threading.Thread(target=self.__run, name='liveness', daemon=True)
+                self.__thread.start()
+        return results
+
+    def close(self):
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread:
+            self.__thread.join(self.__timeout + 1)
+        self.__monitor.close()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__wake.clear()
+            with self.__lock:
+                peers = self.__peers
+            if peers:
+                try:
+                    results = self.__monitor.check(peers, timeout=self.__timeout)
+                except Exception as e:
+                    print(f"Failed to check the liveness of {len(peers)} peers: {e}")
+                    results = {}
+                with self.__lock:
+                    self.__results.update(results)
+            self.__wake.wait(self.__interval)
+
+class Hysteresis:
+    """
+    Debounces a stream of up/down observations: the value only flips after `rise` consecutive
+    observations of up, or `fall` consecutive observations of down.
+    """
+
+    def __init__(self, rise: int = 1, fall: int = 3, initial: bool = False):
+        self.__rise = rise
+        self.__fall = fall
+        self.__value = initial
+        self.__streak = 0
+
+    @property
+    def value(self) -> bool:
+        return self.__value
+
+    @property
+    def pending(self) -> bool:
+        """Whether observations contradicting the current value have been seen."""
+        return self.__streak > 0
+
+    def update(self, up: bool) -> bool:
+        if up == self.__value:
+            self.__streak = 0
+        else:
+            self.__streak += 1
+            if self.__streak >= (self.__rise if up else self.__fall):
+                self.__value = up
+                self.__streak = 0
+        return self.__value
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import hcloud
+
+class TokenBucket:
+    """
+    Thread-safe token bucket mirroring the Hetzner Cloud API request budget.
+
+    Hetzner allows `RateLimit-Limit` requests per hour and refills one token per second. The
+    bucket starts with that default and is re-synced from the `RateLimit-*` headers of every
+    response, so it tracks the real budget even when other clients share the same token.
+    """
+
+    def __init__(self, capacity: int = 3600, refill_rate: float = 1.0):
+        self.__lock = threading.Lock()
+        self.__capacity = capacity
+        self.__refill_rate = refill_rate
+        self.__tokens = float(capacity)
+        self.__updated = time.monotonic()
+        self.__paused_until = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return self.__capacity
+
+    @property
+    def remaining(self) -> float:
+        with self.__lock:
+            self.__refill(time.monotonic())
+            return self.__tokens
+
+    def acquire(self, tokens: int = 1, timeout: float = None) -> bool:
+        """Take `tokens`, waiting for the bucket to refill if needed. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__refill(now)
+                if now >= self.__paused_until and self.__tokens >= tokens:
+                    self.__tokens -= tokens
+                    return True
+                wait = max(self.__paused_until - now, (tokens - self.__tokens) / self.__refill_rate, 0.01)
+            if deadline is not None:
+                if time.monotonic() + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+    def update(self, limit: int, remaining: int, reset: float = None):
+        """Sync the bucket with the API's view of the budget (`reset` is when it is full again, in epoch seconds)."""
+        with self.__lock:
+            self.__capacity = limit
+            self.__tokens = float(min(remaining, limit))
+            self.__updated = time.monotonic()
+            if reset is not None:
+                seconds = reset - time.time()
+                if seconds > 0 and remaining < limit:
+                    self.__refill_rate = (limit - remaining) / seconds
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. after a 429)."""
+        with self.__lock:
+            self.__tokens = 0.0
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+
+    def __refill(self, now: float):
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__refill_rate)
+        self.__updated = now
+
+class RateLimitedClient(hcloud.Client):
+    """hcloud.Client which takes a token from a shared bucket before every request."""
+
+    def __init__(self, *args, bucket: TokenBucket = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket or TokenBucket()
+        self.requests = 0
+        self._requests_session.hooks['response'].append(self.__record)
+
+    def request(self, method: str, url: str, **kwargs) -> dict:
+        self.bucket.acquire()
+        return super().request(method, url, **kwargs)
+
+    def __record(self, response, *args, **kwargs):
+        self.requests += 1
+        headers = response.headers
+        try:
+            if 'RateLimit-Remaining' in headers:
+                self.bucket.update(
+                    limit=int(headers.get('RateLimit-Limit', self.bucket.capacity)),
+                    remaining=int(headers['RateLimit-Remaining']),
+                    reset=float(headers['RateLimit-Reset']) if 'RateLimit-Reset' in headers else None,
+                )
+        except ValueError:
+            pass
+        if response.status_code == 429:
+            # The headers above already drained the bucket; honour Retry-After on top if given
+            retry_after = headers.get('Retry-After', '')
+            self.bucket.pause(int(retry_after) if retry_after.isdigit() else 1)
+        return response
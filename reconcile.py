@@ -0,0 +1,100 @@
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping
+
+from wireguard_tools import WireguardKey, WireguardPeer
+
+import tracing
+from backend import WireguardBackend, select_backend
+
+@dataclass(frozen=True)
+class PeerChanges:
+    added: list[WireguardPeer] = field(default_factory=list)
+    updated: list[WireguardPeer] = field(default_factory=list)
+    removed: list[WireguardKey] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+    def __str__(self):
+        return f"{len(self.added)} added, {len(self.updated)} updated, {len(self.removed)} removed"
+
+def _peer_state(peer: WireguardPeer) -> tuple:
+    """The parts of a peer that are programmed into the device (i.e. not handshake/transfer stats)."""
+    return (
+        str(peer.endpoint_host) if peer.endpoint_host is not None else None,
+        peer.endpoint_port,
+        peer.persistent_keepalive or None,
+        str(peer.preshared_key) if peer.preshared_key else None,
+        frozenset(str(ip) for ip in peer.allowed_ips),
+    )
+
+class PeerReconciler:
+    """
+    Keeps a cached view of a wireguard device's peers and applies only peer-level deltas to it.
+
+    `WireguardDevice.set_config` always replaces every peer, which reprograms unchanged peers and
+    costs time proportional to the size of the config. The reconciler instead diffs the desired
+    peers against its cache and sends add/update/remove operations for just the peers that
+    changed, so a cycle without changes performs no device writes at all.
+    """
+
+    def __init__(self, interface: str, backend: WireguardBackend = None):
+        self.__interface = interface
+        self.__backend = backend or select_backend()
+        self.__peers: dict[WireguardKey, WireguardPeer] = {}
+
+    @property
+    def peers(self) -> Mapping[WireguardKey, WireguardPeer]:
+        """Peers as of the last refresh/apply, including handshake and transfer stats from the last refresh."""
+        return MappingProxyType(self.__peers)
+
+    def refresh(self) -> Mapping[WireguardKey, WireguardPeer]:
+        """Re-read the peers from the device."""
+        with tracing.span('device.get_config', interface=self.__interface) as span:
+            device = self.__backend.device(self.__interface)
+            try:
+                self.__peers = dict(device.get_config().peers)
+            finally:
+                device.close()
+            if span is not None:
+                span['peers'] = len(self.__peers)
+        return self.peers
+
+    def diff(self, desired: Mapping[WireguardKey, WireguardPeer]) -> PeerChanges:
+        changes = PeerChanges()
+        for key, peer in desired.items():
+            current = self.__peers.get(key)
+            if current is None:
+                changes.added.append(peer)
+            elif _peer_state(current) != _peer_state(peer):
+                changes.updated.append(peer)
+        changes.removed.extend(key for key in self.__peers if key not in desired)
+        return changes
+
+    def apply(self, changes: PeerChanges):
+        if not changes:
+            return
+        with tracing.span('device.set_config', interface=self.__interface, added=len(changes.added),
+                          updated=len(changes.updated), removed=len(changes.removed)):
+            self.__backend.set_peers(self.__interface, changes.removed, changes.added + changes.updated)
+
+        for key in changes.removed:
+            self.__peers.pop(key, None)
+        for peer in changes.added:
+            self.__peers[peer.public_key] = peer
+        for peer in changes.updated:
+            previous = self.__peers.get(peer.public_key)
+            if previous is not None:
+                # Reprogramming a peer keeps its session, so it keeps the stats the device reported
+                peer = WireguardPeer.from_dict(peer.asdict())
+                peer.last_handshake = previous.last_handshake
+                peer.rx_bytes = previous.rx_bytes
+                peer.tx_bytes = previous.tx_bytes
+            self.__peers[peer.public_key] = peer
+
+    def reconcile(self, desired: Mapping[WireguardKey, WireguardPeer]) -> PeerChanges:
+        """Bring the device's peers in line with `desired`, returning what was changed."""
+        changes = self.diff(desired)
+        self.apply(changes)
+        return changes
@@ -0,0 +1,199 @@
+from ipaddress import IPv6Address, IPv6Network, ip_address
+from types import MappingProxyType
+from typing import Iterable, Iterator, Mapping
+
+from wireguard_tools import WireguardKey, WireguardPeer
+
+class AddressAllocator:
+    """
+    Hands out one tunnel address per server from a network.
+
+    Each server has a preferred address derived from its id (`network + ((id + 8) mod size)`,
+    which matches the addresses handed out before the allocator existed). When that address is
+    taken by another server the allocator probes forward to the next free one, so two servers
+    never share a tunnel address regardless of the prefix length.
+
+    With `slices` > 1 the network is split into that many equal prefixes and each server gets
+    its address from slice `id mod slices`, so servers can be routed by source prefix (e.g. to
+    one of several NAT64 instances). A single slice gives the same addresses as before.
+    """
+
+    def __init__(self, network: IPv6Network, reserved: Iterable[IPv6Address] = (), slices: int = 1):
+        if slices < 1 or slices & (slices - 1) or slices > network.num_addresses:
+            raise ValueError(f"Address slices must be a power of two that fits {network}, not {slices}")
+        self.__network = network
+        self.__base = int(network.network_address)
+        self.__slices = slices
+        self.__size = network.num_addresses // slices
+        self.__reserved = {network.network_address, *reserved}
+        self.__by_owner: dict[int, IPv6Address] = {}
+        self.__by_address: dict[IPv6Address, int | None] = {}
+
+    @property
+    def network(self) -> IPv6Network:
+        return self.__network
+
+    def __len__(self):
+        return len(self.__by_address)
+
+    @property
+    def allocations(self) -> Mapping[int, IPv6Address]:
+        """Address assigned to each known owner."""
+        return MappingProxyType(self.__by_owner)
+
+    @property
+    def slices(self) -> list[IPv6Network]:
+        return list(self.__network.subnets(prefixlen_diff=self.__slices.bit_length() - 1))
+
+    def preferred(self, owner: int) -> IPv6Address:
+        return IPv6Address(self.__slice_base(owner) + (owner + 8) % self.__size)
+
+    def fits(self, owner: int, address: IPv6Address) -> bool:
+        """Whether `address` lies in the slice `owner` gets its address from."""
+        return address in self.__network and \
+            (int(address) - self.__base) // self.__size == owner % self.__slices
+
+    def owner_of(self, address: IPv6Address) -> int | None:
+        return self.__by_address.get(address)
+
+    def address_of(self, owner: int) -> IPv6Address | None:
+        return self.__by_owner.get(owner)
+
+    def allocate(self, owner: int) -> IPv6Address:
+        """Return the address assigned to `owner`, assigning one if it doesn't have one yet."""
+        if owner in self.__by_owner:
+            return self.__by_owner[owner]
+
+        base = self.__slice_base(owner)
+        offset = (owner + 8) % self.__size
+        # Among n+1 consecutive addresses at least one is free when only n are taken
+        for _ in range(min(len(self.__by_address) + len(self.__reserved) + 1, self.__size)):
+            address = IPv6Address(base + offset)
+            if address not in self.__reserved:
+                holder = self.__by_address.get(address, owner)
+                # Addresses claimed without a known owner (e.g. peers found on the device at
+                # startup) are adopted by the server they would have been derived from
+                if holder == owner or (holder is None and address == self.preferred(owner)):
+                    self.__assign(owner, address)
+                    return address
+            offset = (offset + 1) % self.__size
+        raise ValueError(f"No free addresses left in {self.slices[owner % self.__slices]}")
+
+    def claim(self, address: IPv6Address, owner: int = None) -> bool:
+        """Mark an address that is already in use, returning False if someone else holds it."""
+        if address not in self.__network or address in self.__reserved:
+            return False
+        holder = self.__by_address.get(address)
+        if address in self.__by_address and holder is not None and holder != owner:
+            return False
+        if owner is None:
+            self.__by_address[address] = None
+        else:
+            self.__assign(owner, address)
+        return True
+
+    def release(self, owner: int = None, address: IPv6Address = None):
+        if owner is not None and owner in self.__by_owner:
+            address = self.__by_owner.pop(owner)
+        if address is not None and self.__by_address.get(address) in (owner, None):
+            self.__by_address.pop(address, None)
+
+    def __slice_base(self, owner: int) -> int:
+        return self.__base + (owner % self.__slices) * self.__size
+
+    def __assign(self, owner: int, address: IPv6Address):
+        previous = self.__by_owner.get(owner)
+        if previous is not None and previous != address:
+            self.__by_address.pop(previous, None)
+        self.__by_owner[owner] = address
+        self.__by_address[address] = owner
+
+class PeerRegistry:
+    """
+    Wireguard peers indexed by public key, tunnel address and endpoint address.
+
+    Adding a peer evicts any peer that shares its key, tunnel address or endpoint, which is how
+    the service replaces the tunnel of a server that re-handshakes or was rebuilt. All lookups
+    are dictionary lookups, so reconciling n servers against m peers is O(n + m).
+    """
+
+    def __init__(self, peers: Iterable[WireguardPeer] = ()):
+        self.__peers: dict[WireguardKey, WireguardPeer] = {}
+        self.__owners: dict[WireguardKey, int | None] = {}
+        self.__by_tunnel_ip: dict[IPv6Address, WireguardKey] = {}
+        self.__by_endpoint: dict[str, WireguardKey] = {}
+        for peer in peers:
+            self.add(peer)
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def __iter__(self) -> Iterator[WireguardPeer]:
+        return iter(self.__peers.values())
+
+    def __contains__(self, key: WireguardKey):
+        return key in self.__peers
+
+    @property
+    def peers(self) -> Mapping[WireguardKey, WireguardPeer]:
+        return self.__peers
+
+    def get(self, key: WireguardKey) -> WireguardPeer | None:
+        return self.__peers.get(key)
+
+    def owner(self, key: WireguardKey) -> int | None:
+        return self.__owners.get(key)
+
+    def by_tunnel_ip(self, address: IPv6Address) -> WireguardPeer | None:
+        key = self.__by_tunnel_ip.get(address)
+        return self.__peers.get(key) if key else None
+
+    def by_endpoint(self, host: IPv6Address | str) -> WireguardPeer | None:
+        key = self.__by_endpoint.get(str(host))
+        return self.__peers.get(key) if key else None
+
+    def add(self, peer: WireguardPeer, owner: int = None) -> list[WireguardPeer]:
+        """Add a peer for server `owner`, returning the peers it displaced."""
+        evicted = []
+        for key in {peer.public_key, *self.__tunnel_keys(peer), self.__endpoint_key(peer)}:
+            if key is not None and key in self.__peers:
+                evicted.append(self.remove(key))
+
+        self.__peers[peer.public_key] = peer
+        self.__owners[peer.public_key] = owner
+        for address in self.tunnel_ips(peer):
+            self.__by_tunnel_ip[address] = peer.public_key
+        if peer.endpoint_host is not None:
+            self.__by_endpoint[str(peer.endpoint_host)] = peer.public_key
+        return evicted
+
+    def remove(self, key: WireguardKey) -> WireguardPeer | None:
+        peer = self.__peers.pop(key, None)
+        self.__owners.pop(key, None)
+        if peer is None:
+            return None
+        for address in self.tunnel_ips(peer):
+            if self.__by_tunnel_ip.get(address) == key:
+                del self.__by_tunnel_ip[address]
+        if self.__by_endpoint.get(str(peer.endpoint_host)) == key:
+            del self.__by_endpoint[str(peer.endpoint_host)]
+        return peer
+
+    def remove_tunnel_ip(self, address: IPv6Address) -> WireguardPeer | None:
+        key = self.__by_tunnel_ip.get(address)
+        return self.remove(key) if key else None
+
+    def remove_endpoint(self, host: IPv6Address | str) -> WireguardPeer | None:
+        key = self.__by_endpoint.get(str(host))
+        return self.remove(key) if key else None
+
+    @staticmethod
+    def tunnel_ips(peer: WireguardPeer) -> list[IPv6Address]:
+        """Host addresses routed to the peer (its /128 allowed ips)."""
+        return [ip_address(ip.ip) for ip in peer.allowed_ips if ip.network.num_addresses == 1]
+
+    def __tunnel_keys(self, peer: WireguardPeer) -> list[WireguardKey]:
+        return [self.__by_tunnel_ip.get(address) for address in self.tunnel_ips(peer)]
+
+    def __endpoint_key(self, peer: WireguardPeer) -> WireguardKey | None:
+        return self.__by_endpoint.get(str(peer.endpoint_host)) if peer.endpoint_host is not None else None
@@ -0,0 +1,45 @@
+import socket
+import threading
+import time
+
+class CachedResolver:
+    """
+    getaddrinfo with a per-hostname cache.
+
+    Successful lookups are reused for `ttl` seconds and failures for `negative_ttl`, so a
+    burst of handshakes resolves the control server once. The system resolver doesn't tell
+    us the record's real TTL, so a fixed one is used.
+    """
+
+    def __init__(self, ttl: float = 60, negative_ttl: float = 5):
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__lock = threading.Lock()
+        self.__cache: dict[tuple[str, int], tuple[float, str | None]] = {}
+
+    def resolve(self, hostname: str, family: int = socket.AF_INET6) -> str | None:
+        """The first address of `family` for `hostname`, or None if it doesn't resolve."""
+        now = time.monotonic()
+        with self.__lock:
+            cached = self.__cache.get((hostname, family))
+        if cached and cached[0] > now:
+            return cached[1]
+
+        try:
+            address = socket.getaddrinfo(hostname, None, family)[0][4][0]
+            expires = now + self.__ttl
+        except socket.gaierror as e:
+            print(f"Failed to resolve {hostname}: {e}")
+            address = None
+            expires = now + self.__negative_ttl
+        with self.__lock:
+            self.__cache[(hostname, family)] = (expires, address)
+        return address
+
+    def invalidate(self, hostname: str = None):
+        with self.__lock:
+            if hostname is None:
+                self.__cache.clear()
+            else:
+                for key in [key for key in self.__cache if key[0] == hostname]:
+                    del self.__cache[key]
@@ -1,13 +1,36 @@
+import json
 import os
+import socket
 import time
-import requests
-import subprocess
-import hcloud
-from ipaddress import ip_interface, IPv4Interface, IPv6Interface
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_interface, IPv4Interface, IPv6Address, IPv6Interface
 from dataclasses import dataclass
 
-from hcloud.servers import BoundServer
-from wireguard_tools import WireguardConfig, WireguardDevice, WireguardKey, WireguardPeer
+from wireguard_tools import WireguardConfig, WireguardKey, WireguardPeer
+
+import backend as wireguard_backend
+import metrics
+import mtu
+import nat64pool
+import netconf
+import tracing
+import unbound
+from discovery import AdaptiveInterval, Discovery
+from handshake import HandshakeClient, HandshakeRequest
+from httpapi import ControlAPI, HTTPResponse
+from labels import update_labels
+from lifecycle import PeerLifecycle
+from prober import BackgroundLiveness
+from ratelimit import RateLimitedClient
+from reconcile import PeerReconciler
+from registry import AddressAllocator, PeerRegistry
+from sharding import GatewayMembership, HashRing, gateway_interface
+from startup import Startup, setup_wireguard
+from state import ServiceState, StateStore
+from status import ServerStatus, StatusBoard
+from usage import UsageSampler, UsageTracker
 
 @dataclass
 class WireguardServerConfig:
@@ -39,6 +62,13 @@ class Hetznat64Config:
   # Interval in seconds at which the service should poll the Hetzner Cloud API
   poll_interval: int = 5
 
+  # Longest interval in seconds the service backs off to while nothing changes
+  max_poll_interval: int = 60
+
+  # Servers requested per page, and pages fetched in parallel, when listing servers
+  page_size: int = 50
+  page_concurrency: int = 4
+
   # Path to the CA certificate
   ca_file: str = None
 
@@ -48,13 +78,173 @@ class Hetznat64Config:
   # Path to the server's key
   key_file: str = None
 
+  # Maximum number of agent handshakes in flight at once
+  handshake_concurrency: int = 32
+
+  # Seconds each agent gets to answer a handshake before it is skipped for the cycle
+  handshake_timeout: float = 10
+
+  # Seconds to wait before handshaking again with a server that is still waiting
+  handshake_retry_interval: int = 30
+
+  # URL of an agent's handshake endpoint, {host} is replaced with the agent's address
+  agent_url: str = "https://[{host}]:5001/handshake"
+
+  # Port for the HTTP API serving /metrics and /usage (0 to disable it)
+  metrics_port: int = 9464
+
+  # Seconds between samples of the peers' transfer counters, and samples kept per peer
+  usage_interval: float = 10
+  usage_history: int = 360
+
+  # File to keep the key, peers and address allocations in across restarts (None to disable)
+  state_file: str = None
+
+  # Seconds before evicting peers whose server left the inventory, that never handshaked, or
+  # whose last handshake is this old; and the most peers evicted per cycle
+  gc_orphan_grace: float = 600
+  gc_unconfirmed_grace: float = 900
+  gc_stale_grace: float = 3600
+  gc_batch_size: int = 100
+
+  # This gateway's id and every gateway splitting the fleet with it (empty for a single gateway)
+  gateway_id: str = None
+  gateways: tuple[str, ...] = ()
+  gateway_check_interval: float = 5
+
+  # Host agents connect their tunnel to (None for the control server they are configured with)
+  gateway_endpoint: str = None
+
+  # Address to probe the path MTU to, e.g. the NAT64 gateway behind the tunnel (None to disable)
+  mtu_probe_target: str = None
+  mtu_probe_interval: float = 300
+
+  # NAT64 (tayga) instances the NAT64 prefix is routed through, and source slices of the tunnel
+  # network spread across them (see nat64pool.route)
+  nat64_instances: tuple[nat64pool.Nat64Instance, ...] = ()
+  nat64_slices: int = 1
+
+  # Seconds between reads of the NAT64 instances' mappings
+  nat64_pool_interval: float = 30
+
+  # URL of the DNS64 resolver's stats (its scraper's /stats endpoint, None to disable) and
+  # seconds between reads
+  dns64_stats_url: str = None
+  dns64_stats_interval: float = 30
+
+  # File to write trace spans to as JSON lines (None to disable tracing)
+  trace_file: str = None
+
+  # Cycles longer than this many seconds get the next cycle profiled into profile_dir (None to disable)
+  slow_cycle_threshold: float = None
+  profile_dir: str = "/var/lib/hetznat64/profiles"
+
 
 class Hetznat64Service:
-  def __init__(self, config: Hetznat64Config):
+  def __init__(self, config: Hetznat64Config, backend: wireguard_backend.WireguardBackend = None):
     self.__config = config
-    self.__hcloud = hcloud.Client(token=config.api_key, api_endpoint=config.api_endpoint)
+    self.__backend = backend or wireguard_backend.select_backend()
+    self.__hcloud = RateLimitedClient(token=config.api_key, api_endpoint=config.api_endpoint)
+    self.__discovery = Discovery(
+      self.__hcloud,
+      label_selector=self.__status_label,
+      page_size=config.page_size,
+      concurrency=config.page_concurrency,
+    )
+    self.__interval = AdaptiveInterval(config.poll_interval, config.max_poll_interval)
+    # Servers that were handshaked while waiting, and when to try them again
+    self.__retries: dict[int, float] = {}
+    # Why the last handshake with each server failed, for the status snapshot
+    self.__handshake_errors: dict[int, str] = {}
+    # Servers restored with an address outside their slice (the slice layout changed), and that
+    # old address, held until a new handshake moves them
+    self.__relocating: dict[int, IPv6Address] = {}
     self.__server = None
-
+    self.__handshakes = HandshakeClient(
+      cert_file=config.cert_file,
+      key_file=config.key_file,
+      ca_file=config.ca_file,
+      concurrency=config.handshake_concurrency,
+      timeout=config.handshake_timeout,
+      url=config.agent_url,
+    )
+    self.__peers = PeerReconciler(config.wireguard.name, backend=self.__backend)
+    self.__registry: PeerRegistry = None
+    self.__addresses = AddressAllocator(config.wireguard.ip.network, reserved=[config.wireguard.ip.ip],
+                                        slices=config.nat64_slices)
+    self.__liveness = BackgroundLiveness(timeout=5, interval=config.poll_interval)
+    self.__lifecycle = PeerLifecycle(
+      orphan_grace=config.gc_orphan_grace,
+      unconfirmed_grace=config.gc_unconfirmed_grace,
+      stale_grace=config.gc_stale_grace,
+      batch_size=config.gc_batch_size,
+    )
+    self.__store = StateStore(config.state_file) if config.state_file else None
+    snapshot = self.__store.load() if self.__store else None
+    if snapshot:
+      self.__restore(snapshot)
+    self.__api = ControlAPI(port=config.metrics_port)
+    self.__usage = UsageTracker(capacity=config.usage_history)
+    self.__usage_sampler = UsageSampler(
+      config.wireguard.name,
+      self.__usage,
+      interval=config.usage_interval,
+      owner=lambda key: self.__registry.owner(key) if self.__registry else None,
+      backend=self.__backend,
+    )
+    self.__membership = GatewayMembership(
+      config.gateway_id,
+      list(config.gateways),
+      port=config.metrics_port,
+      interval=config.gateway_check_interval,
+    ) if config.gateways else None
+    self.__ring: HashRing = None
+    self.__label_executor = ThreadPoolExecutor(max_workers=config.page_concurrency, thread_name_prefix='labels')
+    self.__mtu_probe = mtu.PathMTUProbe(config.mtu_probe_target, interval=config.mtu_probe_interval)
+    self.__dns64 = unbound.StatsScraper(
+      lambda: unbound.fetch_stats(config.dns64_stats_url), interval=config.dns64_stats_interval,
+    ) if config.dns64_stats_url else None
+    self.__nat64_pools = nat64pool.PoolMonitor(list(config.nat64_instances), interval=config.nat64_pool_interval)
+    if config.trace_file:
+      tracing.configure(config.trace_file)
+    self.__slow_cycles = tracing.SlowCycleProfiler(
+      config.slow_cycle_threshold, config.profile_dir,
+    ) if config.slow_cycle_threshold else None
+    self.__status = StatusBoard()
+    self.__api.route('/metrics', self.__metrics)
+    self.__api.route('/health', self.__health)
+    self.__api.route('/gateway', self.__gateway)
+    self.__api.route('/usage/top', self.__top_talkers)
+    self.__api.route('/usage/servers', self.__server_usage)
+    self.__api.route('/status', self.__status.serve_json)
+    self.__api.route('/status.html', self.__status.serve_html)
+    # This instance's collectors, served by /metrics next to the process-wide metrics
+    self.__collectors = metrics.instance_registry()
+    metrics.register(metrics.ApiBudgetCollector(self.__hcloud), self.__collectors)
+    metrics.register(metrics.PeerStatsCollector(self.__peer_stats), self.__collectors)
+    if self.__dns64:
+      metrics.register(metrics.ResolverStatsCollector(self.__dns64), self.__collectors)
+
+  @property
+  def __status_label(self) -> str:
+    return f'{self.__config.discovery_label_prefix}.status'
+
+  @property
+  def __gateway_label(self) -> str:
+    return f'{self.__config.discovery_label_prefix}.gateway'
+
+  @property
+  def public_key(self) -> WireguardKey:
+    return self.__config.wireguard.key.public_key()
+
+  @property
+  def api_budget(self) -> dict:
+    """Remaining Hetzner API requests in the current rate-limit window."""
+    return {
+      'remaining': int(self.__hcloud.bucket.remaining),
+      'limit': self.__hcloud.bucket.capacity,
+      'requests': self.__hcloud.requests,
+    }
 
   def start(self):
     print("Starting Hetznat64 service with config:")
@@ -66,159 +256,525 @@ class Hetznat64Service:
         listen_port=self.__config.wireguard.port,
         addresses=addresses,
       )
-
-      self.__server = WireguardDevice.get(interface)
+      if self.__registry is not None:
+        # Peers restored from the state file go straight back on the device, so agents keep
+        # their tunnels without a new handshake
+        for peer in self.__registry:
+          config.add_peer(peer)
+        print(f"Restored {len(self.__registry)} peers from {self.__store.path}")
+
+      self.__server = self.__backend.device(interface)
       print(interface, self.__server)
       print('getting devices')
       self.__server.set_config(config)
-      for dev in WireguardDevice.list():
+      for dev in self.__backend.devices():
         print("getting config for device", dev.interface)
         print(dev.get_config().to_wgconfig(wgquick_format=True))
       print('got devices')
 
+    if self.__config.metrics_port:
+      self.__api.start()
+    if self.__membership:
+      # Know who else is up before the first cycle, so this gateway doesn't claim their servers
+      self.__membership.check()
+      self.__membership.start()
+    if self.__config.usage_interval:
+      self.__usage_sampler.start()
+    if self.__config.mtu_probe_target and self.__config.mtu_probe_interval:
+      self.__mtu_probe.start()
+    if self.__dns64:
+      self.__dns64.start()
+    if len(self.__nat64_pools):
+      self.__nat64_pools.start()
+
     while True:
-      self.poll()
-      time.sleep(self.__config.poll_interval)
+      try:
+        changed = self.poll()
+      except Exception as e:
+        # e.g. the API is unavailable or rate limited; back off and try again
+        print(f"Poll failed: {e}")
+        metrics.POLL_FAILURES.inc()
+        changed = False
+      delay = self.__interval.next(changed)
+      if self.__retries:
+        # Don't back off past the next handshake retry
+        until_retry = min(self.__retries.values()) - time.monotonic()
+        delay = min(delay, max(until_retry, self.__config.poll_interval))
+      time.sleep(delay)
 
   def stop(self):
-    self.__server.close()
-
-  def poll(self):
-    label = f'{self.__config.discovery_label_prefix}.status=waiting'
-    servers: list[BoundServer] = []
-    index = 1
-    while True:
-      page = self.__hcloud.servers.get_list(label_selector=label, page=index)
-      index += 1
-      servers.extend(page.servers)
-      if not page.meta.pagination.next_page:
-        break
-
-    device = WireguardDevice.get(self.__config.wireguard.name)
-    config = device.get_config()
-    config.addresses = [self.__config.wireguard.ip]
-    config.private_key = self.__config.wireguard.key
-    oldconfig = config.to_wgconfig(wgquick_format=True)
+    self.__api.stop()
+    self.__usage_sampler.stop()
+    self.__mtu_probe.stop()
+    if self.__dns64:
+      self.__dns64.stop()
+    self.__nat64_pools.stop()
+    if self.__membership:
+      self.__membership.stop()
+    self.__label_executor.shutdown(wait=False)
+    self.__discovery.close()
+    self.__handshakes.close()
+    self.__liveness.close()
+    if self.__server:
+      self.__server.close()
+
+  def poll(self) -> bool:
+    """Run one reconcile cycle, returning whether anything changed."""
+    profile = self.__slow_cycles.cycle() if self.__slow_cycles else nullcontext()
+    start = time.perf_counter()
+    with profile, metrics.POLL_DURATION.time(), tracing.span('cycle'):
+      try:
+        changed = self.__poll()
+      except Exception as e:
+        self.__publish_status(time.perf_counter() - start, error=str(e))
+        raise
+      self.__publish_status(time.perf_counter() - start, changed=changed)
+      return changed
+
+  def __poll(self) -> bool:
+    with metrics.phase('discovery'):
+      delta = self.__discovery.poll()
+    if delta:
+      print(f"Inventory: {delta}")
+    for server in delta.removed:
+      print(f"Server {server.id} is no longer labelled for discovery")
+
+    # With several gateways, every one of them only serves the servers the ring gives it. When
+    # the ring changes, every server may have a new owner, so look at all of them again
+    ring = self.__membership.ring if self.__membership else None
+    ring_changed = ring is not self.__ring
+    self.__ring = ring
+    candidates = list(self.__discovery.inventory) if ring is not None and ring_changed else delta.added + delta.changed
+    served = {self.__registry.owner(key) for key in self.__registry.peers} if self.__registry else set()
+
+    # Handshake with servers that started waiting (or whose address changed while waiting) or
+    # moved here from another gateway, and retry the ones still waiting after their last handshake
+    now = time.monotonic()
+    waiting = {server.id: server for server in candidates if self.__wants_handshake(server, ring, served)}
+    for server_id, retry_at in list(self.__retries.items()):
+      server = self.__discovery.inventory.get(server_id)
+      if not server or not self.__wants_handshake(server, ring, served):
+        del self.__retries[server_id]
+      elif server_id not in waiting and retry_at <= now:
+        waiting[server_id] = server
+    servers = list(waiting.values())
     for server in servers:
-      server_id = (server.id + 8) & 0xFFFFFFFF
-      network = self.__config.wireguard.ip.network
-      ipv6 = f"{network[0].exploded[:-9]}{(server_id >> 16) & 0xFFFF:04x}:{server_id & 0xFFFF:04x}"
-      peer_ip = IPv6Interface(ipv6)
-
-      # Delete any peers with the same wireguard ip
-      peer_key = next((p for p in config.peers.keys() if peer_ip in config.peers[p].allowed_ips), None)
-      if peer_key:
-        config.del_peer(peer_key)
-
-      # Delete any peers with the same endpoint ip
+      self.__retries[server.id] = now + self.__config.handshake_retry_interval
+
+    # One device read per cycle; peer changes are diffed against it instead of re-reading the config
+    with metrics.phase('refresh'):
+      device_peers = self.__peers.refresh()
+    seeded = self.__registry is None
+    if seeded:
+      # Adopt whatever is already on the device so existing tunnels keep their addresses
+      self.__registry = PeerRegistry(device_peers.values())
+      for peer in self.__registry:
+        for address in PeerRegistry.tunnel_ips(peer):
+          self.__addresses.claim(address)
+
+    if ring is not None:
+      self.__hand_over(ring)
+
+    pending: list[HandshakeRequest] = []
+    for server in servers:
+      peer_ip = IPv6Interface(f"{self.__addresses.allocate(server.id)}/128")
       endpoint_host = IPv6Interface(server.public_net.ipv6.ip).ip
-      endpoint_peers = [p for p in config.peers.keys() if str(config.peers[p].endpoint_host) == str(endpoint_host)]
-      for peer_key in endpoint_peers:
-        config.del_peer(peer_key)
 
       # Services on hetzner servers with a ::/64 address will actually be listening on ::1
       if endpoint_host.exploded.endswith(":0000"):
           endpoint_host = IPv6Interface(endpoint_host.exploded[:-2] + "1").ip
+
+      # Delete any peers with the same wireguard ip or endpoint ip
+      self.__registry.remove_tunnel_ip(peer_ip.ip)
+      self.__registry.remove_endpoint(endpoint_host)
+
       print(f"Server {server.id} with IP {endpoint_host} is waiting for handshake (peer ip: {peer_ip})")
-      try:
-          response = requests.post(
-              f"https://[{endpoint_host}]:5001/handshake",
-              json={
-                  'control_ip': str(self.__config.wireguard.ip),
-                  'control_port': self.__config.wireguard.port,
-                  'public_key': str(self.__config.wireguard.key.public_key()),
-                  'agent_ip': str(peer_ip),
-              },
-              timeout=10,
-              cert=(self.__config.cert_file, self.__config.key_file),
-              verify=self.__config.ca_file,
-          )
-          if response.status_code == 200:
-              data = response.json()
-              public_key = data['public_key']
-              endpoint_port = data['port']
-          else:
-              print(f"Handshake failed with status {response.status_code}")
-              continue
-      except Exception as e:
-          print(f"Failed to connect to agent: {e}")
-          continue
-      config.add_peer(WireguardPeer(
-        public_key=public_key,
+      pending.append(HandshakeRequest(
+        server_id=server.id,
         endpoint_host=endpoint_host,
-        endpoint_port=endpoint_port,
+        payload={
+          'control_ip': str(self.__config.wireguard.ip),
+          'control_port': self.__config.wireguard.port,
+          'public_key': str(self.__config.wireguard.key.public_key()),
+          'agent_ip': str(peer_ip),
+          **({'control_host': self.__config.gateway_endpoint} if self.__config.gateway_endpoint else {}),
+        },
+      ))
+
+    with metrics.phase('handshake'):
+      results = self.__handshakes.handshake_all(pending)
+    for result in results:
+      metrics.HANDSHAKE_DURATION.labels('success' if result.ok else 'failure').observe(result.duration)
+      if not result.ok:
+        metrics.HANDSHAKE_FAILURES.inc()
+        print(f"Server {result.request.server_id}: {result.error}")
+        self.__handshake_errors[result.request.server_id] = result.error
+        continue
+      self.__handshake_errors.pop(result.request.server_id, None)
+      self.__end_relocation(result.request.server_id)
+      self.__registry.add(WireguardPeer(
+        public_key=result.public_key,
+        endpoint_host=result.request.endpoint_host,
+        endpoint_port=result.port,
         persistent_keepalive=25,
-        allowed_ips=[ipv6],
-      ));
-
-    if oldconfig != config.to_wgconfig(wgquick_format=True):
-      print(config.to_wgconfig(wgquick_format=True))
-      WireguardDevice.get(self.__config.wireguard.name).set_config(config)
-
-    updated = WireguardDevice.get(self.__config.wireguard.name).get_config()
-    for peer in updated.peers.values():
-      if not peer.last_handshake:
-        try:
-          ping_result = subprocess.run(
-            ["ping6", "-c", "1", "-W", "5", str(peer.allowed_ips[0].ip)],
-            capture_output=True
-          )
-          if ping_result.returncode == 0:
-            print(f"Ping to {peer.allowed_ips[0].ip} succeeded")
-          else:
-            print(f"Ping to {peer.allowed_ips[0].ip} failed")
-        except Exception as e:
-          print(f"Ping process failed for {peer.allowed_ips[0].ip}: {e}")
+        allowed_ips=[f"{self.__addresses.address_of(result.request.server_id)}/128"],
+      ), owner=result.request.server_id)
+
+    if ring is not None:
+      self.__claim(ring)
+
+    # Drop peers of servers that are gone or whose tunnels are dead, so the device (and every
+    # refresh, save and probe) only carries the live fleet
+    with metrics.phase('gc'):
+      evictions = self.__lifecycle.collect(
+        self.__registry.peers, self.__registry.owner, self.__discovery.inventory, stats=device_peers,
+      )
+    for eviction in evictions:
+      self.__registry.remove(eviction.key)
+      if eviction.owner is not None and eviction.owner not in self.__discovery.inventory:
+        self.__addresses.release(owner=eviction.owner)
+        self.__end_relocation(eviction.owner)
+        self.__usage.forget(eviction.owner)
+      metrics.PEER_EVICTIONS.labels(eviction.reason).inc()
+    if evictions:
+      reasons = Counter(eviction.reason for eviction in evictions)
+      print(f"Evicted {len(evictions)} peers: {', '.join(f'{count} {reason}' for reason, count in sorted(reasons.items()))}")
+
+    with metrics.phase('reconcile'):
+      changes = self.__peers.reconcile(self.__registry.peers)
+    metrics.PEERS.set(len(self.__peers.peers))
+    for change, peers in (('added', changes.added), ('updated', changes.updated), ('removed', changes.removed)):
+      if peers:
+        metrics.PEER_CHANGES.labels(change).inc(len(peers))
+    if changes:
+      print(f"Updated peers: {changes}")
     else:
       print("No changes to the config")
 
+    # Peers that never handshaked get an echo so wireguard initiates the tunnel from our side;
+    # they are probed in the background and the cycle reports whatever answers came in since
+    unconfirmed = {key: peer for key, peer in self.__peers.peers.items() if not peer.last_handshake and peer.allowed_ips}
+    if self.__store and (seeded or servers or changes):
+      self.__save()
+
+    with metrics.phase('probe'):
+      liveness_results = self.__liveness.update(unconfirmed)
+    for key, liveness in liveness_results.items():
+      ping_ip = unconfirmed[key].allowed_ips[0].ip
+      if liveness.rtt is not None:
+        print(f"Ping to {ping_ip} succeeded ({liveness.rtt * 1000:.1f} ms)")
+      elif liveness.alive:
+        print(f"Peer {ping_ip} is receiving traffic")
+      else:
+        print(f"Ping to {ping_ip} failed")
+
+    return bool(delta or servers or changes or (ring is not None and ring_changed))
+
+  def __restore(self, snapshot: ServiceState):
+    # Keep the key agents already have as their peer, so their tunnels survive the restart
+    self.__config.wireguard.key = snapshot.private_key
+    self.__registry = PeerRegistry()
+    for peer, owner in snapshot.peers:
+      self.__registry.add(peer, owner=owner)
+      for address in PeerRegistry.tunnel_ips(peer):
+        if owner is not None and address in self.__addresses.network and not self.__addresses.fits(owner, address):
+          # Saved under another slice layout: the tunnel keeps its old address (held without an
+          # owner so nobody else gets it) until a handshake moves the server into its slice
+          self.__addresses.claim(address)
+          self.__relocating[owner] = address
+        else:
+          self.__addresses.claim(address, owner)
+    for owner, address in snapshot.allocations.items():
+      if self.__addresses.fits(owner, address):
+        self.__addresses.claim(address, owner)
+    if self.__relocating:
+      print(f"Moving {len(self.__relocating)} servers to the address slice of their NAT64 instance")
+
+  def __save(self):
+    try:
+      self.__store.save(ServiceState(
+        private_key=self.__config.wireguard.key,
+        peers=[(peer, self.__registry.owner(peer.public_key)) for peer in self.__registry],
+        allocations=dict(self.__addresses.allocations),
+      ))
+    except OSError as e:
+      print(f"Failed to save state to {self.__store.path}: {e}")
+
+  def __metrics(self, request) -> HTTPResponse:
+    body, content_type = metrics.exposition(self.__collectors)
+    return HTTPResponse(body=body, content_type=content_type)
+
+  def __health(self, request) -> HTTPResponse:
+    return HTTPResponse(body=json.dumps({
+      'status': 'ok',
+      'peers': len(self.__registry) if self.__registry is not None else 0,
+      'api_budget': self.api_budget,
+      'path_mtu': self.__mtu_probe.as_dict(),
+      'dns64': self.__dns64.as_dict() if self.__dns64 else None,
+      'nat64': self.__nat64_pools.as_dict() if len(self.__nat64_pools) else None,
+    }).encode())
+
+  def __publish_status(self, duration: float, changed: bool = False, error: str = None):
+    """Publish the fleet as of this cycle for /status, from state the cycle already holds."""
+    try:
+      with metrics.phase('status'):
+        self.__build_status(duration, changed, error)
+    except Exception as e:
+      print(f"Failed to publish the status snapshot: {e}")
+
+  def __build_status(self, duration: float, changed: bool, error: str):
+    now = time.time()
+    inventory = self.__discovery.inventory
+    device_peers = self.__peers.peers
+    usage = {usage.key: usage for usage in self.__usage.usage(window=60)}
+    for server_id in [server_id for server_id in self.__handshake_errors if server_id not in inventory]:
+      del self.__handshake_errors[server_id]
+
+    servers: list[ServerStatus] = []
+    listed = set()
+    for key, peer in (self.__registry.peers.items() if self.__registry is not None else ()):
+      owner = self.__registry.owner(key)
+      server = inventory.get(owner) if owner is not None else None
+      stats = device_peers.get(key)
+      last_handshake = stats.last_handshake if stats else None
+      peer_usage = usage.get(str(key))
+      listed.add(owner)
+      servers.append(ServerStatus(
+        server=owner,
+        name=server.name if server else None,
+        state=(server.labels or {}).get(self.__status_label) if server else None,
+        gateway=(server.labels or {}).get(self.__gateway_label) if server else None,
+        public_key=str(key),
+        tunnel_ip=', '.join(str(address) for address in PeerRegistry.tunnel_ips(peer)),
+        endpoint=str(peer.endpoint_host) if peer.endpoint_host is not None else None,
+        last_handshake=last_handshake or None,
+        handshake_age=max(now - last_handshake, 0) if last_handshake else None,
+        rx_rate=peer_usage.rx_rate if peer_usage else None,
+        tx_rate=peer_usage.tx_rate if peer_usage else None,
+        rx_total=peer_usage.rx_total if peer_usage else None,
+        tx_total=peer_usage.tx_total if peer_usage else None,
+        last_error=self.__handshake_errors.get(owner),
+      ))
+    # Servers without a peer here: still waiting for (or failing) their handshake
+    ring = self.__ring
+    for server in inventory:
+      if server.id in listed or not self.__owns(server, ring):
+        continue
+      servers.append(ServerStatus(
+        server=server.id,
+        name=server.name,
+        state=(server.labels or {}).get(self.__status_label),
+        gateway=(server.labels or {}).get(self.__gateway_label),
+        last_error=self.__handshake_errors.get(server.id),
+      ))
+    servers.sort(key=lambda status: (status.server is None, status.server or 0))
+
+    members = list(ring.members) if ring is not None else []
+    self.__status.publish(
+      servers,
+      gateway={
+        'id': self.__config.gateway_id,
+        'endpoint': self.__config.gateway_endpoint,
+        'members': members,
+        'down': [gateway for gateway in self.__config.gateways if gateway not in members],
+      },
+      cycle={
+        'duration': round(duration, 3),
+        'changed': changed,
+        'error': error,
+        'poll_interval': self.__interval.current,
+      },
+      health={
+        'peers': len(device_peers),
+        'api_budget': self.api_budget,
+        'path_mtu': self.__mtu_probe.as_dict(),
+        'dns64': self.__dns64.as_dict() if self.__dns64 else None,
+        'nat64': self.__nat64_pools.as_dict() if len(self.__nat64_pools) else None,
+      },
+      generated=now,
+    )
+
+  def __top_talkers(self, request) -> HTTPResponse:
+    count = int(request.query.get('n', ['10'])[0])
+    window = float(request.query.get('window', ['60'])[0])
+    talkers = self.__usage.top_talkers(count, window)
+    return HTTPResponse(body=json.dumps([usage.as_dict() for usage in talkers]).encode())
+
+  def __server_usage(self, request) -> HTTPResponse:
+    totals = [
+      {'server': server, 'rx_total': rx, 'tx_total': tx}
+      for server, (rx, tx) in sorted(self.__usage.server_totals().items(), key=lambda item: -sum(item[1]))
+    ]
+    return HTTPResponse(body=json.dumps(totals).encode())
+
+  def __peer_stats(self):
+    # Stats as of the last refresh; scrapes never read the device themselves
+    for key, peer in list(self.__peers.peers.items()):
+      owner = self.__registry.owner(key) if self.__registry else None
+      yield {'public_key': str(key), 'server': '' if owner is None else str(owner)}, peer
+
+  def __is_waiting(self, server) -> bool:
+    return (server.labels or {}).get(self.__status_label) == 'waiting'
+
+  def __owns(self, server, ring: HashRing) -> bool:
+    return ring is None or ring.owner(server.id) == self.__config.gateway_id
+
+  def __wants_handshake(self, server, ring: HashRing, served: set[int]) -> bool:
+    if not self.__owns(server, ring):
+      return False
+    if self.__is_waiting(server) or server.id in self.__relocating:
+      return True
+    # A connected server the ring moved here from another gateway: take its tunnel over
+    return ring is not None and server.id not in served and \
+      (server.labels or {}).get(self.__gateway_label) != self.__config.gateway_id
+
+  def __end_relocation(self, owner: int):
+    """Let go of the old address of a server that moved slices (or left)."""
+    address = self.__relocating.pop(owner, None)
+    if address is not None:
+      self.__addresses.release(address=address)
+
+  def __hand_over(self, ring: HashRing):
+    """
+    Drop the peers of servers the ring gave to another gateway, once that gateway has taken them
+    over (its label is on the server). Until then this gateway keeps serving them, so a server
+    whose new gateway can't reach it doesn't lose its tunnel.
+    """
+    for key in list(self.__registry.peers):
+      server = self.__discovery.inventory.get(self.__registry.owner(key))
+      if server is None or self.__owns(server, ring):
+        continue
+      holder = (server.labels or {}).get(self.__gateway_label)
+      if holder and holder != self.__config.gateway_id:
+        print(f"Server {server.id} was handed over to gateway {holder}")
+        self.__registry.remove(key)
+        self.__addresses.release(owner=server.id)
+        self.__end_relocation(server.id)
+        self.__usage.forget(server.id)
+        self.__retries.pop(server.id, None)
+
+  def __claim(self, ring: HashRing):
+    """Record this gateway in the label of every server it serves that doesn't carry it yet."""
+    served = {self.__registry.owner(key) for key in self.__registry.peers}
+    unclaimed = [
+      server for server in self.__discovery.inventory
+      if server.id in served and self.__owns(server, ring)
+      and (server.labels or {}).get(self.__gateway_label) != self.__config.gateway_id
+    ]
+    for server, error in zip(unclaimed, self.__label_executor.map(self.__label_gateway, unclaimed)):
+      if error:
+        print(f"Failed to label server {server.id} with gateway {self.__config.gateway_id}: {error}")
+
+  def __label_gateway(self, server) -> Exception | None:
+    # Only the gateway label is ours; the agent writes the status label at any time, so merge
+    # into the server's labels as they are now rather than as the cycle listed them
+    try:
+      update_labels(self.__hcloud, server.id, {self.__gateway_label: self.__config.gateway_id})
+      return None
+    except Exception as e:
+      return e
+
+  def __gateway(self, request) -> HTTPResponse:
+    return HTTPResponse(body=json.dumps({
+      'id': self.__config.gateway_id,
+      'endpoint': self.__config.gateway_endpoint,
+      'members': list(self.__membership.ring.members) if self.__membership else [],
+    }).encode())
+
 
 
 if __name__ == "__main__":
+  network = netconf.connect()
+  backend = wireguard_backend.from_environment(network=network)
   interface = os.environ.get("WG_INTERFACE", "hetznat64")
   ipv6 = os.environ.get("WG_IPV6", "fd00:6464::1/64")
   port = os.environ.get("WG_PORT", "51820")
-  try:
-    device = WireguardDevice.get(interface)
-    wgconf = device.get_config()
-  except Exception as e:
-    print(f"Wireguard interface {interface} not found, creating it")
-    subprocess.Popen([
-      "/usr/bin/sudo",
-      "/setup-wg.sh",
-      "--name", interface,
-      "--port", port,
-      "--ip6", ipv6,
-      "--ip4", os.environ.get("WG_IPV4", "10.0.0.1/24"),
-    ])
-    while True:
-      time.sleep(1)
-      try:
-        device = WireguardDevice.get(interface)
-        wgconf = device.get_config()
-        break
-      except Exception as e:
-        print(f"Wireguard interface {interface} not found, retrying...")
-
-  # set the wireguard interface to the ipv6 address
-  subprocess.run(["/usr/bin/sudo", "/update-ip.sh", str(ip_interface(ipv6))], check=True)
-
-  # set the nat64 interface to the ipv6 address
   nat64_prefix = os.environ.get("NAT64_PREFIX", "64:ff9b::/96")
   nat64_ipv6 = os.environ.get("NAT64_IPV6", "fd00:6464:64:ff9b::64")
-  subprocess.run(["/usr/bin/sudo", "/setup-nat64.sh", "--prefix", nat64_prefix, "--via", nat64_ipv6], check=True)
-
-  wgkey = WireguardKey.generate()
-  service = Hetznat64Service(
-    Hetznat64Config(
-      wireguard=WireguardServerConfig(name=interface, ip=ip_interface(ipv6), port=port, key=wgkey),
-      discovery_label_prefix=os.environ.get("DISCOVERY_LABEL_PREFIX", 'hetznat64'),
-      api_endpoint=os.environ.get("HCLOUD_API_ENDPOINT", 'https://api.hetzner.cloud/v1'),
-      api_key=os.environ["HCLOUD_API_TOKEN"],
-      cert_file=os.environ["CERT_FILE"],
-      key_file=os.environ["KEY_FILE"],
-      ca_file=os.environ["CA_FILE"],
+  # One instance at NAT64_IPV6 unless several are listed
+  nat64_instances = nat64pool.parse_instances(os.environ.get("NAT64_INSTANCES") or " ".join(
+    filter(None, [nat64_ipv6, os.environ.get("NAT64_POOL", "10.64.64.0/22"), os.environ.get("NAT64_DATA_DIR")])
+  ))
+  nat64_slices = int(os.environ.get("NAT64_SLICES") or nat64pool.slice_count(len(nat64_instances)))
+  tunnel_mtu = int(os.environ["WG_MTU"]) if os.environ.get("WG_MTU") else None
+  gateways = tuple(gateway for gateway in os.environ.get("GATEWAYS", "").split(",") if gateway)
+  gateway_id = os.environ.get("GATEWAY_ID", socket.gethostname())
+  if gateways:
+    # Each gateway tunnels from its own slice of the network, so their addresses never collide
+    ipv6 = str(gateway_interface(ip_interface(ipv6), gateway_id, list(gateways), int(os.environ.get("ADDRESS_SLICES", 16))))
+    print(f"Gateway {gateway_id} of {', '.join(gateways)}, tunnel address {ipv6}")
+
+  def setup_device():
+    device = setup_wireguard(interface, network, backend, port=port, ip6=ipv6,
+                             ip4=os.environ.get("WG_IPV4", "10.0.0.1/24"))
+    device.close()
+
+  def setup_address():
+    # set the wireguard interface to the ipv6 address
+    network.set_address(interface, ip_interface(ipv6))
+    network.masquerade(interface)
+
+  def setup_nat64_route():
+    nat64pool.route(network, nat64_prefix, ip_interface(ipv6).network, nat64_instances, nat64_slices)
+    if gateways:
+      # The NAT64 gateway only routes the whole network back to one gateway; masquerading makes
+      # replies to every other gateway's slice come back to the gateway that sent them
+      for device in {network.route_device(instance.address) for instance in nat64_instances}:
+        network.masquerade(device)
+
+  def create_service():
+    return Hetznat64Service(
+      Hetznat64Config(
+        wireguard=WireguardServerConfig(name=interface, ip=ip_interface(ipv6), port=port, key=WireguardKey.generate()),
+        discovery_label_prefix=os.environ.get("DISCOVERY_LABEL_PREFIX", 'hetznat64'),
+        api_endpoint=os.environ.get("HCLOUD_API_ENDPOINT", 'https://api.hetzner.cloud/v1'),
+        api_key=os.environ["HCLOUD_API_TOKEN"],
+        cert_file=os.environ["CERT_FILE"],
+        key_file=os.environ["KEY_FILE"],
+        ca_file=os.environ["CA_FILE"],
+        handshake_concurrency=int(os.environ.get("HANDSHAKE_CONCURRENCY", 32)),
+        handshake_timeout=float(os.environ.get("HANDSHAKE_TIMEOUT", 10)),
+        handshake_retry_interval=int(os.environ.get("HANDSHAKE_RETRY_INTERVAL", 30)),
+        poll_interval=int(os.environ.get("POLL_INTERVAL", 5)),
+        max_poll_interval=int(os.environ.get("MAX_POLL_INTERVAL", 60)),
+        metrics_port=int(os.environ.get("METRICS_PORT", 9464)),
+        usage_interval=float(os.environ.get("USAGE_INTERVAL", 10)),
+        usage_history=int(os.environ.get("USAGE_HISTORY", 360)),
+        state_file=os.environ.get("STATE_FILE", "/var/lib/hetznat64/state.json") or None,
+        gc_orphan_grace=float(os.environ.get("GC_ORPHAN_GRACE", 600)),
+        gc_unconfirmed_grace=float(os.environ.get("GC_UNCONFIRMED_GRACE", 900)),
+        gc_stale_grace=float(os.environ.get("GC_STALE_GRACE", 3600)),
+        gc_batch_size=int(os.environ.get("GC_BATCH_SIZE", 100)),
+        gateway_id=gateway_id if gateways else None,
+        gateways=gateways,
+        gateway_check_interval=float(os.environ.get("GATEWAY_CHECK_INTERVAL", 5)),
+        gateway_endpoint=os.environ.get("GATEWAY_ENDPOINT") or (gateway_id if gateways else None),
+        mtu_probe_target=os.environ.get("MTU_PROBE_TARGET", str(nat64_instances[0].address)) or None,
+        mtu_probe_interval=float(os.environ.get("MTU_PROBE_INTERVAL", 300)),
+        nat64_instances=tuple(nat64_instances),
+        nat64_slices=nat64_slices,
+        nat64_pool_interval=float(os.environ.get("NAT64_POOL_INTERVAL", 30)),
+        dns64_stats_url=os.environ.get("DNS64_STATS_URL") or None,
+        dns64_stats_interval=float(os.environ.get("DNS64_STATS_INTERVAL", 30)),
+        trace_file=os.environ.get("TRACE_FILE") or None,
+        slow_cycle_threshold=float(os.environ["SLOW_CYCLE_THRESHOLD"]) if os.environ.get("SLOW_CYCLE_THRESHOLD") else None,
+        profile_dir=os.environ.get("PROFILE_DIR", "/var/lib/hetznat64/profiles"),
+      ),
+      backend=backend,
     )
-  )
-  print(f'Starting service on port {port} with key {wgkey.public_key()}')
+
+  # The device, the nat64 route (via another interface) and the service's own setup don't
+  # depend on each other, so they run side by side
+  print(f"Wireguard backend: {backend.describe()}")
+  startup = Startup()
+  startup.step('wireguard', setup_device)
+  startup.step('address', setup_address, after=('wireguard',))
+  startup.step('mtu', lambda: mtu.tune(network, interface, tunnel=tunnel_mtu), after=('wireguard',))
+  startup.step('nat64-route', setup_nat64_route)
+  startup.step('service', create_service)
+  service = startup.run()['service']
+  print(startup.timeline.report())
+  startup.timeline.export()
+
+  print(f'Starting service on port {port} with key {service.public_key}')
   service.start()
@@ -17,6 +17,18 @@ while [[ $# -gt 0 ]]; do
 			WG_INTERFACE="$2"
 			shift 2
 			;;
+		--backend)
+			WG_BACKEND="$2"
+			shift 2
+			;;
+		--threads)
+			WG_THREADS="$2"
+			shift 2
+			;;
+		--multi-queue)
+			WG_MULTI_QUEUE="$2"
+			shift 2
+			;;
 		*)
 			echo "Unknown argument: $1"
 			exit 1
@@ -45,50 +57,47 @@ if [ -z "${WG_PORT}" ]; then
 	exit 1
 fi
 
+if [ -z "${WG_BACKEND}" ]; then
+	WG_BACKEND=boringtun
+fi
+
+if [ -z "${WG_THREADS}" ]; then
+	WG_THREADS=$(nproc)
+fi
+
 mkdir -p /config
 touch /config/wireguard.conf
 chown wireguard:wireguard /config/wireguard.conf
 
-# Setup boringtun interface and start
-if [ -f /usr/local/bin/boringtun ]; then
-	printf "Starting Wireguard userspace (boringtun)\n";
+# Setup the kernel or boringtun interface and start
+if [ "${WG_BACKEND}" = "kernel" ]; then
+	printf "Starting Wireguard kernel module\n";
+	ip link add dev ${WG_INTERFACE} type wireguard || exit 1;
+elif [ -f /usr/local/bin/boringtun ]; then
+	printf "Starting Wireguard userspace (boringtun) with ${WG_THREADS} threads\n";
 	mkdir -p /dev/net;
-	mknod /dev/net/tun c 10 200;
+	[ -c /dev/net/tun ] || mknod /dev/net/tun c 10 200;
 	chown wireguard:wireguard /dev/net/tun;
-	/usr/local/bin/boringtun -f ${WG_INTERFACE} --disable-multi-queue &
+	if [ "${WG_MULTI_QUEUE}" = "0" ]; then
+		/usr/local/bin/boringtun -f ${WG_INTERFACE} --threads ${WG_THREADS} --disable-multi-queue &
+	else
+		/usr/local/bin/boringtun -f ${WG_INTERFACE} --threads ${WG_THREADS} &
+	fi
 	wireguard_pid=$!;
 else
 	printf "WARNING: Wireguard binary not found. This container will not run\n";
 	exit 1;
 fi
 
-# Add a sleep for any Wireguard intialization slowness
-while true; do
-	output=$(wg show ${WG_INTERFACE} 2>&1)
-	case "$output" in
-		*"Protocol not supported"*|*"No such device"*)
-			printf "Startup error: protocol not supported: sleeping...\n"
-			sleep 1
-			;;
-		*)
-			break
-			;;
-	esac
-done
-
-# Wait for wireguard socket to be created
-while true; do
-	output=$(chown wireguard:wireguard -R /var/run/wireguard 2>&1)
-	case "$output" in
-		*"No such file or directory"*)
-			printf "Startup error: no such file or directory: sleeping...\n"
-			sleep 1
-			;;
-		*)
-			break
-			;;
-	esac
-done
+# Wait for the interface on netlink link events and, for boringtun, its UAPI socket on inotify
+# (the kernel is configured over netlink), then hand the socket to the unprivileged user
+if [ "${WG_BACKEND}" = "kernel" ]; then
+	/usr/local/bin/python3 /app/netconf.py --wait-for-interface ${WG_INTERFACE} || exit 1;
+else
+	/usr/local/bin/python3 /app/netconf.py --wait-for-interface ${WG_INTERFACE} \
+		--socket /var/run/wireguard/${WG_INTERFACE}.sock || exit 1;
+	chown wireguard:wireguard -R /var/run/wireguard;
+fi
 
 # Extract containers default gateway interface (usually eth0)
 read _ _ _ _ iface < <(ip route show default);
@@ -115,7 +124,8 @@ if [ -f /config/iptables.sh ]; then
 	source /config/iptables.sh;
 fi
 
-# Set MTU lower than the default 1500 accounting for wg overhead
+# Set MTU lower than the default 1500 accounting for wg overhead; the service and agent
+# resize it for the actual underlay path once they start
 mtuout=$(ip link set mtu 1420 qlen 1000 dev ${WG_INTERFACE})
 # printf "Setting network interface mtu... $mtuout\n";
 
@@ -142,4 +152,6 @@ printf "Bringing interface up... $ipup\n";
 # printf "${nl}IPv4 connectivity validation:\n" && /bin/ping -4 -q -c 1 ipv4.google.com;
 printf "${nl}Running....\n"
 
-wait $wireguard_pid
+if [ -n "${wireguard_pid}" ]; then
+	wait $wireguard_pid
+fi
@@ -0,0 +1,143 @@
+import bisect
+import hashlib
+import json
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv6Interface, IPv6Network
+from typing import Iterable
+
+from prober import Hysteresis
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    """
+    Consistent hashing of servers onto gateways.
+
+    Every gateway is placed on the ring at `replicas` points and a server belongs to the first
+    gateway point at or after its own hash. When a gateway joins or leaves, only the servers
+    between its points and their neighbours change owner (about 1/n of the fleet) and every
+    other server stays where it is.
+    """
+
+    def __init__(self, members: Iterable[str] = (), replicas: int = 64):
+        self.__members = tuple(sorted(set(members)))
+        points = sorted((_hash(f"{member}#{replica}"), member)
+                        for member in self.__members for replica in range(replicas))
+        self.__hashes = [point for point, _ in points]
+        self.__owners = [member for _, member in points]
+
+    @property
+    def members(self) -> tuple[str, ...]:
+        return self.__members
+
+    def __len__(self):
+        return len(self.__members)
+
+    def owner(self, key) -> str | None:
+        if not self.__hashes:
+            return None
+        index = bisect.bisect_left(self.__hashes, _hash(str(key)))
+        return self.__owners[index % len(self.__owners)]
+
+def address_slice(network: IPv6Network, index: int, slices: int) -> IPv6Network:
+    """The `index`-th of `slices` equal parts of `network` (`slices` must be a power of two)."""
+    if slices < 1 or slices & (slices - 1):
+        raise ValueError(f"Address slices must be a power of two, not {slices}")
+    if not 0 <= index < slices:
+        raise ValueError(f"Slice {index} out of range for {slices} slices")
+    return list(network.subnets(prefixlen_diff=slices.bit_length() - 1))[index] if slices > 1 else network
+
+def gateway_interface(network: IPv6Interface, gateway_id: str, gateways: list[str], slices: int) -> IPv6Interface:
+    """
+    The tunnel address of a gateway: the first host of its own slice of `network`.
+
+    Slices are assigned by the gateway's position in the configured list rather than the live
+    members, so a gateway keeps its addresses (and its agents their tunnels) while others come
+    and go.
+    """
+    if gateway_id not in gateways:
+        raise ValueError(f"Gateway {gateway_id} is not one of {', '.join(gateways)}")
+    if len(gateways) > slices:
+        raise ValueError(f"{len(gateways)} gateways don't fit in {slices} address slices")
+    subnet = address_slice(network.network, gateways.index(gateway_id), slices)
+    return IPv6Interface(f"{subnet[1]}/{subnet.prefixlen}")
+
+class GatewayMembership:
+    """
+    Which of the configured gateways are up, and the hash ring over them.
+
+    Every gateway serves `/gateway` on its control API (on `port` unless the gateway is given as
+    host:port); the others are checked every `interval` seconds, in parallel. A gateway leaves
+    the ring after `fail_threshold` failed checks in a row, so a single slow answer doesn't move
+    its servers, and rejoins on its first success.
+    """
+
+    def __init__(self, gateway_id: str, gateways: list[str], port: int = 9464, interval: float = 5,
+                 fail_threshold: int = 3, timeout: float = 2):
+        self.__id = gateway_id
+        self.__others = [gateway for gateway in gateways if gateway != gateway_id]
+        self.__port = port
+        self.__interval = interval
+        self.__timeout = timeout
+        self.__lock = threading.Lock()
+        self.__health = {gateway: Hysteresis(rise=1, fall=fail_threshold) for gateway in self.__others}
+        self.__ring = HashRing([gateway_id])
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__executor = ThreadPoolExecutor(max_workers=max(len(self.__others), 1), thread_name_prefix='membership')
+
+    @property
+    def gateway_id(self) -> str:
+        return self.__id
+
+    @property
+    def ring(self) -> HashRing:
+        with self.__lock:
+            return self.__ring
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='membership', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def check(self) -> bool:
+        """Check every other gateway once, returning whether the ring changed."""
+        results = dict(zip(self.__others, self.__executor.map(self.__alive, self.__others)))
+        live = [self.__id] + [gateway for gateway, alive in results.items() if self.__health[gateway].update(alive)]
+        with self.__lock:
+            if tuple(sorted(live)) == self.__ring.members:
+                return False
+            previous, self.__ring = self.__ring.members, HashRing(live)
+        joined = sorted(set(live) - set(previous))
+        left = sorted(set(previous) - set(live))
+        print(f"Gateways: {', '.join(sorted(live))}"
+              + (f" (joined: {', '.join(joined)})" if joined else "") + (f" (left: {', '.join(left)})" if left else ""))
+        return True
+
+    def __url(self, gateway: str) -> str:
+        # Gateways are hostnames or addresses, optionally with the port of their control API
+        if gateway.startswith('[') or gateway.count(':') == 1:
+            return f"http://{gateway}/gateway"
+        host = f"[{gateway}]" if ':' in gateway else gateway
+        return f"http://{host}:{self.__port}/gateway"
+
+    def __alive(self, gateway: str) -> bool:
+        try:
+            with urllib.request.urlopen(self.__url(gateway), timeout=self.__timeout) as response:
+                return json.loads(response.read()).get('id') == gateway
+        except Exception:
+            return False
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Failed to check gateways: {e}")
+            self.__stop.wait(self.__interval)
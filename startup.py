@@ -0,0 +1,217 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from wireguard_tools import WireguardDevice
+
+import metrics
+from backend import BoringtunBackend, WireguardBackend
+
+WG_UAPI_SOCKET_DIR = "/var/run/wireguard"
+
+# inotify events that can make a missing path appear
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+@dataclass(frozen=True)
+class Phase:
+    name: str
+    start: float
+    end: float
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+class Timeline:
+    """Start and end of each startup phase, relative to when the timeline was created."""
+
+    def __init__(self):
+        self.__origin = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__phases: list[Phase] = []
+
+    @property
+    def phases(self) -> list[Phase]:
+        with self.__lock:
+            return sorted(self.__phases, key=lambda phase: phase.start)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.__origin
+
+    @contextmanager
+    def phase(self, name: str):
+        start = self.elapsed
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__phases.append(Phase(name, start, self.elapsed))
+
+    def report(self) -> str:
+        lines = [f"Startup took {self.elapsed * 1000:.0f} ms:"]
+        for phase in self.phases:
+            lines.append(f"  {phase.name:<16} {phase.start * 1000:7.0f} ms -> {phase.end * 1000:7.0f} ms"
+                         f" ({phase.duration * 1000:.0f} ms)")
+        return "\n".join(lines)
+
+    def export(self):
+        """Publish the phase durations as metrics."""
+        for phase in self.phases:
+            metrics.STARTUP_PHASE_DURATION.labels(phase.name).set(phase.duration)
+
+class Startup:
+    """
+    Runs startup steps as soon as the steps they depend on are done, independent ones in
+    parallel, recording each one on a Timeline.
+    """
+
+    def __init__(self, timeline: Timeline = None):
+        self.timeline = timeline or Timeline()
+        self.__steps: dict[str, tuple[Callable[[], Any], tuple[str, ...]]] = {}
+
+    def step(self, name: str, run: Callable[[], Any], after: tuple[str, ...] = ()):
+        for dependency in after:
+            if dependency not in self.__steps:
+                raise ValueError(f"Step {name} depends on unknown step {dependency}")
+        self.__steps[name] = (run, tuple(after))
+
+    def run(self) -> dict[str, Any]:
+        """Run every step, returning their results by name. The first failure is raised once running steps finish."""
+        results: dict[str, Any] = {}
+        futures: dict[Future, str] = {}
+        pending = dict(self.__steps)
+        with ThreadPoolExecutor(max_workers=max(len(pending), 1), thread_name_prefix='startup') as executor:
+            while pending or futures:
+                for name, (run, after) in list(pending.items()):
+                    if all(dependency in results for dependency in after):
+                        del pending[name]
+                        futures[executor.submit(self.__run_step, name, run)] = name
+                if not futures:
+                    raise RuntimeError(f"Startup steps {', '.join(pending)} can never run")
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = futures.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        wait(futures)
+                        raise error
+                    results[name] = future.result()
+        return results
+
+    def __run_step(self, name: str, run: Callable[[], Any]):
+        with self.timeline.phase(name):
+            return run()
+
+class _Inotify:
+    """Just enough inotify to sleep until something is created in a directory."""
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, path: str):
+        if self.__libc.inotify_add_watch(self.fd, path.encode(), IN_CREATE | IN_MOVED_TO) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {path} failed")
+
+    def wait(self, timeout: float):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+def wait_for_path(path: str, timeout: float = 30):
+    """Block until `path` exists, woken by inotify (polling only where inotify is unavailable)."""
+    deadline = time.monotonic() + timeout
+    try:
+        watcher = _Inotify()
+    except (OSError, AttributeError, TypeError):
+        watcher = None
+    try:
+        while True:
+            if watcher:
+                # Watch the deepest directory that exists; when it gains a child, look again
+                parent = os.path.dirname(os.path.abspath(path))
+                while not os.path.isdir(parent):
+                    parent = os.path.dirname(parent)
+                watcher.watch(parent)
+            if os.path.exists(path):
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out waiting for {path}")
+            if watcher:
+                watcher.wait(remaining)
+            else:
+                time.sleep(min(0.05, remaining))
+    finally:
+        if watcher:
+            watcher.close()
+
+def _open_device(backend: WireguardBackend, interface: str) -> WireguardDevice:
+    # Netlink and helper devices open fine whether or not the link exists; reading the config
+    # is what fails for a missing device
+    device = backend.device(interface)
+    try:
+        device.get_config()
+    except Exception:
+        device.close()
+        raise
+    return device
+
+def wait_for_wireguard(interface: str, network, backend: WireguardBackend, timeout: float = 60) -> WireguardDevice:
+    """
+    Block until the wireguard device can be configured: the link exists (netlink) and, for a
+    userspace implementation, its UAPI socket is up and accessible.
+    """
+    deadline = time.monotonic() + timeout
+    network.wait_for_interface(interface, timeout=timeout)
+    socket_path = os.path.join(WG_UAPI_SOCKET_DIR, f"{interface}.sock")
+    delay = 0.005
+    while True:
+        try:
+            return _open_device(backend, interface)
+        except Exception:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
+            if isinstance(backend, BoringtunBackend) and not os.path.exists(socket_path):
+                try:
+                    wait_for_path(socket_path, timeout=min(remaining, 1.0))
+                    continue
+                except TimeoutError:
+                    pass
+            # The device exists but isn't accepting (or accessible) yet, e.g. a kernel device
+            # still registering with generic netlink
+            time.sleep(min(delay, max(remaining, 0)))
+            delay = min(delay * 2, 0.1)
+
+def setup_wireguard(interface: str, network, backend: WireguardBackend, port: int | str, ip6: str, ip4: str,
+                    timeout: float = 60) -> WireguardDevice:
+    """Return the wireguard device, creating it through the backend if it doesn't exist yet."""
+    try:
+        return _open_device(backend, interface)
+    except Exception:
+        print(f"Wireguard interface {interface} not found, creating it")
+    command = backend.setup_command(interface, port, ip6, ip4)
+    if command is None:
+        return backend.create(interface)
+    subprocess.Popen(command)
+    return wait_for_wireguard(interface, network, backend, timeout=timeout)
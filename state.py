@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+from dataclasses import dataclass, field
+from ipaddress import IPv6Address
+
+from wireguard_tools import WireguardKey, WireguardPeer
+
+STATE_VERSION = 1
+
+@dataclass
+class ServiceState:
+    # The service's wireguard key, which every agent has as its peer's public key
+    private_key: WireguardKey
+
+    # Peers on the device, with the id of the server each belongs to (None if unknown)
+    peers: list[tuple[WireguardPeer, int | None]] = field(default_factory=list)
+
+    # Tunnel address assigned to each server id
+    allocations: dict[int, IPv6Address] = field(default_factory=dict)
+
+def _dump_peer(peer: WireguardPeer, owner: int | None) -> dict:
+    data = {
+        'key': str(peer.public_key),
+        'server': owner,
+        'endpoint': [str(peer.endpoint_host), peer.endpoint_port] if peer.endpoint_host is not None else None,
+        'allowed_ips': [str(ip) for ip in peer.allowed_ips],
+    }
+    if peer.persistent_keepalive:
+        data['keepalive'] = peer.persistent_keepalive
+    if peer.preshared_key:
+        data['psk'] = str(peer.preshared_key)
+    return data
+
+def _load_peer(data: dict) -> tuple[WireguardPeer, int | None]:
+    endpoint = data.get('endpoint')
+    peer = WireguardPeer(
+        public_key=data['key'],
+        preshared_key=data.get('psk'),
+        endpoint_host=endpoint[0] if endpoint else None,
+        endpoint_port=endpoint[1] if endpoint else None,
+        persistent_keepalive=data.get('keepalive'),
+        allowed_ips=data['allowed_ips'],
+    )
+    return peer, data.get('server')
+
+class StateStore:
+    """
+    Keeps a ServiceState in a small JSON file.
+
+    Writes go to a temporary file in the same directory which is fsynced and renamed over the
+    snapshot, so a crash leaves either the old or the new state on disk, never a torn file.
+    Saving a state identical to the one on disk is a no-op, so it can be called every cycle.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__last: bytes = None
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def load(self) -> ServiceState | None:
+        try:
+            with open(self.__path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            data = json.loads(raw)
+            if data.get('version') != STATE_VERSION:
+                print(f"Ignoring state in {self.__path} with unsupported version {data.get('version')}")
+                return None
+            state = ServiceState(
+                private_key=WireguardKey(data['private_key']),
+                peers=[_load_peer(peer) for peer in data.get('peers', [])],
+                allocations={int(owner): IPv6Address(address) for owner, address in data.get('allocations', {}).items()},
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable state in {self.__path}: {e}")
+            return None
+        self.__last = raw
+        return state
+
+    def save(self, state: ServiceState) -> bool:
+        """Write the state if it differs from what's on disk, returning whether it was written."""
+        raw = json.dumps({
+            'version': STATE_VERSION,
+            'private_key': str(state.private_key),
+            'peers': [_dump_peer(peer, owner) for peer, owner in state.peers],
+            'allocations': {str(owner): str(address) for owner, address in sorted(state.allocations.items())},
+        }, separators=(',', ':')).encode()
+        if raw == self.__last:
+            return False
+
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix='.state-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temporary, 0o600)
+            os.replace(temporary, self.__path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        # Make the rename itself durable
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        self.__last = raw
+        return True
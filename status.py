@@ -0,0 +1,194 @@
+import hashlib
+import html
+import json
+import time
+from dataclasses import dataclass, field
+
+from httpapi import HTTPRequest, HTTPResponse
+
+@dataclass(frozen=True)
+class ServerStatus:
+    # Hetzner server id (None for a peer whose server left the inventory) and name
+    server: int | None
+    name: str = None
+
+    # Discovery status label ('waiting', 'connected', ...) and the gateway serving it
+    state: str = None
+    gateway: str = None
+
+    # The server's peer on the device, if it has one
+    public_key: str = None
+    tunnel_ip: str = None
+    endpoint: str = None
+
+    # Unix time of the peer's last handshake, and its age when the snapshot was taken
+    last_handshake: float = None
+    handshake_age: float = None
+
+    # Bytes per second over the last minute, and bytes since the service started sampling
+    rx_rate: float = None
+    tx_rate: float = None
+    rx_total: int = None
+    tx_total: int = None
+
+    # Why the last handshake with the server's agent failed (None if it didn't)
+    last_error: str = None
+
+    def as_dict(self) -> dict:
+        return {
+            'server': self.server,
+            'name': self.name,
+            'state': self.state,
+            'gateway': self.gateway,
+            'public_key': self.public_key,
+            'tunnel_ip': self.tunnel_ip,
+            'endpoint': self.endpoint,
+            'last_handshake': self.last_handshake,
+            'handshake_age': None if self.handshake_age is None else round(self.handshake_age, 1),
+            'rx_rate': None if self.rx_rate is None else round(self.rx_rate, 1),
+            'tx_rate': None if self.tx_rate is None else round(self.tx_rate, 1),
+            'rx_total': self.rx_total,
+            'tx_total': self.tx_total,
+            'last_error': self.last_error,
+        }
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Fleet state as of one reconcile cycle, with its JSON and HTML renderings computed once when
+    it is published. Never modified afterwards, so any number of requests can share it.
+    """
+
+    version: int
+    generated: float
+    servers: tuple[ServerStatus, ...]
+    gateway: dict
+    cycle: dict
+    health: dict
+    body: bytes = field(repr=False)
+    page: bytes = field(repr=False)
+    etag: str
+
+    def as_dict(self) -> dict:
+        return {
+            'version': self.version,
+            'generated': self.generated,
+            'gateway': self.gateway,
+            'cycle': self.cycle,
+            'health': self.health,
+            'servers': [server.as_dict() for server in self.servers],
+        }
+
+def _format_rate(rate: float | None) -> str:
+    if rate is None:
+        return ''
+    for unit in ('B/s', 'kB/s', 'MB/s'):
+        if rate < 1000:
+            return f"{rate:.0f} {unit}"
+        rate /= 1000
+    return f"{rate:.1f} GB/s"
+
+def _format_age(age: float | None) -> str:
+    if age is None:
+        return 'never'
+    if age < 120:
+        return f"{age:.0f}s"
+    if age < 7200:
+        return f"{age / 60:.0f}m"
+    return f"{age / 3600:.0f}h"
+
+def render_page(snapshot: dict) -> str:
+    """A plain HTML table of the snapshot, for a browser rather than a dashboard."""
+    rows = "".join(
+        "<tr>" + "".join(f"<td>{html.escape(str(value))}</td>" for value in (
+            '' if server['server'] is None else server['server'], server['name'] or '', server['state'] or '',
+            server['tunnel_ip'] or '', server['endpoint'] or '', _format_age(server['handshake_age']),
+            _format_rate(server['rx_rate']), _format_rate(server['tx_rate']), server['last_error'] or '',
+        )) + "</tr>"
+        for server in snapshot['servers']
+    )
+    gateway = snapshot['gateway']
+    cycle = snapshot['cycle']
+    generated = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(snapshot['generated']))
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta http-equiv="refresh" content="10"><title>hetznat64 status</title>
+<style>body{{font-family:sans-serif}}table{{border-collapse:collapse}}td,th{{padding:2px 8px;text-align:left;border-bottom:1px solid #ddd}}</style>
+</head><body>
+<h1>hetznat64 {html.escape(gateway.get('id') or '')}</h1>
+<p>Snapshot {snapshot['version']} taken {generated} UTC after a {cycle.get('duration', 0):.2f}s cycle{
+    html.escape(f" that failed: {cycle['error']}") if cycle.get('error') else ''}.
+Gateways up: {html.escape(', '.join(gateway.get('members', [])) or 'this one only')}{
+    html.escape(f"; down: {', '.join(gateway['down'])}") if gateway.get('down') else ''}.</p>
+<table><tr><th>Server</th><th>Name</th><th>State</th><th>Tunnel IP</th><th>Endpoint</th><th>Handshake</th>
+<th>Rx</th><th>Tx</th><th>Last error</th></tr>
+{rows}
+</table></body></html>
+"""
+
+class StatusBoard:
+    """
+    Serves the latest published Snapshot as `/status` (JSON) and `/status.html`.
+
+    The reconcile loop publishes a new snapshot after each cycle; handlers only pick up the
+    current one and return its precomputed bytes, or 304 when the client's If-None-Match names
+    its ETag. Serving never reads the device or calls the Hetzner API.
+    """
+
+    def __init__(self):
+        self.__version = 0
+        self.__snapshot: Snapshot = None
+
+    @property
+    def snapshot(self) -> Snapshot | None:
+        return self.__snapshot
+
+    def publish(self, servers: list[ServerStatus], gateway: dict, cycle: dict, health: dict,
+                generated: float = None) -> Snapshot:
+        self.__version += 1
+        content = {
+            'version': self.__version,
+            'generated': time.time() if generated is None else generated,
+            'gateway': gateway,
+            'cycle': cycle,
+            'health': health,
+            'servers': [server.as_dict() for server in servers],
+        }
+        body = json.dumps(content, default=str).encode()
+        snapshot = Snapshot(
+            version=content['version'],
+            generated=content['generated'],
+            servers=tuple(servers),
+            gateway=gateway,
+            cycle=cycle,
+            health=health,
+            body=body,
+            page=render_page(content).encode(),
+            etag=f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"',
+        )
+        # Swapping the reference is atomic; requests hold on to whichever snapshot they picked up
+        self.__snapshot = snapshot
+        return snapshot
+
+    def serve_json(self, request: HTTPRequest) -> HTTPResponse:
+        return self.__serve(request, lambda snapshot: snapshot.body, 'application/json')
+
+    def serve_html(self, request: HTTPRequest) -> HTTPResponse:
+        return self.__serve(request, lambda snapshot: snapshot.page, 'text/html; charset=utf-8')
+
+    def __serve(self, request: HTTPRequest, payload, content_type: str) -> HTTPResponse:
+        snapshot = self.__snapshot
+        if snapshot is None:
+            return HTTPResponse(status=503, body=b'{"detail":"No reconcile cycle has finished yet"}',
+                                headers={'Retry-After': '5'})
+        # The JSON and HTML renderings of a snapshot differ, so they get their own tags
+        etag = snapshot.etag if content_type == 'application/json' else f'{snapshot.etag[:-1]}-html"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'X-Snapshot-Version': str(snapshot.version)}
+        if _matches(request.headers.get('If-None-Match'), etag):
+            return HTTPResponse(status=304, content_type=content_type, headers=headers)
+        return HTTPResponse(body=payload(snapshot), content_type=content_type, headers=headers)
+
+def _matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
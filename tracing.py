@@ -0,0 +1,233 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Spans buffered before they are written out, unless a root span ends first
+BUFFER_SPANS = 1000
+
+# Trace file size at which it is rotated to `<file>.1`
+MAX_TRACE_BYTES = 64 * 1024 * 1024
+
+# Seconds between stack samples while profiling, and profiles kept on disk
+SAMPLE_INTERVAL = 0.005
+KEEP_PROFILES = 20
+
+# Returned by span() while tracing is off, so a disabled span is one attribute check
+_DISABLED = nullcontext()
+
+# (trace id, span id) of the span the current thread or task is in
+_current: contextvars.ContextVar[tuple[str, int] | None] = contextvars.ContextVar('span', default=None)
+
+class Tracer:
+    """
+    Writes spans as JSON lines: one object per finished span with its name, start time (unix),
+    duration in milliseconds, trace id, span id, parent span id, thread and attributes.
+
+    A span started outside any other span begins a new trace (e.g. one reconcile cycle). Work
+    handed to an executor only stays in the trace if the function is wrapped with `bind`.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = MAX_TRACE_BYTES):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__buffer: list[str] = []
+        self.__ids = itertools.count(1)
+        self.__prefix = f"{os.getpid():x}-{int(time.time()):x}"
+
+    @property
+    def enabled(self) -> bool:
+        return self.__path is not None
+
+    def span(self, name: str, **attributes):
+        """Context manager timing `name`; yields a dict further attributes can be added to."""
+        if self.__path is None:
+            return _DISABLED
+        return self.__span(name, attributes)
+
+    def bind(self, function):
+        """`function` running in the trace and under the span that is current now (for executors)."""
+        if self.__path is None:
+            return function
+        context = contextvars.copy_context()
+        return functools.wraps(function)(lambda *args, **kwargs: context.copy().run(function, *args, **kwargs))
+
+    def flush(self):
+        with self.__lock:
+            self.__flush()
+
+    @contextmanager
+    def __span(self, name: str, attributes: dict):
+        parent = _current.get()
+        span_id = next(self.__ids)
+        trace_id = parent[0] if parent else f"{self.__prefix}-{span_id:x}"
+        token = _current.set((trace_id, span_id))
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _current.reset(token)
+            record = {
+                'name': name,
+                'start': round(started, 6),
+                'duration_ms': round(duration * 1000, 3),
+                'trace': trace_id,
+                'span': span_id,
+                'parent': parent[1] if parent else None,
+                'thread': threading.current_thread().name,
+                **attributes,
+            }
+            line = json.dumps(record, default=str)
+            with self.__lock:
+                self.__buffer.append(line)
+                if parent is None or len(self.__buffer) >= BUFFER_SPANS:
+                    self.__flush()
+
+    def __flush(self):
+        if not self.__buffer:
+            return
+        try:
+            if self.__max_bytes and os.path.exists(self.__path) and os.path.getsize(self.__path) >= self.__max_bytes:
+                os.replace(self.__path, f"{self.__path}.1")
+            with open(self.__path, 'a') as f:
+                f.write("\n".join(self.__buffer) + "\n")
+        except OSError as e:
+            print(f"Failed to write {len(self.__buffer)} spans to {self.__path}: {e}")
+        self.__buffer.clear()
+
+TRACER = Tracer()
+
+def configure(path: str = None, max_bytes: int = MAX_TRACE_BYTES):
+    """Write spans to `path` (None to turn tracing off)."""
+    global TRACER
+    if path:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        print(f"Writing trace spans to {path}")
+    TRACER.flush()
+    TRACER = Tracer(path, max_bytes)
+
+def span(name: str, **attributes):
+    return TRACER.span(name, **attributes)
+
+def bind(function):
+    return TRACER.bind(function)
+
+def traced(name: str):
+    """Decorator putting every call of the function in a span called `name`."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            with TRACER.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread from a background thread and counts them, for the
+    collapsed-stack format flame graph tools read (`thread;outer;...;inner count` per line).
+    Costs one stack walk per thread per `interval` while running, and nothing otherwise.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def __run(self):
+        own = threading.get_ident()
+        while not self.__stop.wait(self.__interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+class SlowCycleProfiler:
+    """
+    Profiles the cycle after one that took longer than `threshold` seconds and saves the profile
+    to `directory` as `<name>-<time>.folded`, keeping the newest KEEP_PROFILES. Wrap each cycle
+    in `cycle()`; unarmed, it only compares the duration against the threshold.
+    """
+
+    def __init__(self, threshold: float, directory: str, name: str = 'cycle', keep: int = KEEP_PROFILES):
+        self.__threshold = threshold
+        self.__directory = directory
+        self.__name = name
+        self.__keep = keep
+        self.__armed = False
+        self.last_profile: str = None
+
+    @contextmanager
+    def cycle(self):
+        profiler = None
+        if self.__armed:
+            self.__armed = False
+            profiler = SamplingProfiler()
+            profiler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if profiler:
+                profiler.stop()
+                self.__save(profiler, duration)
+            elif duration > self.__threshold:
+                print(f"{self.__name.capitalize()} took {duration:.2f}s (over {self.__threshold:g}s), profiling the next one")
+                self.__armed = True
+
+    def __save(self, profiler: SamplingProfiler, duration: float):
+        path = os.path.join(self.__directory, f"{self.__name}-{time.strftime('%Y%m%dT%H%M%S')}.folded")
+        try:
+            os.makedirs(self.__directory, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(profiler.collapsed())
+            profiles = sorted(entry for entry in os.listdir(self.__directory)
+                              if entry.startswith(f"{self.__name}-") and entry.endswith('.folded'))
+            for old in profiles[:-self.__keep]:
+                os.remove(os.path.join(self.__directory, old))
+        except OSError as e:
+            print(f"Failed to save the profile of a {self.__name} to {path}: {e}")
+            return
+        self.last_profile = path
+        print(f"Profiled a {duration:.2f}s {self.__name} ({profiler.samples} samples): {path}")
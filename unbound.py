@@ -0,0 +1,341 @@
+import json
+import math
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from dataclasses import asdict, dataclass
+from ipaddress import IPv6Address, IPv6Network
+from typing import Callable
+
+from httpapi import ControlAPI, HTTPResponse
+
+MIB = 1024 * 1024
+
+# Name with only A records (RFC 7050), so any AAAA answer for it was synthesized by DNS64
+IPV4ONLY_NAME = 'ipv4only.arpa'
+
+DNS_TYPE_AAAA = 28
+DNS_CLASS_IN = 1
+
+def host_cpus() -> int:
+    """CPUs this process may use: its affinity, capped by a cgroup v2 CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(cpus, 1)
+
+def host_memory() -> int:
+    """Bytes of memory this process may use: the host's, capped by a cgroup memory limit."""
+    with open('/proc/meminfo') as f:
+        memory = next(int(line.split()[1]) * 1024 for line in f if line.startswith('MemTotal:'))
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+            if limit != 'max':
+                memory = min(memory, int(limit))
+            break
+        except (OSError, ValueError):
+            continue
+    return memory
+
+def _yes(value: bool) -> str:
+    return 'yes' if value else 'no'
+
+@dataclass(frozen=True)
+class UnboundProfile:
+    # Worker threads, one per CPU
+    threads: int
+
+    # Cache slabs (a power of two near the thread count) so threads rarely contend on a lock
+    slabs: int
+
+    # Cache sizes in bytes. The rrset cache holds the records the message cache points into, so
+    # it gets twice the space
+    msg_cache: int
+    rrset_cache: int
+    key_cache: int
+
+    # Refresh popular records before they expire, so they never miss the cache
+    prefetch: bool = True
+
+    # Answer from an expired record when the authoritative servers don't answer in time (RFC 8767)
+    serve_expired: bool = True
+    serve_expired_ttl: int = 86400
+    serve_expired_client_timeout: int = 1800
+
+    def render(self) -> str:
+        """The profile as an unbound config fragment, for an `include:` in the server clause."""
+        slabs = self.slabs
+        return '\n'.join([
+            f"# Generated by unbound.py for {self.threads} CPUs and {self.cache_memory // MIB}m of cache",
+            "server:",
+            f"  num-threads: {self.threads}",
+            "  so-reuseport: yes",
+            f"  msg-cache-slabs: {slabs}",
+            f"  rrset-cache-slabs: {slabs}",
+            f"  infra-cache-slabs: {slabs}",
+            f"  key-cache-slabs: {slabs}",
+            f"  msg-cache-size: {self.msg_cache // MIB}m",
+            f"  rrset-cache-size: {self.rrset_cache // MIB}m",
+            f"  key-cache-size: {self.key_cache // MIB}m",
+            f"  prefetch: {_yes(self.prefetch)}",
+            f"  prefetch-key: {_yes(self.prefetch)}",
+            f"  serve-expired: {_yes(self.serve_expired)}",
+            f"  serve-expired-ttl: {self.serve_expired_ttl}",
+            f"  serve-expired-client-timeout: {self.serve_expired_client_timeout}",
+            "",
+        ])
+
+    @property
+    def cache_memory(self) -> int:
+        return self.msg_cache + self.rrset_cache + self.key_cache
+
+def profile(cpus: int = None, memory: int = None, cache_share: float = 0.25, max_cache: int = 1024 * MIB,
+            threads: int = None) -> UnboundProfile:
+    """
+    Size unbound for the host: a thread per CPU and `cache_share` of its memory (at most
+    `max_cache`) split between the message, rrset and key caches.
+
+    The caches are shared by all threads, but unbound's resident size ends up around 2.5x the
+    configured cache sizes once malloc overhead and per-thread buffers are counted, so the
+    share is divided by that.
+    """
+    cpus = cpus or host_cpus()
+    memory = memory or host_memory()
+    threads = threads or cpus
+    slabs = 1 << max(threads - 1, 0).bit_length()
+    cache = max(min(int(memory * cache_share / 2.5), max_cache), 8 * MIB)
+    # 1:2 message to rrset, plus a small key cache for DNSSEC validation
+    unit = cache // 7
+    return UnboundProfile(
+        threads=threads,
+        slabs=slabs,
+        msg_cache=max(unit * 2, 2 * MIB) // MIB * MIB,
+        rrset_cache=max(unit * 4, 4 * MIB) // MIB * MIB,
+        key_cache=max(unit, 1 * MIB) // MIB * MIB,
+    )
+
+def parse_stats(text: str) -> dict[str, float]:
+    """`unbound-control stats` output (`name=value` lines) as a dict."""
+    counters = {}
+    for line in text.splitlines():
+        name, _, value = line.partition('=')
+        try:
+            counters[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return counters
+
+@dataclass(frozen=True)
+class Synthesis:
+    # Whether the resolver answered the probe with an address in the DNS64 prefix
+    ok: bool
+
+    # Seconds the probe query took, or None if it got no answer
+    seconds: float | None
+
+    addresses: tuple[str, ...] = ()
+
+def probe_synthesis(server: str = '127.0.0.1', port: int = 53, prefix: IPv6Network = IPv6Network('64:ff9b::/96'),
+                    name: str = IPV4ONLY_NAME, timeout: float = 2) -> Synthesis:
+    """Ask the resolver for the AAAA records of an IPv4-only name and check they were synthesized."""
+    ident = int.from_bytes(os.urandom(2), 'big')
+    question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\0'
+    query = struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0) + question + struct.pack('!HH', DNS_TYPE_AAAA, DNS_CLASS_IN)
+    family = socket.AF_INET6 if ':' in server else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        start = time.perf_counter()
+        try:
+            sock.sendto(query, (server, port))
+            while True:
+                data = sock.recv(4096)
+                if len(data) >= 12 and struct.unpack('!H', data[:2])[0] == ident:
+                    break
+        except OSError:
+            return Synthesis(ok=False, seconds=None)
+        seconds = time.perf_counter() - start
+
+    addresses = []
+    try:
+        answers = struct.unpack('!H', data[6:8])[0]
+        offset = _skip_name(data, 12) + 4
+        for _ in range(answers):
+            offset = _skip_name(data, offset)
+            rtype, _, _, length = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            if rtype == DNS_TYPE_AAAA and length == 16:
+                addresses.append(str(IPv6Address(data[offset:offset + 16])))
+            offset += length
+    except (struct.error, ValueError, IndexError):
+        pass
+    ok = bool(addresses) and all(IPv6Address(address) in prefix for address in addresses)
+    return Synthesis(ok=ok, seconds=seconds, addresses=tuple(addresses))
+
+def _skip_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            # Compression pointer, the name ends here
+            return offset + 2
+        offset += length + 1
+
+@dataclass(frozen=True)
+class ResolverStats:
+    # Cumulative since the resolver started
+    queries: int
+    cache_hits: int
+    cache_misses: int
+    prefetches: int
+    expired_answers: int
+    aaaa_queries: int
+
+    # Recursion time of the answers that missed the cache, in seconds
+    recursion_avg: float
+    recursion_median: float
+
+    # Queries waiting on recursion, averaged over the threads
+    request_list_avg: float
+
+    # Memory in the message and rrset caches
+    cache_memory: int
+
+    # Result of the last DNS64 synthesis probe, if one was made
+    synthesis: Synthesis | None = None
+
+    @property
+    def hit_ratio(self) -> float | None:
+        answered = self.cache_hits + self.cache_misses
+        return self.cache_hits / answered if answered else None
+
+    @classmethod
+    def from_counters(cls, counters: dict[str, float], synthesis: Synthesis = None) -> 'ResolverStats':
+        value = lambda name: counters.get(name, 0)
+        return cls(
+            queries=int(value('total.num.queries')),
+            cache_hits=int(value('total.num.cachehits')),
+            cache_misses=int(value('total.num.cachemiss')),
+            prefetches=int(value('total.num.prefetch')),
+            expired_answers=int(value('total.num.expired')),
+            aaaa_queries=int(value('num.query.type.AAAA')),
+            recursion_avg=value('total.recursion.time.avg'),
+            recursion_median=value('total.recursion.time.median'),
+            request_list_avg=value('total.requestlist.avg'),
+            cache_memory=int(value('mem.cache.message') + value('mem.cache.rrset')),
+            synthesis=synthesis,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ResolverStats':
+        data = {name: value for name, value in data.items() if name != 'hit_ratio'}
+        synthesis = data.pop('synthesis', None)
+        if synthesis is not None:
+            synthesis = Synthesis(**{**synthesis, 'addresses': tuple(synthesis.get('addresses', ()))})
+        return cls(**data, synthesis=synthesis)
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), 'hit_ratio': self.hit_ratio}
+
+def read_stats(command: tuple[str, ...] = ('unbound-control',), prefix: IPv6Network = IPv6Network('64:ff9b::/96'),
+               timeout: float = 5) -> ResolverStats:
+    """Stats of the local resolver, without resetting its counters, and a fresh synthesis probe."""
+    output = subprocess.run([*command, 'stats_noreset'], capture_output=True, text=True, timeout=timeout, check=True)
+    return ResolverStats.from_counters(parse_stats(output.stdout), probe_synthesis(prefix=prefix))
+
+def fetch_stats(url: str, timeout: float = 5) -> ResolverStats:
+    """Stats published by the scraper running next to a resolver (its /stats endpoint)."""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return ResolverStats.from_dict(json.loads(response.read()))
+
+class StatsScraper:
+    """
+    Reads resolver stats from `source` on a background thread and keeps the last result, so
+    health checks and metric scrapes never wait on the resolver.
+    """
+
+    def __init__(self, source: Callable[[], ResolverStats], interval: float = 30):
+        self.__source = source
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.stats: ResolverStats | None = None
+        self.checked: float | None = None
+        self.error: str | None = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='dns64-stats', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def scrape(self) -> ResolverStats | None:
+        try:
+            self.stats = self.__source()
+            self.error = None
+        except Exception as e:
+            self.error = str(e)
+        self.checked = time.time()
+        return self.stats
+
+    def as_dict(self) -> dict:
+        return {
+            'stats': self.stats.as_dict() if self.stats else None,
+            'checked': self.checked,
+            'error': self.error,
+        }
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.scrape()
+            self.__stop.wait(self.__interval)
+
+if __name__ == "__main__":
+    # Runs as the resolver container's entrypoint: write the profile, start unbound and publish its stats
+    profile_file = os.environ.get('UNBOUND_PROFILE', '/usr/local/etc/unbound/profile.conf')
+    dns64_prefix = IPv6Network(os.environ.get('DNS64_PREFIX', '64:ff9b::/96'))
+    result = profile(
+        cpus=int(os.environ['DNS64_CPUS']) if os.environ.get('DNS64_CPUS') else None,
+        memory=int(os.environ['DNS64_MEMORY_MB']) * MIB if os.environ.get('DNS64_MEMORY_MB') else None,
+        cache_share=float(os.environ.get('DNS64_CACHE_SHARE', 0.25)),
+        threads=int(os.environ['DNS64_THREADS']) if os.environ.get('DNS64_THREADS') else None,
+    )
+    with open(profile_file, 'w') as f:
+        f.write(result.render())
+    print(f"Unbound profile: {result.threads} threads, {result.slabs} slabs, "
+          f"msg {result.msg_cache // MIB}m, rrset {result.rrset_cache // MIB}m, key {result.key_cache // MIB}m")
+
+    unbound = subprocess.Popen(['unbound', '-d', *sys.argv[1:]])
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: unbound.send_signal(signum))
+
+    scraper = StatsScraper(lambda: read_stats(prefix=dns64_prefix), interval=float(os.environ.get('STATS_INTERVAL', 15)))
+    api = ControlAPI(port=int(os.environ.get('STATS_PORT', 9053)))
+    api.route('/stats', lambda request: HTTPResponse(
+        status=200 if scraper.stats else 503,
+        body=json.dumps(scraper.stats.as_dict() if scraper.stats else {'detail': scraper.error}).encode(),
+    ))
+    api.start()
+    scraper.start()
+
+    code = unbound.wait()
+    scraper.stop()
+    api.stop()
+    sys.exit(code)
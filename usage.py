@@ -0,0 +1,212 @@
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Callable, Hashable, Mapping
+
+from wireguard_tools import WireguardKey, WireguardPeer
+
+from backend import WireguardBackend, select_backend
+
+@dataclass(frozen=True)
+class PeerUsage:
+    key: str
+    server: int | None
+
+    # Bytes per second over the requested window
+    rx_rate: float
+    tx_rate: float
+
+    # Bytes transferred since the peer was first sampled, across counter resets
+    rx_total: int
+    tx_total: int
+
+    def as_dict(self) -> dict:
+        return {
+            'public_key': self.key,
+            'server': self.server,
+            'rx_rate': round(self.rx_rate, 1),
+            'tx_rate': round(self.tx_rate, 1),
+            'rx_total': self.rx_total,
+            'tx_total': self.tx_total,
+        }
+
+class UsageSeries:
+    """
+    Fixed-size ring buffer of (time, rx, tx) samples for one peer.
+
+    Values are the peer's cumulative totals, stored in flat typed arrays (24 bytes a sample)
+    rather than a list of tuples, so a few hundred samples for every peer stay small.
+    """
+
+    def __init__(self, capacity: int):
+        self.__times = array('d', bytes(8 * capacity))
+        self.__rx = array('Q', bytes(8 * capacity))
+        self.__tx = array('Q', bytes(8 * capacity))
+        self.__capacity = capacity
+        self.__head = 0
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, timestamp: float, rx: int, tx: int):
+        self.__times[self.__head] = timestamp
+        self.__rx[self.__head] = rx
+        self.__tx[self.__head] = tx
+        self.__head = (self.__head + 1) % self.__capacity
+        self.__count = min(self.__count + 1, self.__capacity)
+
+    def latest(self) -> tuple[float, int, int] | None:
+        if not self.__count:
+            return None
+        index = (self.__head - 1) % self.__capacity
+        return self.__times[index], self.__rx[index], self.__tx[index]
+
+    def rate(self, window: float) -> tuple[float, float]:
+        """Average rx/tx bytes per second between the newest sample and the oldest one inside `window`."""
+        if self.__count < 2:
+            return 0.0, 0.0
+        newest = (self.__head - 1) % self.__capacity
+        oldest = newest
+        for offset in range(1, self.__count):
+            index = (newest - offset) % self.__capacity
+            if self.__times[newest] - self.__times[index] > window:
+                break
+            oldest = index
+        if oldest == newest:
+            # Window is shorter than the sample interval, use the previous sample
+            oldest = (newest - 1) % self.__capacity
+        elapsed = self.__times[newest] - self.__times[oldest]
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return ((self.__rx[newest] - self.__rx[oldest]) / elapsed,
+                (self.__tx[newest] - self.__tx[oldest]) / elapsed)
+
+    def samples(self) -> list[tuple[float, int, int]]:
+        """All samples, oldest first."""
+        start = (self.__head - self.__count) % self.__capacity
+        return [
+            (self.__times[index], self.__rx[index], self.__tx[index])
+            for index in ((start + offset) % self.__capacity for offset in range(self.__count))
+        ]
+
+class UsageTracker:
+    """
+    Rolling transfer accounting for wireguard peers.
+
+    Each sample records every peer's counters. The device counters restart when a peer is
+    re-added, so totals are accumulated from deltas and survive resets. Per-server totals also
+    outlive the peer itself (e.g. when a server re-handshakes with a new key), until the server
+    is forgotten.
+    """
+
+    def __init__(self, capacity: int = 360):
+        self.__capacity = capacity
+        self.__lock = threading.Lock()
+        self.__series: dict[Hashable, UsageSeries] = {}
+        self.__owners: dict[Hashable, int | None] = {}
+        # Last raw device counters per peer, to detect resets
+        self.__counters: dict[Hashable, tuple[int, int]] = {}
+        self.__server_totals: dict[int | None, list[int]] = {}
+
+    def sample(self, peers: Mapping[Hashable, WireguardPeer], owner: Callable[[Hashable], int | None] = None,
+               now: float = None):
+        now = time.time() if now is None else now
+        with self.__lock:
+            for key, peer in peers.items():
+                rx, tx = peer.rx_bytes or 0, peer.tx_bytes or 0
+                previous_rx, previous_tx = self.__counters.get(key, (0, 0))
+                # A counter lower than last time means the peer was reset; everything is new traffic
+                delta_rx = rx - previous_rx if rx >= previous_rx else rx
+                delta_tx = tx - previous_tx if tx >= previous_tx else tx
+                self.__counters[key] = (rx, tx)
+
+                series = self.__series.get(key)
+                if series is None:
+                    series = self.__series[key] = UsageSeries(self.__capacity)
+                latest = series.latest()
+                total_rx, total_tx = (latest[1], latest[2]) if latest else (0, 0)
+                series.append(now, total_rx + delta_rx, total_tx + delta_tx)
+
+                server = owner(key) if owner else None
+                self.__owners[key] = server
+                totals = self.__server_totals.setdefault(server, [0, 0])
+                totals[0] += delta_rx
+                totals[1] += delta_tx
+
+            for key in [key for key in self.__series if key not in peers]:
+                del self.__series[key]
+                del self.__counters[key]
+                del self.__owners[key]
+
+    def forget(self, server: int):
+        """Drop a server's totals, once it is gone for good (left the inventory or moved to another gateway)."""
+        with self.__lock:
+            self.__server_totals.pop(server, None)
+
+    def usage(self, window: float = 60) -> list[PeerUsage]:
+        with self.__lock:
+            result = []
+            for key, series in self.__series.items():
+                rx_rate, tx_rate = series.rate(window)
+                _, rx_total, tx_total = series.latest()
+                result.append(PeerUsage(
+                    key=str(key),
+                    server=self.__owners.get(key),
+                    rx_rate=rx_rate,
+                    tx_rate=tx_rate,
+                    rx_total=rx_total,
+                    tx_total=tx_total,
+                ))
+            return result
+
+    def top_talkers(self, count: int = 10, window: float = 60) -> list[PeerUsage]:
+        """Peers with the highest combined rx+tx rate over `window` seconds."""
+        return sorted(self.usage(window), key=lambda usage: usage.rx_rate + usage.tx_rate, reverse=True)[:count]
+
+    def server_totals(self) -> dict[int | None, tuple[int, int]]:
+        """Bytes (rx, tx) transferred per server since the tracker started."""
+        with self.__lock:
+            return {server: (rx, tx) for server, (rx, tx) in self.__server_totals.items()}
+
+    def history(self, key: Hashable) -> list[tuple[float, int, int]]:
+        with self.__lock:
+            series = self.__series.get(key)
+            return series.samples() if series else []
+
+class UsageSampler:
+    """Samples a wireguard interface's peer counters into a UsageTracker on a background thread."""
+
+    def __init__(self, interface: str, tracker: UsageTracker, interval: float = 10,
+                 owner: Callable[[WireguardKey], int | None] = None, backend: WireguardBackend = None):
+        self.__interface = interface
+        self.__backend = backend or select_backend()
+        self.__tracker = tracker
+        self.__interval = interval
+        self.__owner = owner
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='usage-sampler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def sample(self):
+        device = self.__backend.device(self.__interface)
+        try:
+            peers = device.get_config().peers
+        finally:
+            device.close()
+        self.__tracker.sample(peers, self.__owner)
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Failed to sample usage for {self.__interface}: {e}")
+            self.__stop.wait(self.__interval)
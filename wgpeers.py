@@ -0,0 +1,69 @@
+import os
+import socket
+
+from wireguard_tools import WireguardKey, WireguardPeer
+
+# Where userspace implementations (boringtun) put their UAPI sockets, `<interface>.sock`
+UAPI_SOCKET_DIR = "/var/run/wireguard"
+
+class PeerUpdateError(RuntimeError):
+    pass
+
+def uapi_message(removed: list[WireguardKey], peers: list[WireguardPeer]) -> str:
+    """
+    A UAPI `set` message removing the `removed` peers and adding or replacing `peers`. Without
+    replace_peers it only touches the peers it names.
+    """
+    uapi = ["set=1"]
+    for key in removed:
+        uapi.extend([f"public_key={key.hex}", "remove=true"])
+    for peer in peers:
+        uapi.append(f"public_key={peer.public_key.hex}")
+        if peer.endpoint_host is not None and peer.endpoint_port is not None:
+            host = str(peer.endpoint_host)
+            uapi.append(f"endpoint={f'[{host}]' if ':' in host else host}:{peer.endpoint_port}")
+        if peer.preshared_key is not None:
+            uapi.append(f"preshared_key={peer.preshared_key.hex}")
+        uapi.append(f"persistent_keepalive_interval={peer.persistent_keepalive or 0}")
+        uapi.append("replace_allowed_ips=true")
+        uapi.extend(f"allowed_ip={address}" for address in peer.allowed_ips)
+    uapi.append("\n")
+    return "\n".join(uapi)
+
+def set_peers_uapi(interface: str, removed: list[WireguardKey], peers: list[WireguardPeer],
+                   socket_dir: str = UAPI_SOCKET_DIR):
+    """Apply the peer changes over the interface's UAPI socket, raising PeerUpdateError if it refuses them."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(os.path.join(socket_dir, f"{interface}.sock"))
+        sock.sendall(uapi_message(removed, peers).encode())
+        # The response is key=value lines ending with an empty line
+        response = b""
+        while not response.endswith(b"\n\n"):
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+    fields = dict(line.split("=", 1) for line in response.decode().splitlines() if "=" in line)
+    errno = int(fields.get("errno", 0))
+    if errno != 0:
+        raise PeerUpdateError(f"Failed to apply peer changes to {interface}: errno {errno}")
+
+def netlink_peer(peer: WireguardPeer) -> dict:
+    """`peer` as pyroute2's WireGuard.set expects it."""
+    attributes = {"public_key": str(peer.public_key), "allowed_ips": [str(address) for address in peer.allowed_ips]}
+    if peer.endpoint_host is not None and peer.endpoint_port is not None:
+        attributes["endpoint_addr"] = str(peer.endpoint_host)
+        attributes["endpoint_port"] = peer.endpoint_port
+    if peer.preshared_key is not None:
+        attributes["preshared_key"] = str(peer.preshared_key)
+    attributes["persistent_keepalive"] = peer.persistent_keepalive or 0
+    return attributes
+
+def set_peers_netlink(interface: str, removed: list[WireguardKey], peers: list[WireguardPeer]):
+    """Apply the peer changes to a kernel device over netlink (needs CAP_NET_ADMIN)."""
+    from pyroute2 import WireGuard
+    with WireGuard() as wg:
+        for key in removed:
+            wg.set(interface, peer={"public_key": str(key), "remove": True})
+        for peer in peers:
+            wg.set(interface, peer=netlink_peer(peer))